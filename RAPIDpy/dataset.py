@@ -6,8 +6,12 @@
    Created by Alan D Snow, 2016.
    License: BSD-3-Clause
 """
+from collections import OrderedDict
 from csv import writer as csv_writer
 import datetime
+import os
+import struct
+from threading import Lock
 
 from netCDF4 import Dataset, num2date
 import numpy as np
@@ -18,6 +22,26 @@ from pytz import utc
 
 from .helper_functions import log, open_csv
 
+# largest gap of unrequested values read to join two runs of indices
+# along the dimension that is contiguous in the file
+QOUT_READ_MAX_GAP = 64
+# default size of the blocks of Qout values read by iter_qout_blocks
+QOUT_BLOCK_MAX_BYTES = 64 * 1024 ** 2
+
+# netCDF classic format type codes: (data type, size in bytes)
+NETCDF3_TYPES = {
+    1: ('>i1', 1),
+    2: ('S1', 1),
+    3: ('>i2', 2),
+    4: ('>i4', 4),
+    5: ('>f4', 4),
+    6: ('>f8', 8),
+}
+# attributes that make netCDF4 mask or scale the values of a variable
+NETCDF_MASK_SCALE_ATTRIBUTES = ('_FillValue', 'missing_value', 'valid_min',
+                                'valid_max', 'valid_range', 'scale_factor',
+                                'add_offset')
+
 
 # -----------------------------------------------------------------------------
 # Helper Function
@@ -43,7 +67,7 @@ def compare_qout_files(dataset1_path, dataset2_path):
 
         d2_reordered_river_index_list = []
         for rivid in d1.get_river_id_array():
-            reordered_index = np.where(d2.get_river_id_array() == rivid)[0][0]
+            reordered_index = d2.get_river_index(rivid)
             d2_reordered_river_index_list.append(reordered_index)
         d2_reordered_qout = d2.get_qout_index(d2_reordered_river_index_list)
     else:
@@ -95,6 +119,299 @@ def compare_qout_files(dataset1_path, dataset2_path):
     return qout_same
 
 
+def _check_index_array(index_array, dimension_size):
+    """
+    Returns the integer indices along a dimension with the negative
+    indices counted from the end of the dimension.
+    """
+    index_array = np.asarray(index_array).ravel()
+    if index_array.dtype == np.bool_:
+        return np.flatnonzero(index_array)
+    index_array = np.where(index_array < 0,
+                           index_array + dimension_size,
+                           index_array)
+    if index_array.size and (index_array.min() < 0 or
+                             index_array.max() >= dimension_size):
+        raise IndexError("ERROR: Index out of range for dimension "
+                         "of size {0} ...".format(dimension_size))
+    return index_array
+
+
+def _plan_index_runs(index_array, dimension_size, max_gap=0):
+    """
+    Plans the reads of the indices along a dimension. The indices are
+    sorted, deduplicated and joined into runs read with one slice each.
+    Runs separated by up to `max_gap` unrequested indices are joined.
+
+    Parameters
+    ----------
+    index_array: int or list or :obj:`numpy.array`
+        The indices along the dimension. None reads the whole dimension.
+    dimension_size: int
+        The size of the dimension.
+    max_gap: int, optional
+        The largest gap between runs to read through. Default is 0.
+
+    Returns
+    -------
+    list:
+        The keys to read along the dimension.
+    :obj:`numpy.array`:
+        The position of each index in the data read with the keys
+        joined along the dimension or None if the data is in order.
+    """
+    if index_array is None:
+        return [slice(None)], None
+    if np.ndim(index_array) == 0:
+        return [index_array], None
+    index_array = np.asarray(index_array).ravel()
+    if index_array.size == 0 or index_array.dtype.kind not in 'iu':
+        # left to netCDF4 to read or reject
+        return [index_array], None
+
+    unique_index_array, unique_positions = \
+        np.unique(_check_index_array(index_array, dimension_size),
+                  return_inverse=True)
+
+    run_breaks = \
+        np.flatnonzero(np.diff(unique_index_array) > max_gap + 1) + 1
+    run_starts = unique_index_array[np.r_[0, run_breaks]]
+    run_stops = \
+        unique_index_array[np.r_[run_breaks, unique_index_array.size] - 1] + 1
+    run_offsets = np.r_[0, np.cumsum(run_stops - run_starts)[:-1]]
+
+    run_index_array = np.searchsorted(run_starts, unique_index_array,
+                                      side='right') - 1
+    positions = (unique_index_array - run_starts[run_index_array] +
+                 run_offsets[run_index_array])[unique_positions.ravel()]
+    if positions.size == run_offsets[-1] + run_stops[-1] - run_starts[-1] \
+            and (np.diff(positions) == 1).all():
+        positions = None
+
+    return ([slice(run_start, run_stop) for run_start, run_stop
+             in zip(run_starts, run_stops)],
+            positions)
+
+
+def _read_netcdf3_header(netcdf_file):
+    """
+    Reads the header of a netCDF classic or 64-bit offset format file.
+
+    Parameters
+    ----------
+    netcdf_file: file
+        The netCDF file opened in binary mode.
+
+    Returns
+    -------
+    int:
+        The number of records in the file.
+    dict:
+        The dimension sizes in order of the dimension IDs. Zero is
+        the size of the record dimension.
+    dict:
+        The variable name: (dimension IDs, type code, size in bytes of
+        the variable or of one record, file offset of the data).
+    """
+    def read_int(size=4):
+        return struct.unpack('>q' if size == 8 else '>i',
+                             netcdf_file.read(size))[0]
+
+    def read_name():
+        name_size = read_int()
+        name = netcdf_file.read(name_size)
+        netcdf_file.read(-name_size % 4)
+        return name.decode('utf-8')
+
+    def read_list_size():
+        # the tag of the list is followed by the number of elements
+        read_int()
+        return read_int()
+
+    def skip_attributes():
+        for _ in xrange(read_list_size()):
+            read_name()
+            type_size = NETCDF3_TYPES[read_int()][1]
+            value_size = read_int() * type_size
+            netcdf_file.read(value_size + -value_size % 4)
+
+    magic = netcdf_file.read(4)
+    if magic[:3] != b'CDF' or magic[3:] not in (b'\x01', b'\x02'):
+        raise ValueError("Not a netCDF classic or 64-bit offset "
+                         "format file ...")
+    offset_size = 8 if magic[3:] == b'\x02' else 4
+    num_records = read_int()
+
+    dimension_sizes = []
+    for _ in xrange(read_list_size()):
+        read_name()
+        dimension_sizes.append(read_int())
+
+    skip_attributes()
+
+    variables = {}
+    for _ in xrange(read_list_size()):
+        variable_name = read_name()
+        dimension_ids = [read_int() for _ in xrange(read_int())]
+        skip_attributes()
+        type_code = read_int()
+        variable_size = read_int()
+        variables[variable_name] = (dimension_ids, type_code,
+                                    variable_size, read_int(offset_size))
+    return num_records, dimension_sizes, variables
+
+
+def _open_netcdf3_memmap(filename, variable_name):
+    """
+    Maps a variable of a netCDF classic or 64-bit offset format file
+    into memory. The data is read from the file when it is accessed
+    and the array stays valid until it is deleted.
+
+    Parameters
+    ----------
+    filename: str
+        Path to the netCDF file.
+    variable_name: str
+        Name of the variable.
+
+    Returns
+    -------
+    :obj:`numpy.array`:
+        The read only big-endian array of the variable. Fill values
+        are not masked and packed values are not scaled.
+    """
+    with open(filename, 'rb') as netcdf_file:
+        num_records, dimension_sizes, variables = \
+            _read_netcdf3_header(netcdf_file)
+
+    dimension_ids, type_code, _, data_offset = \
+        variables[variable_name]
+    dtype = np.dtype(NETCDF3_TYPES[type_code][0])
+    shape = tuple(dimension_sizes[dimension_id]
+                  for dimension_id in dimension_ids)
+    if not dimension_ids or dimension_sizes[dimension_ids[0]] != 0:
+        return np.memmap(filename, dtype=dtype, mode='r',
+                         offset=data_offset, shape=shape)
+
+    # the records of all record variables are interleaved
+    record_variables = [record_variable
+                        for record_variable in variables.values()
+                        if record_variable[0] and
+                        dimension_sizes[record_variable[0][0]] == 0]
+    shape = (num_records,) + shape[1:]
+    item_size = int(np.prod(shape[1:])) * dtype.itemsize
+    record_size = item_size
+    if len(record_variables) > 1:
+        # the records of a single record variable are not padded
+        record_size = sum(record_variable[2]
+                          for record_variable in record_variables)
+    if not num_records:
+        return np.zeros(shape, dtype=dtype)
+    # the last record may end after this variable
+    record_memmap = np.memmap(filename, dtype=np.uint8, mode='r',
+                              offset=data_offset,
+                              shape=((num_records - 1) * record_size +
+                                     item_size,))
+    return np.ndarray(shape, dtype=dtype, buffer=record_memmap,
+                      strides=(record_size,) +
+                      np.empty(shape[1:], dtype=dtype).strides)
+
+
+class QoutBlockCache(object):
+    """
+    Cache of blocks of Qout values shared by :class:`RAPIDDataset`
+    objects in the same process. The least recently used blocks are
+    dropped when the cache is larger than `max_bytes`. The blocks are
+    kept with the path and modification time of the file, so a file
+    that is written again is read again.
+
+    Parameters
+    ----------
+    max_bytes: int, optional
+        Largest size of the blocks in the cache in bytes.
+        Default is 256 MB.
+    time_block_size: int, optional
+        Number of time steps in a block. Default is 1024.
+    river_block_size: int, optional
+        Number of river segments in a block. Default is 256.
+
+    Attributes
+    ----------
+    hits: int
+        Number of blocks found in the cache.
+    misses: int
+        Number of blocks read from the files.
+    num_bytes: int
+        Size of the blocks in the cache in bytes.
+
+
+    Example::
+
+        from RAPIDpy import RAPIDDataset
+        from RAPIDpy.dataset import QoutBlockCache
+
+        block_cache = QoutBlockCache(max_bytes=512 * 1024 ** 2)
+
+        path_to_rapid_qout = '/path/to/Qout.nc'
+        with RAPIDDataset(path_to_rapid_qout,
+                          block_cache=block_cache) as qout_nc:
+            streamflow_array = qout_nc.get_qout(53458)
+        print(block_cache.hits, block_cache.misses)
+    """
+    def __init__(self, max_bytes=256 * 1024 ** 2,
+                 time_block_size=1024, river_block_size=256):
+        if time_block_size < 1 or river_block_size < 1:
+            raise ValueError("The block sizes must be at least one.")
+        self.max_bytes = max_bytes
+        self.time_block_size = time_block_size
+        self.river_block_size = river_block_size
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        # (file, variable, block index of each dimension): block
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, block_key):
+        """
+        Returns the block and marks it as the most recently used or
+        None if the block is not in the cache.
+        """
+        with self._lock:
+            block = self._blocks.pop(block_key, None)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks[block_key] = block
+            self.hits += 1
+            return block
+
+    def put(self, block_key, block):
+        """
+        Adds the block to the cache and drops the least recently used
+        blocks to keep the cache under `max_bytes`. Blocks larger than
+        the cache are not added.
+        """
+        if block.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old_block = self._blocks.pop(block_key, None)
+            if old_block is not None:
+                self.num_bytes -= old_block.nbytes
+            self._blocks[block_key] = block
+            self.num_bytes += block.nbytes
+            while self.num_bytes > self.max_bytes:
+                self.num_bytes -= self._blocks.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        """
+        Removes all of the blocks from the cache.
+        """
+        with self._lock:
+            self._blocks.clear()
+            self.num_bytes = 0
+
+
 # ------------------------------------------------------------------------------
 # Main Dataset Manager Class
 # ------------------------------------------------------------------------------
@@ -123,6 +440,15 @@ class RAPIDDataset(object):
     out_tzinfo: tzinfo, optional
         Time zone to output data as. The dates will be converted from UTC
         to the time zone input. Default is UTC.
+    use_memmap: bool, optional
+        If True, the streamflow variable of a netCDF classic or 64-bit
+        offset format file is mapped into memory and read without the
+        netCDF library. The streamflow arrays returned are read only
+        big-endian views of the file. Not used if the values of the
+        variable are masked or scaled. Default is False.
+    block_cache: :class:`QoutBlockCache`, optional
+        If given, the streamflow is read in blocks kept in the cache
+        for the next queries. Not used with `use_memmap`.
 
 
     Example::
@@ -141,7 +467,9 @@ class RAPIDDataset(object):
                  streamflow_variable="",
                  datetime_simulation_start=None,
                  simulation_time_step_seconds=None,
-                 out_tzinfo=None):
+                 out_tzinfo=None,
+                 use_memmap=False,
+                 block_cache=None):
         """
         Initialize the class with variables given by the user
         """
@@ -222,6 +550,32 @@ class RAPIDDataset(object):
         self.out_tzinfo = out_tzinfo
         self.datetime_simulation_start = datetime_simulation_start
         self.simulation_time_step_seconds = simulation_time_step_seconds
+        # (sorted river ID array, index of each river ID in the file)
+        self._river_id_lookup = None
+
+        self.qout_memmap = None
+        if use_memmap:
+            qout_variable = self.qout_nc.variables[self.q_var_name]
+            if self.qout_nc.data_model not in ('NETCDF3_CLASSIC',
+                                               'NETCDF3_64BIT_OFFSET'):
+                log("{0} is not a netCDF classic format file. "
+                    "Reading with netCDF4 ...".format(filename),
+                    "WARNING")
+            elif set(NETCDF_MASK_SCALE_ATTRIBUTES) \
+                    .intersection(qout_variable.ncattrs()):
+                log("{0} is masked or scaled. Reading with netCDF4 ..."
+                    .format(self.q_var_name),
+                    "WARNING")
+            else:
+                self.qout_memmap = \
+                    _open_netcdf3_memmap(filename, self.q_var_name)
+
+        self.block_cache = block_cache
+        if block_cache is not None:
+            qout_stat = os.stat(filename)
+            self._block_cache_file = (os.path.abspath(filename),
+                                      qout_stat.st_mtime,
+                                      qout_stat.st_size)
 
     def __enter__(self):
         return self
@@ -231,6 +585,8 @@ class RAPIDDataset(object):
 
     def close(self):
         """Close the dataset."""
+        # the memory map is closed with the last array using it
+        self.qout_memmap = None
         self.qout_nc.close()
 
     def _is_legacy_time_valid(self):
@@ -552,6 +908,44 @@ class RAPIDDataset(object):
         """
         return self.qout_nc.variables[self.river_id_variable][:]
 
+    def _get_river_id_lookup(self):
+        """
+        Returns the river IDs of the file sorted and the index of each
+        sorted river ID in the file. The river IDs are read once and
+        the lookup is kept for the other searches.
+        """
+        if self._river_id_lookup is None:
+            river_id_array = np.asarray(self.get_river_id_array())
+            # a stable sort keeps the first index of a duplicate river ID
+            river_id_sort_index = np.argsort(river_id_array, kind='mergesort')
+            self._river_id_lookup = (river_id_array[river_id_sort_index],
+                                     river_id_sort_index)
+        return self._river_id_lookup
+
+    def _search_river_index(self, river_id_array):
+        """
+        Searches for the index of each river ID in the file.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The index of each river ID in the file. The index is
+            undefined for the river IDs not found.
+        :obj:`numpy.array`:
+            True where the river ID was found.
+        """
+        sorted_river_id_array, river_id_sort_index = \
+            self._get_river_id_lookup()
+        sorted_position = np.searchsorted(sorted_river_id_array,
+                                          river_id_array)
+        found = sorted_position < sorted_river_id_array.size
+        found[found] = (sorted_river_id_array[sorted_position[found]] ==
+                        river_id_array[found])
+        sorted_position[~found] = 0
+        if not sorted_river_id_array.size:
+            return sorted_position, found
+        return river_id_sort_index[sorted_position], found
+
     def get_river_index(self, river_id):
         """
         This method retrieves the river index in the netCDF
@@ -579,11 +973,11 @@ class RAPIDDataset(object):
                 river_index = qout_nc.get_river_index(river_id)
 
         """
-        try:
-            return np.where(self.get_river_id_array() == river_id)[0][0]
-        except IndexError:
+        river_index, found = self._search_river_index(np.array([river_id]))
+        if not found[0]:
             raise IndexError("ERROR: River ID {0} not found in dataset "
                              "...".format(river_id))
+        return river_index[0]
 
     def get_subset_riverid_index_list(self, river_id_list):
         """
@@ -607,28 +1001,22 @@ class RAPIDDataset(object):
             An array of the missing river ids.
 
         """
-        netcdf_river_indices_list = []
-        valid_river_ids = []
-        missing_river_ids = []
-        for river_id in river_id_list:
-            # get where streamids are in netcdf file
-            try:
-                netcdf_river_indices_list \
-                    .append(self.get_river_index(river_id))
-                valid_river_ids.append(river_id)
-            except IndexError:
-                log("ReachID {0} not found in netCDF dataset."
-                    " Skipping ...".format(river_id),
-                    "WARNING")
-                missing_river_ids.append(river_id)
+        river_id_array = np.array(river_id_list).ravel()
+        # get where streamids are in netcdf file
+        river_index_array, found = self._search_river_index(river_id_array)
+        missing_river_ids = river_id_array[~found]
+        for river_id in missing_river_ids:
+            log("ReachID {0} not found in netCDF dataset."
+                " Skipping ...".format(river_id),
+                "WARNING")
 
-        np_valid_river_indices_list = np.array(netcdf_river_indices_list)
-        np_valid_river_ids = np.array(valid_river_ids)
+        np_valid_river_indices_list = river_index_array[found]
+        np_valid_river_ids = river_id_array[found]
         sorted_indexes = np.argsort(np_valid_river_indices_list)
 
         return(np_valid_river_indices_list[sorted_indexes],
                np_valid_river_ids[sorted_indexes],
-               np.array(missing_river_ids))
+               missing_river_ids)
 
     def get_qout(self,
                  river_id_array=None,
@@ -718,6 +1106,9 @@ class RAPIDDataset(object):
                 river_id_array = [river_id_array]
             riverid_index_list_subset = \
                 self.get_subset_riverid_index_list(river_id_array)[0]
+            if not riverid_index_list_subset.size:
+                raise IndexError("ERROR: River ID(s) {0} not found in "
+                                 "dataset ...".format(river_id_array))
 
         return self.get_qout_index(riverid_index_list_subset,
                                    date_search_start,
@@ -731,6 +1122,274 @@ class RAPIDDataset(object):
                                    filter_mode,
                                    as_dataframe)
 
+    def _read_qout_blocks(self, qout_variable, index_list):
+        """
+        Reads the indices of each dimension of the Qout variable from
+        the blocks in the block cache. The blocks not in the cache are
+        read from the file and added to the cache.
+
+        Parameters
+        ----------
+        qout_variable: :obj:`netCDF4.Variable`
+            The Qout variable.
+        index_list: list
+            The indices for each dimension of the variable
+            (see :func:`_plan_index_runs`).
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The Qout values with the dimensions of the variable.
+        """
+        block_size_list = []
+        dimension_index_list = []
+        for dimension_name, dimension_size, index_array in \
+                zip(qout_variable.dimensions, qout_variable.shape,
+                    index_list):
+            block_size_list.append(
+                self.block_cache.time_block_size
+                if dimension_name.lower() == 'time' else
+                self.block_cache.river_block_size)
+            if index_array is None:
+                dimension_index_list.append(np.arange(dimension_size))
+            else:
+                dimension_index_list.append(
+                    _check_index_array(index_array, dimension_size))
+
+        # position of the indices in each block of each dimension
+        block_positions_list = []
+        for dimension_index_array, block_size in \
+                zip(dimension_index_list, block_size_list):
+            block_index_array = dimension_index_array // block_size
+            block_order = np.argsort(block_index_array, kind='mergesort')
+            block_index_array, block_starts = \
+                np.unique(block_index_array[block_order], return_index=True)
+            block_positions_list.append(
+                list(zip(block_index_array,
+                         np.split(block_order, block_starts[1:]))))
+
+        qout_array = None
+        for outer_block_index, outer_positions in block_positions_list[0]:
+            for inner_block_index, inner_positions in \
+                    block_positions_list[1]:
+                block_key = (self._block_cache_file, self.q_var_name,
+                             outer_block_index, inner_block_index)
+                block = self.block_cache.get(block_key)
+                if block is None:
+                    block = qout_variable[
+                        outer_block_index * block_size_list[0]:
+                        (outer_block_index + 1) * block_size_list[0],
+                        inner_block_index * block_size_list[1]:
+                        (inner_block_index + 1) * block_size_list[1]]
+                    self.block_cache.put(block_key, block)
+                if qout_array is None:
+                    qout_array = (np.ma.empty if np.ma.isMaskedArray(block)
+                                  else np.empty)(
+                        [len(dimension_index_array) for dimension_index_array
+                         in dimension_index_list], dtype=block.dtype)
+                qout_array[np.ix_(outer_positions, inner_positions)] = \
+                    block[np.ix_(
+                        dimension_index_list[0][outer_positions] -
+                        outer_block_index * block_size_list[0],
+                        dimension_index_list[1][inner_positions] -
+                        inner_block_index * block_size_list[1])]
+        if qout_array is None:
+            qout_array = np.ma.empty(
+                [len(dimension_index_array) for dimension_index_array
+                 in dimension_index_list], dtype=qout_variable.dtype)
+
+        # a single index drops the dimension
+        if np.ndim(index_list[1]) == 0 and index_list[1] is not None:
+            qout_array = qout_array[:, 0]
+        if np.ndim(index_list[0]) == 0 and index_list[0] is not None:
+            qout_array = qout_array[0]
+        return qout_array
+
+    def _read_qout_subset(self, qout_variable, index_list):
+        """
+        Reads the indices of each dimension of the Qout variable with
+        one slice for each run of indices and puts the values in
+        the requested order. Gaps are only read through along the last
+        dimension, which is contiguous in the file.
+
+        Parameters
+        ----------
+        qout_variable: :obj:`netCDF4.Variable` or :obj:`numpy.memmap`
+            The Qout variable.
+        index_list: list
+            The indices for each dimension of the variable
+            (see :func:`_plan_index_runs`).
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The Qout values with the dimensions of the variable.
+        """
+        if self.block_cache is not None and self.qout_memmap is None:
+            return self._read_qout_blocks(qout_variable, index_list)
+
+        outer_keys, outer_positions = \
+            _plan_index_runs(index_list[0], qout_variable.shape[0])
+        inner_keys, inner_positions = \
+            _plan_index_runs(index_list[1], qout_variable.shape[1],
+                             QOUT_READ_MAX_GAP)
+
+        row_list = []
+        for outer_key in outer_keys:
+            block_list = [qout_variable[outer_key, inner_key]
+                          for inner_key in inner_keys]
+            if len(block_list) == 1:
+                row_list.append(block_list[0])
+            else:
+                row_list.append(np.ma.concatenate(block_list, axis=-1)
+                                if np.ma.isMaskedArray(block_list[0]) else
+                                np.concatenate(block_list, axis=-1))
+        if len(row_list) == 1:
+            qout_array = row_list[0]
+        elif np.ma.isMaskedArray(row_list[0]):
+            qout_array = np.ma.concatenate(row_list, axis=0)
+        else:
+            qout_array = np.concatenate(row_list, axis=0)
+
+        if outer_positions is not None:
+            qout_array = qout_array[outer_positions]
+        if inner_positions is not None:
+            qout_array = qout_array[..., inner_positions]
+        return qout_array
+
+    def _read_qout_river_time(self, river_index_array, time_index_array):
+        """
+        Reads the Qout values at the river and time indices
+        (see :func:`_plan_index_runs`).
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The Qout values with the river dimension first.
+        """
+        qout_variable = self.qout_nc.variables[self.q_var_name]
+        qout_dimensions = qout_variable.dimensions
+        if self.qout_memmap is not None:
+            qout_variable = self.qout_memmap
+        if qout_dimensions[0].lower() == 'time' and \
+                qout_dimensions[1].lower() == self.river_id_dimension.lower():
+            return self._read_qout_subset(
+                qout_variable,
+                [time_index_array, river_index_array]).transpose()
+        elif qout_dimensions[1].lower() == 'time' and \
+                qout_dimensions[0].lower() == self.river_id_dimension.lower():
+            return self._read_qout_subset(
+                qout_variable,
+                [river_index_array, time_index_array])
+        raise Exception("Invalid RAPID Qout file dimensions ...")
+
+    def iter_qout_blocks(self,
+                         block_size=None,
+                         axis='rivid',
+                         river_index_array=None,
+                         time_index_array=None,
+                         max_block_bytes=QOUT_BLOCK_MAX_BYTES):
+        """
+        This method reads the streamflow in blocks of river segments
+        or of time steps, so a computation over the whole file only
+        holds one block in memory.
+
+        Parameters
+        ----------
+        block_size: int, optional
+            Number of river segments or time steps in a block. Default is
+            the most that fit in `max_block_bytes`, rounded down to whole
+            chunks of the file.
+        axis: str, optional
+            Read blocks of river segments ('rivid') or of time steps
+            ('time'). Default is 'rivid'.
+        river_index_array: list or :obj:`numpy.array`, optional
+            Indices of the river segments to read. Default is all.
+        time_index_array: list or :obj:`numpy.array`, optional
+            Indices of the time steps to read. Default is all.
+        max_block_bytes: int, optional
+            Largest size of a block in bytes if `block_size`
+            is not given. Default is 64 MB.
+
+        Yields
+        ------
+        :obj:`numpy.array`:
+            The river or time indices of the block.
+        :obj:`numpy.array`:
+            The streamflow of the block with the shape (river, time).
+
+
+        Example::
+
+            from RAPIDpy import RAPIDDataset
+
+            path_to_rapid_qout = '/path/to/Qout.nc'
+            with RAPIDDataset(path_to_rapid_qout) as qout_nc:
+                max_flow_array = np.zeros(qout_nc.size_river_id)
+                for river_index_array, streamflow_array in \
+                        qout_nc.iter_qout_blocks():
+                    max_flow_array[river_index_array] = \
+                        streamflow_array.max(axis=1)
+
+        """
+        if axis == 'rivid':
+            block_dimension = self.river_id_dimension
+        elif axis == 'time':
+            block_dimension = 'time'
+        else:
+            raise ValueError("Invalid axis {0}. Must be 'rivid' or 'time'."
+                             .format(axis))
+
+        if river_index_array is not None:
+            river_index_array = _check_index_array(river_index_array,
+                                                   self.size_river_id)
+        if time_index_array is not None:
+            time_index_array = _check_index_array(time_index_array,
+                                                  self.size_time)
+        if axis == 'rivid':
+            block_index_array, other_index_array = \
+                river_index_array, time_index_array
+            block_index_size, other_index_size = \
+                self.size_river_id, self.size_time
+        else:
+            block_index_array, other_index_array = \
+                time_index_array, river_index_array
+            block_index_size, other_index_size = \
+                self.size_time, self.size_river_id
+        if block_index_array is None:
+            block_index_array = np.arange(block_index_size)
+        if other_index_array is not None:
+            other_index_size = other_index_array.size
+
+        if block_size is None:
+            qout_variable = self.qout_nc.variables[self.q_var_name]
+            block_size = max(1, max_block_bytes //
+                             (qout_variable.dtype.itemsize *
+                              max(other_index_size, 1)))
+            # None for the classic format
+            chunk_sizes = qout_variable.chunking()
+            if chunk_sizes and chunk_sizes != 'contiguous':
+                chunk_size = chunk_sizes[
+                    [dimension.lower() for dimension
+                     in qout_variable.dimensions].index(
+                         block_dimension.lower())]
+                if block_size > chunk_size:
+                    block_size -= block_size % chunk_size
+        elif block_size < 1:
+            raise ValueError("The block size must be at least one.")
+
+        for block_start in xrange(0, block_index_array.size, block_size):
+            block_indices = \
+                block_index_array[block_start:block_start + block_size]
+            if axis == 'rivid':
+                yield block_indices, \
+                    self._read_qout_river_time(block_indices,
+                                               other_index_array)
+            else:
+                yield block_indices, \
+                    self._read_qout_river_time(other_index_array,
+                                               block_indices)
+
     def get_qout_index(self,
                        river_index_array=None,
                        date_search_start=None,
@@ -762,34 +1421,8 @@ class RAPIDDataset(object):
                                                          time_index_end,
                                                          time_index)
 
-        qout_variable = self.qout_nc.variables[self.q_var_name]
-        qout_dimensions = qout_variable.dimensions
-        if qout_dimensions[0].lower() == 'time' and \
-                qout_dimensions[1].lower() == self.river_id_dimension.lower():
-            if time_index_array is not None and river_index_array is not None:
-                streamflow_array = qout_variable[time_index_array,
-                                                 river_index_array].transpose()
-            elif time_index_array is not None:
-                streamflow_array = qout_variable[time_index_array, :] \
-                                   .transpose()
-            elif river_index_array is not None:
-                streamflow_array = qout_variable[:, river_index_array] \
-                                   .transpose()
-            else:
-                streamflow_array = qout_variable[:].transpose()
-        elif qout_dimensions[1].lower() == 'time' and \
-                qout_dimensions[0].lower() == self.river_id_dimension.lower():
-            if time_index_array is not None and river_index_array is not None:
-                streamflow_array = qout_variable[river_index_array,
-                                                 time_index_array]
-            elif time_index_array is not None:
-                streamflow_array = qout_variable[:, time_index_array]
-            elif river_index_array is not None:
-                streamflow_array = qout_variable[river_index_array, :]
-            else:
-                streamflow_array = qout_variable[:]
-        else:
-            raise Exception("Invalid RAPID Qout file dimensions ...")
+        streamflow_array = self._read_qout_river_time(river_index_array,
+                                                      time_index_array)
 
         if daily:
             pd_filter = "D"
@@ -797,6 +1430,9 @@ class RAPIDDataset(object):
         if pd_filter is not None or as_dataframe:
             time_array = self.get_time_array(return_datetime=True,
                                              time_index_array=time_index_array)
+            # pandas only works with native byte order
+            streamflow_array = streamflow_array.astype(
+                streamflow_array.dtype.newbyteorder('='), copy=False)
             qout_df = pd.DataFrame(streamflow_array.T, index=time_array)
 
             if pd_filter is not None:
@@ -7,8 +7,6 @@
    Adapted from CreateInflowFileFromECMWFRunoff.py.
    License: BSD-3-Clause
 """
-from netCDF4 import Dataset
-
 from .CreateInflowFileFromGriddedRunoff import \
     CreateInflowFileFromGriddedRunoff
 
@@ -30,14 +28,11 @@ class CreateInflowFileFromERAInterimRunoff(CreateInflowFileFromGriddedRunoff):
         self.runoff_vars = ['ro']
         super(CreateInflowFileFromERAInterimRunoff, self).__init__()
 
-    def data_validation(self, in_nc):
-        """Check the necessary dimensions and variables in the input
-        netcdf data"""
-        data_nc = Dataset(in_nc)
-
+    def dataset_validation(self, data_nc):
+        """Check the necessary dimensions and variables in the opened
+        input netcdf data"""
         dims = list(data_nc.dimensions)
         if dims not in self.dims_oi:
-            data_nc.close()
             raise Exception("{0} {1}".format(self.error_messages[1], dims))
         nc_vars = list(data_nc.variables)
         if nc_vars == self.vars_oi[0]:
@@ -47,6 +42,4 @@ class CreateInflowFileFromERAInterimRunoff(CreateInflowFileFromGriddedRunoff):
         elif nc_vars == self.vars_oi[2]:
             self.runoff_vars = [self.vars_oi[0][-1]]
         else:
-            data_nc.close()
             raise Exception("{0} {1}".format(self.error_messages[2], nc_vars))
-        data_nc.close()
@@ -7,17 +7,58 @@
    License: BSD-3-Clause
 """
 from abc import abstractmethod
+import copy
 import csv
 from datetime import datetime
 import os
+from threading import Lock
 
-from netCDF4 import Dataset
+from netCDF4 import Dataset, default_fillvals
 import numpy as np
 from pytz import utc
+from scipy.sparse import csr_matrix, vstack as sparse_vstack
 from past.builtins import xrange  # pylint: disable=redefined-builtin
 
 # local
 from ..helper_functions import open_csv
+from ..utilities import prefetch_iterator
+
+# increment when the layout of the compiled weight table cache changes
+WEIGHT_TABLE_CACHE_VERSION = 2
+
+# number of grid cells that could be read in the time it takes
+# to start reading another rectangle of the runoff grid
+READ_OVERHEAD_CELLS = 1024
+
+# maximum number of grid cells summed one after another in float32
+FLOAT32_BLOCK_SIZE = 64
+
+# the netCDF library is not thread safe, so the files read ahead
+# in the background and the inflow file share this lock
+NETCDF_LOCK = Lock()
+
+# target size in bytes of the m3_riv chunks in NETCDF4 inflow files
+INFLOW_CHUNK_BYTES = 2 ** 20
+
+
+class WeightTableError(Exception):
+    """
+    Raised when the rows of a weight table are out of sequence.
+
+    Attributes
+    ----------
+    bad_rows: :obj:`numpy.array`
+        Index of each bad row in the weight table (header excluded).
+    rivids: :obj:`numpy.array`
+        The rivid of each bad row.
+    """
+    def __init__(self, message, bad_rows, rivids):
+        self.bad_rows = bad_rows
+        self.rivids = rivids
+        super(WeightTableError, self).__init__(
+            "{0}. {1} bad row(s). ROW INDEX: {2} COMID: {3}"
+            .format(message, len(bad_rows),
+                    bad_rows[:10].tolist(), rivids[:10].tolist()))
 
 
 class CreateInflowFileFromGriddedRunoff(object):
@@ -35,6 +76,13 @@ class CreateInflowFileFromGriddedRunoff(object):
         self.dict_list = []
         self.count = 0
         self.size_stream_id = 0
+        self.lat_slice = None
+        self.lon_slice = None
+        self.index_new = None
+        self.read_plan = None
+        self.weight_matrix = None
+        self.float32_weight_matrices = None
+        self.shared_weight_table = None
         self.simulation_time_step_seconds = 0
         self.error_messages = [
             "Missing Variable 'time'",
@@ -49,12 +97,27 @@ class CreateInflowFileFromGriddedRunoff(object):
             "Incorrect sequence of rows in the weight table"
         ]
 
-    def read_in_weight_table(self, in_weight_table):
+    def read_in_weight_table(self, in_weight_table, use_cache=True):
         """
         Read in weight table
+
+        Parameters
+        ----------
+        in_weight_table: str
+            Path to the weight table CSV file.
+        use_cache: bool, optional
+            If True, the compiled weight table is stored in a binary
+            sidecar file next to the CSV file and memory mapped on the
+            next read instead of parsing the CSV file again. The cache
+            is rebuilt when the path, modification time or size of the
+            CSV file changes. Default is True.
         """
         print("Reading the weight table...")
         print(in_weight_table)
+        self.shared_weight_table = None
+        if use_cache and self._load_weight_table_cache(in_weight_table):
+            return
+
         with open_csv(in_weight_table, "r") as csvfile:
             reader = csv.reader(csvfile)
             header_row = next(reader)
@@ -86,6 +149,580 @@ class CreateInflowFileFromGriddedRunoff(object):
             len(np.unique(np.array(self.dict_list[self.header_wt[0]],
                                    dtype=np.int32)))
 
+        self._compile_weight_table()
+
+        if use_cache:
+            self._write_weight_table_cache(in_weight_table)
+
+    def read_in_weight_tables(self, in_weight_table_list, use_cache=True):
+        """
+        Read in the weight tables of several watersheds on the same
+        grid and combine them so the runoff of all of the watersheds
+        is read and aggregated at once. The grid cells shared by the
+        watersheds are read once and the inflow has the rivids of
+        each watershed one after another.
+
+        Parameters
+        ----------
+        in_weight_table_list: list
+            Paths to the weight table CSV files.
+        use_cache: bool, optional
+            See :meth:`read_in_weight_table`. Default is True.
+        """
+        self.shared_weight_table = None
+        lat_ind_list = []
+        lon_ind_list = []
+        weight_matrix_list = []
+        for in_weight_table in in_weight_table_list:
+            watershed_tool = copy.copy(self)
+            watershed_tool.read_in_weight_table(in_weight_table,
+                                                use_cache=use_cache)
+            lon_ind_list.append(
+                watershed_tool.dict_list[self.header_wt[2]].astype(np.int64))
+            lat_ind_list.append(
+                watershed_tool.dict_list[self.header_wt[3]].astype(np.int64))
+            weight_matrix_list.append(watershed_tool.weight_matrix)
+
+        lon_ind_all = np.concatenate(lon_ind_list)
+        lat_ind_all = np.concatenate(lat_ind_list)
+        len_lon = lon_ind_all.max() + 1
+        cell_unique, cell_index = \
+            np.unique(lat_ind_all * len_lon + lon_ind_all,
+                      return_inverse=True)
+        lat_ind_unique, lon_ind_unique = np.divmod(cell_unique, len_lon)
+
+        # map the weight table rows of each watershed to the shared cells
+        combined_matrix_list = []
+        row_offset = 0
+        for weight_matrix in weight_matrix_list:
+            combined_matrix_list.append(csr_matrix(
+                (weight_matrix.data,
+                 cell_index[row_offset + weight_matrix.indices],
+                 weight_matrix.indptr),
+                shape=(weight_matrix.shape[0], cell_unique.size)))
+            row_offset += weight_matrix.shape[1]
+
+        self.dict_list = None
+        self.count = cell_unique.size
+        self.lat_slice = slice(lat_ind_unique.min(), lat_ind_unique.max() + 1)
+        self.lon_slice = slice(lon_ind_unique.min(), lon_ind_unique.max() + 1)
+        self.read_plan, self.index_new = \
+            self._compile_read_plan(lat_ind_unique, lon_ind_unique)
+        self.weight_matrix = sparse_vstack(combined_matrix_list,
+                                           format='csr')
+        self.size_stream_id = self.weight_matrix.shape[0]
+        self.float32_weight_matrices = None
+
+    def share_weight_table(self, in_weight_table, share_directory,
+                           use_cache=True, use_float32=False):
+        """
+        Reads in the weight table(s) and saves the compiled weight table
+        to files in `share_directory` that are memory mapped. A pickled
+        copy of the tool (Ex. in the jobs of a multiprocessing pool) then
+        only holds the paths to the files and memory maps them when it is
+        unpickled, so the workers use one copy of the weight table in the
+        page cache instead of each reading and compiling it.
+
+        Parameters
+        ----------
+        in_weight_table: str or list
+            Path to the weight table CSV file or a list of weight tables
+            (see :meth:`read_in_weight_tables`).
+        share_directory: str
+            Path to a directory that is kept until the workers finish.
+        use_cache: bool, optional
+            See :meth:`read_in_weight_table`. Default is True.
+        use_float32: bool, optional
+            If True, the float32 weight matrices (see `use_float32` in
+            :meth:`execute`) are shared as well. Default is False.
+        """
+        if isinstance(in_weight_table, list):
+            self.read_in_weight_tables(in_weight_table, use_cache=use_cache)
+        else:
+            self.read_in_weight_table(in_weight_table, use_cache=use_cache)
+
+        shared_matrices = {'weight': [self.weight_matrix]}
+        if use_float32:
+            shared_matrices['float32'] = self._get_float32_weight_matrices()
+
+        shared_arrays = {'index_new': self.index_new,
+                         'read_plan': self.read_plan}
+        matrix_shapes = {}
+        for matrix_name, matrix_list in shared_matrices.items():
+            matrix_shapes[matrix_name] = []
+            for matrix_index, weight_matrix in enumerate(matrix_list):
+                array_name = "{0}_{1}".format(matrix_name, matrix_index)
+                shared_arrays[array_name + "_data"] = weight_matrix.data
+                shared_arrays[array_name + "_indices"] = \
+                    weight_matrix.indices
+                shared_arrays[array_name + "_indptr"] = weight_matrix.indptr
+                matrix_shapes[matrix_name].append(weight_matrix.shape)
+
+        for array_name, shared_array in shared_arrays.items():
+            np.save(os.path.join(share_directory, array_name + ".npy"),
+                    np.ascontiguousarray(shared_array))
+
+        self.shared_weight_table = {
+            'source': in_weight_table,
+            'directory': share_directory,
+            'matrix_shapes': matrix_shapes,
+        }
+        # use the shared copy in this process as well
+        self._attach_shared_weight_table()
+
+    def release_shared_weight_table(self):
+        """
+        Closes the weight table shared with :meth:`share_weight_table`
+        so its files can be removed. The weight table needs to be read
+        in again to use the tool.
+        """
+        if self.shared_weight_table is None:
+            return
+        self.shared_weight_table = None
+        self.dict_list = []
+        self.index_new = None
+        self.read_plan = None
+        self.weight_matrix = None
+        self.float32_weight_matrices = None
+
+    def _attach_shared_weight_table(self):
+        """
+        Memory maps the weight table shared with
+        :meth:`share_weight_table`.
+        """
+        share_directory = self.shared_weight_table['directory']
+
+        def load_shared_array(array_name):
+            """memory map a shared array"""
+            return np.load(os.path.join(share_directory,
+                                        array_name + ".npy"),
+                           mmap_mode='r')
+
+        shared_matrices = {}
+        for matrix_name, shape_list in \
+                self.shared_weight_table['matrix_shapes'].items():
+            shared_matrices[matrix_name] = []
+            for matrix_index, matrix_shape in enumerate(shape_list):
+                array_name = "{0}_{1}".format(matrix_name, matrix_index)
+                shared_matrices[matrix_name].append(csr_matrix(
+                    (load_shared_array(array_name + "_data"),
+                     load_shared_array(array_name + "_indices"),
+                     load_shared_array(array_name + "_indptr")),
+                    shape=tuple(matrix_shape),
+                    copy=False))
+
+        self.dict_list = None
+        self.index_new = load_shared_array('index_new')
+        self.read_plan = load_shared_array('read_plan')
+        self.weight_matrix = shared_matrices['weight'][0]
+        self.float32_weight_matrices = shared_matrices.get('float32')
+
+    def __getstate__(self):
+        """
+        Leaves the arrays of a shared weight table out of the pickled
+        tool (see :meth:`share_weight_table`).
+        """
+        state = self.__dict__.copy()
+        if state.get('shared_weight_table') is not None:
+            for attribute in ('dict_list', 'index_new', 'read_plan',
+                              'weight_matrix', 'float32_weight_matrices'):
+                state[attribute] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Memory maps the shared weight table of an unpickled tool.
+        """
+        self.__dict__.update(state)
+        if self.__dict__.get('shared_weight_table') is not None:
+            self._attach_shared_weight_table()
+
+    @staticmethod
+    def _get_weight_table_cache_files(in_weight_table):
+        """
+        Returns the paths to the compiled weight table cache files:
+        the memory mapped table and the metadata file.
+
+        .. note:: The CSV extension is dropped so the cache files do not
+                  match the weight table search patterns.
+        """
+        cache_base = "{0}_compiled".format(
+            os.path.splitext(in_weight_table)[0])
+        return cache_base + ".npy", cache_base + ".npz"
+
+    @staticmethod
+    def _get_weight_table_cache_key(in_weight_table):
+        """
+        Returns the values used to check that the cache matches
+        the weight table CSV file.
+        """
+        weight_table_stat = os.stat(in_weight_table)
+        return (os.path.abspath(in_weight_table),
+                float(weight_table_stat.st_mtime),
+                int(weight_table_stat.st_size))
+
+    def _load_weight_table_cache(self, in_weight_table):
+        """
+        Loads the compiled weight table cache if it is valid.
+
+        Returns
+        -------
+        bool:
+            True if the cache was loaded, otherwise False.
+        """
+        table_file, meta_file = \
+            self._get_weight_table_cache_files(in_weight_table)
+        if not (os.path.exists(table_file) and os.path.exists(meta_file)):
+            return False
+
+        try:
+            with np.load(meta_file) as cache_meta:
+                cache_key = (str(cache_meta['source_path']),
+                             float(cache_meta['source_mtime']),
+                             int(cache_meta['source_size']))
+                if int(cache_meta['version']) != WEIGHT_TABLE_CACHE_VERSION \
+                        or cache_key != \
+                        self._get_weight_table_cache_key(in_weight_table):
+                    print("Weight table cache out of date. Rebuilding ...")
+                    return False
+                stream_pointers = cache_meta['stream_pointers']
+                bounding_box = cache_meta['bounding_box']
+                read_plan = cache_meta['read_plan']
+                size_stream_id = int(cache_meta['size_stream_id'])
+
+            weight_table = np.load(table_file, mmap_mode='r')
+        except (IOError, OSError, KeyError, ValueError):
+            print("Invalid weight table cache. Rebuilding ...")
+            return False
+
+        if weight_table.dtype.names != tuple(self.header_wt) + \
+                ('index_new',):
+            print("Weight table cache has different columns. Rebuilding ...")
+            return False
+
+        print("Using compiled weight table: {0}".format(table_file))
+        self.dict_list = weight_table
+        self.count = weight_table.shape[0]
+        self.size_stream_id = size_stream_id
+        self.lat_slice = slice(bounding_box[0], bounding_box[1] + 1)
+        self.lon_slice = slice(bounding_box[2], bounding_box[3] + 1)
+        self.index_new = weight_table['index_new']
+        self.read_plan = read_plan
+        self._build_weight_matrix(stream_pointers)
+        return True
+
+    def _write_weight_table_cache(self, in_weight_table):
+        """
+        Writes the compiled weight table to the cache files.
+        The files are written to a temporary name and moved into
+        place so other processes never read a partial cache.
+        """
+        table_file, meta_file = \
+            self._get_weight_table_cache_files(in_weight_table)
+
+        weight_table = np.empty(
+            self.count,
+            dtype=self.dict_list.dtype.descr + [('index_new', 'i8')])
+        for column in self.header_wt:
+            weight_table[column] = self.dict_list[column]
+        weight_table['index_new'] = self.index_new
+
+        source_path, source_mtime, source_size = \
+            self._get_weight_table_cache_key(in_weight_table)
+        replace_file = getattr(os, 'replace', os.rename)
+        tmp_ending = ".{0}.tmp".format(os.getpid())
+        try:
+            with open(table_file + tmp_ending, 'wb') as table_out:
+                np.save(table_out, weight_table)
+            with open(meta_file + tmp_ending, 'wb') as meta_out:
+                np.savez(
+                    meta_out,
+                    version=WEIGHT_TABLE_CACHE_VERSION,
+                    source_path=source_path,
+                    source_mtime=source_mtime,
+                    source_size=source_size,
+                    size_stream_id=self.size_stream_id,
+                    stream_pointers=self.weight_matrix.indptr,
+                    bounding_box=np.array([self.lat_slice.start,
+                                           self.lat_slice.stop - 1,
+                                           self.lon_slice.start,
+                                           self.lon_slice.stop - 1]),
+                    read_plan=self.read_plan)
+            replace_file(table_file + tmp_ending, table_file)
+            replace_file(meta_file + tmp_ending, meta_file)
+        except (IOError, OSError) as ex:
+            print("WARNING: Unable to write weight table cache: {0}"
+                  .format(ex))
+            for tmp_file in (table_file + tmp_ending, meta_file + tmp_ending):
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    def _build_weight_matrix(self, stream_pointers):
+        """
+        Builds the sparse matrix (rows = rivids, columns = weight table
+        rows, values = area_sqm) from the first weight table row of
+        each stream.
+        """
+        num_rows = int(stream_pointers[-1])
+        self.weight_matrix = csr_matrix(
+            (np.asarray(self.dict_list[self.header_wt[1]][:num_rows],
+                        dtype=np.float64),
+             np.arange(num_rows),
+             stream_pointers),
+            shape=(self.size_stream_id, self.count))
+        self.float32_weight_matrices = None
+
+    def _get_stream_groups(self):
+        """
+        Groups the streams of the weight matrix by their number of grid
+        cells, so the runoff volume of the streams of a group is summed
+        with one numpy sum over the last axis. numpy sums each stream the
+        same way as the sum of the runoff volume of a single stream.
+
+        Returns
+        -------
+        list:
+            The (stream indices, weight table columns of each stream,
+            area_sqm of each column) of each group.
+        """
+        stream_pointers = self.weight_matrix.indptr
+        num_cells = np.diff(stream_pointers)
+        stream_group_list = []
+        for group_num_cells in np.unique(num_cells[num_cells > 0]):
+            stream_index_array = np.flatnonzero(num_cells == group_num_cells)
+            cell_pointers = stream_pointers[stream_index_array][:, None] + \
+                np.arange(group_num_cells)
+            stream_group_list.append(
+                (stream_index_array,
+                 self.weight_matrix.indices[cell_pointers],
+                 self.weight_matrix.data[cell_pointers]))
+        return stream_group_list
+
+    def _sum_runoff_volume(self, runoff, conversion_factor,
+                           stream_group_list):
+        """
+        Sums the runoff volume of the grid cells of each stream. The
+        runoff is multiplied by the area and the conversion factor of
+        each grid cell before the sum, so the inflow is the same as
+        the sum of the runoff volume of one stream at a time.
+
+        Parameters
+        ----------
+        runoff: :obj:`numpy.array`
+            The runoff with the shape (time, weight table column).
+        conversion_factor: float
+            The conversion factor or None to leave out.
+        stream_group_list: list
+            The streams grouped with :meth:`_get_stream_groups`.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The inflow with the shape (time, stream).
+        """
+        inflow_data = np.zeros((runoff.shape[0], self.size_stream_id))
+        for stream_index_array, cell_index_array, area_sqm_array in \
+                stream_group_list:
+            # C order so numpy sums the cells of each stream one after
+            # another like the sum of a single stream
+            runoff_volume = np.multiply(runoff[:, cell_index_array],
+                                        area_sqm_array, order='C')
+            if conversion_factor is not None:
+                runoff_volume *= conversion_factor
+            # filter nan
+            runoff_volume[np.isnan(runoff_volume)] = 0
+            inflow_data[:, stream_index_array] = runoff_volume.sum(axis=2)
+        # the streams without runoff are zero, not -0.0
+        inflow_data += 0.0
+        return inflow_data
+
+    def _get_float32_weight_matrices(self):
+        """
+        Splits the weight matrix into two float32 matrices. The first
+        sums blocks of at most FLOAT32_BLOCK_SIZE grid cells of a stream
+        and the second sums the blocks of each stream. This limits the
+        rounding error of streams with many grid cells.
+
+        Returns
+        -------
+        list:
+            The sparse matrices to multiply the runoff with in order.
+        """
+        if self.float32_weight_matrices is not None:
+            return self.float32_weight_matrices
+
+        stream_pointers = self.weight_matrix.indptr
+        num_cells = np.diff(stream_pointers)
+        num_blocks = -(-num_cells // FLOAT32_BLOCK_SIZE)
+        weight_data = self.weight_matrix.data.astype(np.float32)
+        if not num_blocks.size or num_blocks.max() <= 1:
+            self.float32_weight_matrices = [csr_matrix(
+                (weight_data, self.weight_matrix.indices, stream_pointers),
+                shape=self.weight_matrix.shape)]
+            return self.float32_weight_matrices
+
+        block_pointers = np.concatenate([[0], np.cumsum(num_blocks)])
+        block_stream = np.repeat(np.arange(num_blocks.size), num_blocks)
+        block_start = stream_pointers[block_stream] + \
+            (np.arange(block_stream.size) - block_pointers[block_stream]) * \
+            FLOAT32_BLOCK_SIZE
+        self.float32_weight_matrices = [
+            csr_matrix((weight_data, self.weight_matrix.indices,
+                        np.append(block_start, stream_pointers[-1])),
+                       shape=(block_stream.size, self.count)),
+            csr_matrix((np.ones(block_stream.size, dtype=np.float32),
+                        np.arange(block_stream.size),
+                        block_pointers),
+                       shape=(self.size_stream_id, block_stream.size)),
+        ]
+        return self.float32_weight_matrices
+
+    @staticmethod
+    def _compile_read_plan(lat_ind_all, lon_ind_all):
+        """
+        Chooses the rectangles of the runoff grid to read. The candidates
+        are the bounding box of all of the grid cells, one strip per
+        grid row and the bounding boxes of the clusters of cells
+        separated by gaps in longitude and then latitude. The plan
+        reading the fewest cells, counting READ_OVERHEAD_CELLS for
+        each rectangle, is used. This way, networks crossing the
+        dateline or spread over islands do not read the empty grid
+        cells between them.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The rectangles with the columns lat_start, lat_stop,
+            lon_start and lon_stop.
+        :obj:`numpy.array`:
+            The index of each grid cell in the runoff read from the
+            rectangles and flattened one after another.
+        """
+        label_list = [np.zeros(lat_ind_all.size, dtype=np.int64),
+                      np.unique(lat_ind_all, return_inverse=True)[1]]
+
+        lon_unique, lon_inverse = np.unique(lon_ind_all,
+                                            return_inverse=True)
+        lat_key_size = lat_ind_all.max() + 1
+        for max_gap in (1, 4, 16, 64):
+            lon_cluster = np.concatenate(
+                [[0], np.cumsum(np.diff(lon_unique) > max_gap)])[lon_inverse]
+            cluster_key = lon_cluster * lat_key_size + lat_ind_all
+            key_unique, key_inverse = np.unique(cluster_key,
+                                                return_inverse=True)
+            cluster_lon, cluster_lat = np.divmod(key_unique, lat_key_size)
+            cluster_break = (np.diff(cluster_lon) != 0) | \
+                (np.diff(cluster_lat) > max_gap)
+            label_list.append(np.concatenate(
+                [[0], np.cumsum(cluster_break)])[key_inverse])
+
+        read_plan = None
+        read_labels = None
+        read_cost = None
+        for labels in label_list:
+            num_rectangles = labels.max() + 1
+            lat_start = np.full(num_rectangles, lat_ind_all.max())
+            lat_stop = np.zeros(num_rectangles, dtype=np.int64)
+            lon_start = np.full(num_rectangles, lon_ind_all.max())
+            lon_stop = np.zeros(num_rectangles, dtype=np.int64)
+            np.minimum.at(lat_start, labels, lat_ind_all)
+            np.maximum.at(lat_stop, labels, lat_ind_all + 1)
+            np.minimum.at(lon_start, labels, lon_ind_all)
+            np.maximum.at(lon_stop, labels, lon_ind_all + 1)
+            plan_cost = np.sum((lat_stop - lat_start) *
+                               (lon_stop - lon_start)) + \
+                READ_OVERHEAD_CELLS * num_rectangles
+            if read_cost is None or plan_cost < read_cost:
+                read_cost = plan_cost
+                read_labels = labels
+                read_plan = np.column_stack([lat_start, lat_stop,
+                                             lon_start, lon_stop])
+
+        len_lon_subset = read_plan[:, 3] - read_plan[:, 2]
+        offsets = np.concatenate(
+            [[0], np.cumsum((read_plan[:, 1] - read_plan[:, 0]) *
+                            len_lon_subset)[:-1]])
+        index_new = offsets[read_labels] + \
+            (lat_ind_all - read_plan[read_labels, 0]) * \
+            len_lon_subset[read_labels] + \
+            (lon_ind_all - read_plan[read_labels, 2])
+        return read_plan, index_new
+
+    def _compile_weight_table(self):
+        """
+        Compile the weight table into the structures used to aggregate
+        runoff in :meth:`execute`:
+
+        * the lat/lon slices of the bounding box of the grid cells,
+        * the rectangles of the grid to read (see
+          :meth:`_compile_read_plan`),
+        * the flattened index of each weight table row in the runoff
+          read from those rectangles,
+        * a sparse matrix (rows = rivids, columns = weight table rows,
+          values = area_sqm) with the grid cells of each stream.
+        """
+        lon_ind_all = self.dict_list[self.header_wt[2]].astype(np.int64)
+        lat_ind_all = self.dict_list[self.header_wt[3]].astype(np.int64)
+
+        # Obtain a subset of  runoff data based on the indices in the
+        # weight table
+        min_lon_ind_all = lon_ind_all.min()
+        max_lon_ind_all = lon_ind_all.max()
+        min_lat_ind_all = lat_ind_all.min()
+        max_lat_ind_all = lat_ind_all.max()
+        self.lon_slice = slice(min_lon_ind_all, max_lon_ind_all + 1)
+        self.lat_slice = slice(min_lat_ind_all, max_lat_ind_all + 1)
+
+        # compute new indices based on the data subset
+        self.read_plan, self.index_new = \
+            self._compile_read_plan(lat_ind_all, lon_ind_all)
+
+        self._build_weight_matrix(self._validate_weight_table())
+
+    def _validate_weight_table(self):
+        """
+        Checks that the rows of each stream are next to each other and
+        that npoints of each row is the number of rows of its stream.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The index of the first weight table row of each stream
+            followed by the number of rows.
+
+        Raises
+        ------
+        WeightTableError:
+            If any rows are out of sequence. All of the bad rows
+            are reported.
+        """
+        rivid_all = np.asarray(self.dict_list[self.header_wt[0]])
+        npoints_all = np.asarray(self.dict_list[self.header_wt[4]])
+
+        stream_pointers = np.concatenate(
+            [[0], np.flatnonzero(np.diff(rivid_all)) + 1, [self.count]])
+        stream_num_rows = np.diff(stream_pointers)
+
+        # rows of a stream with npoints different from the number of rows
+        bad_row_mask = \
+            npoints_all != np.repeat(stream_num_rows, stream_num_rows)
+        # first rows of streams that already appeared in earlier rows
+        stream_rivids = rivid_all[stream_pointers[:-1]]
+        first_stream_index = np.unique(stream_rivids, return_index=True)[1]
+        repeated_stream_mask = np.ones(stream_rivids.size, dtype=bool)
+        repeated_stream_mask[first_stream_index] = False
+        bad_row_mask[stream_pointers[:-1][repeated_stream_mask]] = True
+
+        if bad_row_mask.any():
+            bad_rows = np.flatnonzero(bad_row_mask)
+            raise WeightTableError(self.error_messages[6],
+                                   bad_rows,
+                                   rivid_all[bad_rows])
+
+        return stream_pointers
+
     @staticmethod
     def _write_lat_lon(data_out_nc, rivid_lat_lon_z_file):
         """Add latitude and longitude each netCDF feature
@@ -105,54 +742,38 @@ class CreateInflowFileFromGriddedRunoff(object):
                     'names': ('rivid', 'lat', 'lon'),
                     'formats': ('i8', 'f8', 'f8'),
                 },
+                ndmin=1,
             )
 
-            # Get relevant arrays while we update them
             nc_rivids = data_out_nc.variables['rivid'][:]
-            lats = data_out_nc.variables['lat'][:]
-            lons = data_out_nc.variables['lon'][:]
-
-            lat_min = None
-            lat_max = None
-            lon_min = None
-            lon_max = None
 
-            # Process each row in the lookup table
-            for nc_index, nc_rivid in enumerate(nc_rivids):
-                try:
-                    lookup_index = \
-                        np.where(lookup_table['rivid'] == nc_rivid)[0][0]
-                except Exception:
-                    raise Exception('rivid {0} misssing in '
-                                    'comid_lat_lon_z file'.format(nc_rivid))
-
-                lat = float(lookup_table['lat'][lookup_index])
-                lats[nc_index] = lat
-                if lat_min is None or lat < lat_min:
-                    lat_min = lat
-                if lat_max is None or lat > lat_max:
-                    lat_max = lat
-
-                lon = float(lookup_table['lon'][lookup_index])
-                lons[nc_index] = lon
-                if lon_min is None or lon < lon_min:
-                    lon_min = lon
-                if lon_max is None or lon > lon_max:
-                    lon_max = lon
+            # join on the sorted lookup table rivids, the stable sort keeps
+            # the first row of each rivid first
+            sort_index = np.argsort(lookup_table['rivid'], kind='mergesort')
+            sorted_rivids = lookup_table['rivid'][sort_index]
+            sorted_index = np.searchsorted(sorted_rivids, nc_rivids)
+            sorted_index[sorted_index >= sorted_rivids.size] = 0
+            found = sorted_rivids[sorted_index] == nc_rivids \
+                if sorted_rivids.size else np.zeros(nc_rivids.size, bool)
+            if not found.all():
+                raise Exception('rivid(s) {0} misssing in '
+                                'comid_lat_lon_z file'
+                                .format(nc_rivids[~found].tolist()))
+
+            lookup_index = sort_index[sorted_index]
+            lats = lookup_table['lat'][lookup_index]
+            lons = lookup_table['lon'][lookup_index]
 
             # Overwrite netCDF variable values
             data_out_nc.variables['lat'][:] = lats
             data_out_nc.variables['lon'][:] = lons
 
             # Update metadata
-            if lat_min is not None:
-                data_out_nc.geospatial_lat_min = lat_min
-            if lat_max is not None:
-                data_out_nc.geospatial_lat_max = lat_max
-            if lon_min is not None:
-                data_out_nc.geospatial_lon_min = lon_min
-            if lon_max is not None:
-                data_out_nc.geospatial_lon_max = lon_max
+            if lats.size:
+                data_out_nc.geospatial_lat_min = lats.min()
+                data_out_nc.geospatial_lat_max = lats.max()
+                data_out_nc.geospatial_lon_min = lons.min()
+                data_out_nc.geospatial_lon_max = lons.max()
         else:
             print('No comid_lat_lon_z file. Not adding values ...')
 
@@ -164,30 +785,80 @@ class CreateInflowFileFromGriddedRunoff(object):
                                  in_rapid_connect_file,
                                  in_rivid_lat_lon_z_file,
                                  land_surface_model_description,
-                                 modeling_institution
+                                 modeling_institution,
+                                 file_format="NETCDF3_CLASSIC",
+                                 chunksizes=None,
+                                 zlib=False,
+                                 complevel=4,
+                                 shuffle=True,
+                                 unlimited_time=False
                                  ):
         """
         Generate inflow file for RAPID
+
+        Parameters
+        ----------
+        file_format: str, optional
+            The format of the inflow file. Use 'NETCDF4' or
+            'NETCDF4_CLASSIC' for files larger than the NETCDF3 limits
+            or to use chunking and compression. RAPID needs to be built
+            with netCDF-4 support to read them.
+            Default is 'NETCDF3_CLASSIC'.
+        chunksizes: tuple, optional
+            The (time, rivid) chunk shape of m3_riv in NETCDF4 files.
+            RAPID reads one time step of every river at a time, so
+            the chunks span all rivers by default with as many time
+            steps as fit in about 1 MB.
+        zlib: bool, optional
+            If True, m3_riv is compressed in NETCDF4 files.
+            Default is False.
+        complevel: int, optional
+            The zlib compression level from 1 to 9. Default is 4.
+        shuffle: bool, optional
+            If True, the HDF5 shuffle filter is used with compression.
+            Default is True.
+        unlimited_time: bool, optional
+            If True, the time dimension is unlimited so time steps can
+            be added later with :meth:`extend_inflow_time`.
+            Default is False.
         """
+        netcdf4_format = file_format.startswith("NETCDF4")
+        if not netcdf4_format and (zlib or chunksizes is not None):
+            raise ValueError("Chunking and compression require the "
+                             "NETCDF4 or NETCDF4_CLASSIC file_format.")
+
         self.simulation_time_step_seconds = simulation_time_step_seconds
 
         # Create output inflow netcdf data
         print("Generating inflow file ...")
-        data_out_nc = Dataset(out_nc, "w", format="NETCDF3_CLASSIC")
+        data_out_nc = Dataset(out_nc, "w", format=file_format)
         rivid_list = np.loadtxt(in_rapid_connect_file,
                                 delimiter=",",
                                 ndmin=1,
                                 usecols=(0,),
                                 dtype=int)
         # create dimensions
-        data_out_nc.createDimension('time', number_of_timesteps)
+        data_out_nc.createDimension(
+            'time', None if unlimited_time else number_of_timesteps)
         data_out_nc.createDimension('rivid', len(rivid_list))
         data_out_nc.createDimension('nv', 2)
         # create variables
         # m3_riv
+        m3_riv_options = {}
+        if netcdf4_format:
+            if chunksizes is None:
+                chunksizes = (
+                    max(1, min(number_of_timesteps,
+                               INFLOW_CHUNK_BYTES // (4 * len(rivid_list)))),
+                    len(rivid_list))
+            m3_riv_options = dict(chunksizes=chunksizes,
+                                  zlib=zlib,
+                                  complevel=complevel,
+                                  shuffle=shuffle)
         m3_riv_var = data_out_nc.createVariable('m3_riv', 'f4',
                                                 ('time', 'rivid'),
-                                                fill_value=0)
+                                                fill_value=0,
+                                                **m3_riv_options)
         m3_riv_var.long_name = 'accumulated external water volume ' \
                                'inflow upstream of each river reach'
         m3_riv_var.units = 'm3'
@@ -197,7 +868,7 @@ class CreateInflowFileFromGriddedRunoff(object):
         data_out_nc.close()
 
         try:
-            data_out_nc = Dataset(out_nc, "a", format="NETCDF3_CLASSIC")
+            data_out_nc = Dataset(out_nc, "a", format=file_format)
             # rivid
             rivid_var = data_out_nc.createVariable('rivid', 'i4',
                                                    ('rivid',))
@@ -276,10 +947,47 @@ class CreateInflowFileFromGriddedRunoff(object):
             print("File size too big to add data beforehand."
                   " Performing conversion after ...")
 
+    @staticmethod
+    def extend_inflow_time(out_nc, number_of_timesteps):
+        """
+        Adds time steps to the end of an inflow file created with
+        `unlimited_time` in :meth:`generateOutputInflowFile`. The
+        inflow of the new time steps is zero until it is written.
+
+        Parameters
+        ----------
+        out_nc: str
+            Path to the inflow file.
+        number_of_timesteps: int
+            The total number of time steps in the inflow file.
+        """
+        with NETCDF_LOCK, Dataset(out_nc, "a") as data_out_nc:
+            if not data_out_nc.dimensions['time'].isunlimited():
+                raise ValueError("The time dimension of {0} is not "
+                                 "unlimited.".format(out_nc))
+            time_var = data_out_nc.variables['time']
+            time_bnds_var = data_out_nc.variables['time_bnds']
+            old_number_of_timesteps = len(time_var)
+            if number_of_timesteps <= old_number_of_timesteps:
+                return
+
+            time_step = int(time_bnds_var[0, 1] - time_bnds_var[0, 0])
+            time_array = time_var[0] + time_step * np.arange(
+                old_number_of_timesteps, number_of_timesteps)
+            time_var[old_number_of_timesteps:] = time_array
+            time_bnds_var[old_number_of_timesteps:, :] = \
+                np.column_stack((time_array, time_array + time_step))
+
     def get_conversion_factor(self, in_nc, num_nc_files):
         """get conversion_factor"""
         data_in_nc = Dataset(in_nc)
+        try:
+            return self._get_conversion_factor(data_in_nc, num_nc_files)
+        finally:
+            data_in_nc.close()
 
+    def _get_conversion_factor(self, data_in_nc, num_nc_files):
+        """get conversion_factor from the opened netcdf dataset"""
         # convert from kg/m^2 (i.e. mm) to m
         conversion_factor = 0.001
 
@@ -299,212 +1007,988 @@ class CreateInflowFileFromGriddedRunoff(object):
             conversion_factor *= \
                 self.simulation_time_step_seconds / \
                 num_nc_files
-        data_in_nc.close()
 
         return conversion_factor
 
-    @abstractmethod
     def data_validation(self, in_nc):
         """Check the necessary dimensions and variables in the input
         netcdf data"""
-        pass
-
-    def execute(self, nc_file_list, index_list, in_weight_table,
-                out_nc, grid_type, mp_lock):
+        data_nc = Dataset(in_nc)
+        try:
+            self.dataset_validation(data_nc)
+        finally:
+            data_nc.close()
 
-        """The source code of the tool."""
-        if not os.path.exists(out_nc):
-            raise Exception("Outfile has not been created. "
-                            "You need to run: generateOutputInflowFile "
-                            "function ...")
+    @abstractmethod
+    def dataset_validation(self, data_nc):
+        """Check the necessary dimensions and variables in the opened
+        input netcdf data"""
+        pass
 
-        if len(nc_file_list) != len(index_list):
-            raise Exception("ERROR: Number of runoff files not equal to "
-                            "number of indices ...")
+    def read_runoff(self, in_nc, num_nc_files=None, use_masked_arrays=False):
+        """
+        Reads the runoff in the weight table cells from a runoff file.
+        The file is opened once to validate it and to read all of
+        the runoff variables in the rectangles of the grid that hold
+        the weight table cells.
+
+        Parameters
+        ----------
+        in_nc: str
+            Path to the runoff file.
+        num_nc_files: int, optional
+            Number of runoff files combined for each time step. If given,
+            the conversion factor is read from the file as well.
+        use_masked_arrays: bool, optional
+            See :meth:`execute`. Default is False.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The runoff with the shape (time, weight table row). Masked
+            and negative values are set to zero.
+        float:
+            The conversion factor or None if `num_nc_files` is not given.
+        """
+        runoff_iterator = self.iter_runoff(
+            in_nc, num_nc_files, use_masked_arrays=use_masked_arrays)
+        try:
+            _, _, data_subset_new, conversion_factor = next(runoff_iterator)
+        finally:
+            runoff_iterator.close()
+        return data_subset_new, conversion_factor
 
-        demo_file_list = nc_file_list[0]
-        if not isinstance(nc_file_list[0], list):
-            demo_file_list = [demo_file_list]
+    def iter_runoff(self, in_nc, num_nc_files=None, time_chunk_size=None,
+                    use_masked_arrays=False):
+        """
+        Reads the runoff like :meth:`read_runoff`, but runoff with
+        a time dimension is read `time_chunk_size` time steps at a time.
+        The file stays open until the last time chunk is read.
+
+        Parameters
+        ----------
+        in_nc: str
+            Path to the runoff file.
+        num_nc_files: int, optional
+            Number of runoff files combined for each time step. If given,
+            the conversion factor is read from the file as well.
+        time_chunk_size: int, optional
+            Number of time steps to read at a time. If None, all of the
+            time steps are read at once.
+        use_masked_arrays: bool, optional
+            See :meth:`execute`. Default is False.
+
+        Yields
+        ------
+        int:
+            Index of the first time step of the chunk in the file.
+        int:
+            Number of time steps in the file.
+        :obj:`numpy.array`:
+            The runoff with the shape (time, weight table row). Masked
+            and negative values are set to zero.
+        float:
+            The conversion factor or None if `num_nc_files` is not given.
+        """
+        conversion_factor = None
+        with NETCDF_LOCK:
+            data_in_nc = Dataset(in_nc)
+        try:
+            with NETCDF_LOCK:
+                self.dataset_validation(data_in_nc)
+                if num_nc_files is not None:
+                    conversion_factor = \
+                        self._get_conversion_factor(data_in_nc, num_nc_files)
+                runoff_var_list = [data_in_nc.variables[var_name]
+                                   for var_name in self.runoff_vars]
+                raw_runoff_reader = None
+                if not use_masked_arrays and \
+                        _RawRunoffReader.can_read(runoff_var_list):
+                    raw_runoff_reader = _RawRunoffReader(runoff_var_list)
+
+            runoff_dimension_size = len(runoff_var_list[0].dimensions)
+            len_time = 1
+            if runoff_dimension_size != 2:
+                len_time = runoff_var_list[0].shape[0]
+            if not time_chunk_size:
+                time_chunk_size = len_time
+
+            for time_start in xrange(0, len_time, time_chunk_size):
+                time_slice = None
+                if runoff_dimension_size != 2:
+                    time_slice = slice(time_start,
+                                       time_start + time_chunk_size)
+
+                if raw_runoff_reader is not None:
+                    data_subset_runoff = \
+                        raw_runoff_reader.read(self.read_plan, time_slice)
+                else:
+                    with NETCDF_LOCK:
+                        data_subset_runoff = \
+                            self._read_runoff_subset(runoff_var_list,
+                                                     time_slice)
+
+                yield (time_start, len_time,
+                       self._filter_runoff(
+                           data_subset_runoff,
+                           filter_nan=raw_runoff_reader is not None),
+                       conversion_factor)
+        finally:
+            with NETCDF_LOCK:
+                data_in_nc.close()
 
-        self.data_validation(demo_file_list[0])
-        self.read_in_weight_table(in_weight_table)
+    def _read_runoff_subset(self, runoff_var_list, time_slice=None):
+        """
+        Reads the sum of the runoff variables in each rectangle of the
+        read plan. Masked values are set to zero.
+
+        Returns
+        -------
+        :obj:`numpy.array`:
+            The runoff with the shape (time, grid cell) with the
+            flattened rectangles one after another.
+        """
+        runoff_list = []
+        for lat_start, lat_stop, lon_start, lon_stop in self.read_plan:
+            runoff_slice = (slice(lat_start, lat_stop),
+                            slice(lon_start, lon_stop))
+            if time_slice is not None:
+                runoff_slice = (time_slice,) + runoff_slice
+
+            # obtain subset of surface and subsurface runoff
+            data_subset_runoff = runoff_var_list[0][runoff_slice]
+            for runoff_var in runoff_var_list[1:]:
+                data_subset_runoff += runoff_var[runoff_slice]
+
+            # reshape the runoff to (time, grid cell)
+            len_time_subset = 1
+            if time_slice is not None:
+                len_time_subset = data_subset_runoff.shape[0]
+            # set masked values to zero
+            runoff_list.append(np.ma.filled(
+                data_subset_runoff.reshape(len_time_subset, -1), 0))
+
+        if len(runoff_list) == 1:
+            return runoff_list[0]
+        return np.concatenate(runoff_list, axis=1)
+
+    def _filter_runoff(self, data_subset_runoff, filter_nan=False):
+        """
+        Extracts the weight table cells from the runoff read with
+        :meth:`_read_runoff_subset` and sets negative values to zero.
+        If `filter_nan` is True, NaN values are set to zero in the
+        same pass.
+        """
+        # obtain a new subset of data
+        data_subset_new = data_subset_runoff[:, self.index_new]
 
-        conversion_factor = self.get_conversion_factor(demo_file_list[0],
-                                                       len(demo_file_list))
+        # FILTER DATA
+        # set negative values to zero
+        if filter_nan:
+            np.fmax(data_subset_new, 0, out=data_subset_new)
+        else:
+            data_subset_new[data_subset_new < 0] = 0
 
-        # get indices of subset of data
-        lon_ind_all = [int(i) for i in self.dict_list[self.header_wt[2]]]
-        lat_ind_all = [int(j) for j in self.dict_list[self.header_wt[3]]]
+        return data_subset_new
 
-        # Obtain a subset of  runoff data based on the indices in the
-        # weight table
-        min_lon_ind_all = min(lon_ind_all)
-        max_lon_ind_all = max(lon_ind_all)
-        min_lat_ind_all = min(lat_ind_all)
-        max_lat_ind_all = max(lat_ind_all)
-        lon_slice = slice(min_lon_ind_all, max_lon_ind_all + 1)
-        lat_slice = slice(min_lat_ind_all, max_lat_ind_all + 1)
-        index_new = []
-
-        # combine inflow data
+    def _iter_runoff_groups(self, nc_file_list, time_chunk_size,
+                            time_step_factor=1, use_masked_arrays=False):
+        """
+        Reads the runoff of each group of files in `nc_file_list` one
+        time chunk at a time and combines the files in the group.
+        The conversion factor is for `time_step_factor` runoff time steps
+        of each group in an inflow time step.
+
+        Yields
+        ------
+        int:
+            Index of the group in `nc_file_list`.
+        int:
+            Index of the first time step of the chunk in the files.
+        int:
+            Number of time steps in the files.
+        :obj:`numpy.array`:
+            The combined runoff with the shape (time, weight table row).
+        float:
+            The conversion factor or None after the first group.
+        """
         for nc_file_array_index, nc_file_array in enumerate(nc_file_list):
+            runoff_iterator_list = []
+            for nc_file in nc_file_array:
+                num_nc_files = None
+                if nc_file_array_index == 0 and not runoff_iterator_list:
+                    num_nc_files = len(nc_file_array) * time_step_factor
+                runoff_iterator_list.append(
+                    self.iter_runoff(nc_file, num_nc_files, time_chunk_size,
+                                     use_masked_arrays))
+            try:
+                while True:
+                    try:
+                        runoff_chunk_list = [next(runoff_iterator)
+                                             for runoff_iterator
+                                             in runoff_iterator_list]
+                    except StopIteration:
+                        break
+
+                    time_start, len_time, data_subset_all, \
+                        conversion_factor = runoff_chunk_list[0]
+                    # combine data (the filtered runoff is a copy)
+                    for _, _, data_subset_new, _ in runoff_chunk_list[1:]:
+                        data_subset_all += data_subset_new
+
+                    yield (nc_file_array_index, time_start, len_time,
+                           data_subset_all, conversion_factor)
+            finally:
+                for runoff_iterator in runoff_iterator_list:
+                    runoff_iterator.close()
+
+    def get_time_chunk_size(self, memory_budget, num_nc_files=1,
+                            prefetch_depth=0, use_float32=False):
+        """
+        Estimates the number of time steps of runoff that can be
+        converted at a time within `memory_budget` bytes. The weight
+        table needs to be read in first.
+
+        Parameters
+        ----------
+        memory_budget: int
+            Memory in bytes for the runoff and inflow being converted.
+        num_nc_files: int, optional
+            Number of runoff files combined for each time step.
+            Default is 1.
+        prefetch_depth: int, optional
+            Number of time chunks read ahead. Default is 0.
+        use_float32: bool, optional
+            If True, the inflow is computed in float32. Default is False.
+
+        Returns
+        -------
+        int:
+            Number of time steps to convert at a time (at least 1).
+        """
+        len_read_subset = np.sum(
+            (self.read_plan[:, 1] - self.read_plan[:, 0]) *
+            (self.read_plan[:, 3] - self.read_plan[:, 2]))
+        # each runoff file is read into a masked array, summed and
+        # filtered and each inflow time step is stored as float64
+        # or float32
+        itemsize = 4 if use_float32 else 8
+        time_step_bytes = \
+            num_nc_files * (3 * 4 * len_read_subset +
+                            itemsize * self.count) + \
+            2 * itemsize * self.size_stream_id
+        # chunks read ahead, the chunk being converted and the one
+        # being read
+        num_chunks = prefetch_depth + 2
+        return max(1, int(memory_budget // (num_chunks * time_step_bytes)))
+
+    def _generate_inflow(self, nc_file_list, index_list, in_weight_table,
+                         grid_type, use_weight_table_cache=True,
+                         prefetch_depth=2, memory_budget=None,
+                         use_float32=False, time_step_factor=1,
+                         use_masked_arrays=False):
+        """
+        Generates the inflow for each entry in `nc_file_list`.
+        See :meth:`execute` for the parameters.
+
+        Yields
+        ------
+        int:
+            Index of the first time step of the inflow in the inflow file.
+        :obj:`numpy.array`:
+            The inflow with the shape (time, rivid).
+        """
+        if len(nc_file_list) != len(index_list):
+            raise Exception("ERROR: Number of runoff files not equal to "
+                            "number of indices ...")
+        if int(time_step_factor) != time_step_factor or \
+                time_step_factor < 1:
+            raise ValueError("Invalid time_step_factor: {0}. Must be a "
+                             "positive integer.".format(time_step_factor))
+
+        if self.shared_weight_table is not None and \
+                self.shared_weight_table['source'] == in_weight_table:
+            # the weight table was read in by share_weight_table
+            pass
+        elif isinstance(in_weight_table, list):
+            self.read_in_weight_tables(in_weight_table,
+                                       use_cache=use_weight_table_cache)
+        else:
+            self.read_in_weight_table(in_weight_table,
+                                      use_cache=use_weight_table_cache)
+
+        nc_file_list = [nc_file_array if isinstance(nc_file_array, list)
+                        else [nc_file_array]
+                        for nc_file_array in nc_file_list]
+
+        # the cumulative t255 runoff is converted a whole file at a time
+        time_chunk_size = None
+        if memory_budget is not None and grid_type != 't255':
+            time_chunk_size = self.get_time_chunk_size(
+                memory_budget,
+                max(len(nc_file_array) for nc_file_array in nc_file_list),
+                prefetch_depth,
+                use_float32)
+
+        # read the runoff files ahead while the inflow is computed
+        runoff_iterator = prefetch_iterator(
+            self._iter_runoff_groups(nc_file_list, time_chunk_size,
+                                     int(time_step_factor),
+                                     use_masked_arrays),
+            prefetch_depth)
+        try:
+            for inflow in self._aggregate_inflow(index_list,
+                                                 runoff_iterator, grid_type,
+                                                 use_float32,
+                                                 int(time_step_factor),
+                                                 use_masked_arrays):
+                yield inflow
+        finally:
+            runoff_iterator.close()
+
+    def _aggregate_inflow(self, index_list, runoff_iterator, grid_type,
+                          use_float32=False, time_step_factor=1,
+                          use_masked_arrays=False):
+        """
+        Converts the runoff from :meth:`_iter_runoff_groups` to inflow.
+        """
+        conversion_factor = None
+        if use_float32:
+            weight_matrix_list = self._get_float32_weight_matrices()
+        else:
+            stream_group_list = self._get_stream_groups()
+        runoff_resampler = None
+        if time_step_factor > 1:
+            runoff_resampler = _RunoffResampler(time_step_factor)
+        # NaN is already set to zero in the runoff read without masked
+        # arrays, but the cumulative t255 runoff and the sums of time
+        # steps can have NaN again (Ex. inf - inf)
+        filter_nan = use_float32 and (use_masked_arrays or
+                                      grid_type == 't255' or
+                                      runoff_resampler is not None)
+
+        for nc_file_array_index, time_start, len_time, data_subset_all, \
+                file_conversion_factor in runoff_iterator:
+            if file_conversion_factor is not None:
+                conversion_factor = file_conversion_factor
 
             index = index_list[nc_file_array_index]
 
-            if not isinstance(nc_file_array, list):
-                nc_file_array = [nc_file_array]
-
-            data_subset_all = None
-            for nc_file in nc_file_array:
-                # Validate the netcdf dataset
-                self.data_validation(nc_file)
+            # assume data is incremental
+            if grid_type == 't255':
+                # A) ERA Interim Low Res (T255) - data is cumulative
+                # from time 3/6/9/12
+                # (time zero not included, so assumed to be zero)
+                ro_first_half = \
+                    np.concatenate([data_subset_all[0:1, ],
+                                    np.subtract(data_subset_all[1:4, ],
+                                                data_subset_all[0:3, ])])
+                # from time 15/18/21/24
+                # (time restarts at time 12, assumed to be zero)
+                ro_second_half = \
+                    np.concatenate([data_subset_all[4:5, ],
+                                    np.subtract(data_subset_all[5:, ],
+                                                data_subset_all[4:7, ])])
+                data_subset_all = \
+                    np.concatenate([ro_first_half, ro_second_half])
+
+            time_index = index * len_time + time_start
+            if runoff_resampler is not None:
+                resampled_runoff = runoff_resampler.add(time_index,
+                                                        data_subset_all)
+                if resampled_runoff is None:
+                    continue
+                time_index, data_subset_all = resampled_runoff
+
+            # the cumulative t255 runoff is not converted
+            runoff_conversion_factor = None
+            if grid_type != 't255':
+                runoff_conversion_factor = conversion_factor
+
+            if not use_float32:
+                yield time_index, \
+                    self._sum_runoff_volume(data_subset_all,
+                                            runoff_conversion_factor,
+                                            stream_group_list)
+                continue
+
+            data_subset_all = data_subset_all.astype(np.float32, copy=False)
+
+            # filter nan
+            if filter_nan:
+                data_subset_all[np.isnan(data_subset_all)] = 0
+
+            # sum the runoff volume of every stream at once
+            inflow_data = data_subset_all.T
+            for weight_matrix in weight_matrix_list:
+                inflow_data = weight_matrix.dot(inflow_data)
+            inflow_data = inflow_data.T
+            if runoff_conversion_factor is not None:
+                inflow_data *= runoff_conversion_factor
+
+            yield time_index, inflow_data
+
+        if runoff_resampler is not None:
+            runoff_resampler.finish()
 
-                # Read the netcdf dataset
-                data_in_nc = Dataset(nc_file)
+    @staticmethod
+    def _write_inflow_files(out_nc_list, inflow_iterator):
+        """
+        Writes the (time_index, inflow_data) slabs from `inflow_iterator`
+        to the inflow files. The inflow has the rivids of each file
+        one after another.
+        """
+        data_out_nc_list = []
+        try:
+            with NETCDF_LOCK:
+                for out_nc in out_nc_list:
+                    data_out_nc_list.append(Dataset(out_nc, "a"))
+            writer_list = [_InflowWriter(data_out_nc)
+                           for data_out_nc in data_out_nc_list]
+            rivid_stops = np.cumsum([writer.num_rivids
+                                     for writer in writer_list])
+
+            for time_index, inflow_data in inflow_iterator:
+                if inflow_data.shape[1] != rivid_stops[-1]:
+                    raise Exception("ERROR: Number of rivids in the inflow "
+                                    "file(s) not equal to number of rivids "
+                                    "in the weight table(s) ...")
+                rivid_start = 0
+                for writer, rivid_stop in zip(writer_list, rivid_stops):
+                    writer.write(time_index,
+                                 inflow_data[:, rivid_start:rivid_stop])
+                    rivid_start = rivid_stop
+
+            for writer in writer_list:
+                writer.flush()
+        finally:
+            with NETCDF_LOCK:
+                for data_out_nc in data_out_nc_list:
+                    data_out_nc.close()
 
-                # Calculate water inflows
-                runoff_dimension_size = \
-                    len(data_in_nc.variables[self.runoff_vars[0]].dimensions)
-                if runoff_dimension_size == 2:
-                    # obtain subset of surface and subsurface runoff
-                    data_subset_runoff = \
-                        data_in_nc.variables[self.runoff_vars[0]][
-                            lat_slice, lon_slice]
-                    for var_name in self.runoff_vars[1:]:
-                        data_subset_runoff += \
-                            data_in_nc.variables[var_name][
-                                lat_slice, lon_slice]
-
-                    # get runoff dims
-                    len_time_subset = 1
-                    len_lat_subset = data_subset_runoff.shape[0]
-                    len_lon_subset = data_subset_runoff.shape[1]
-
-                    # reshape the runoff
-                    data_subset_runoff = data_subset_runoff.reshape(
-                        len_lat_subset * len_lon_subset)
-
-                elif runoff_dimension_size == 3:
-                    # obtain subset of surface and subsurface runoff
-                    data_subset_runoff = \
-                        data_in_nc.variables[self.runoff_vars[0]][
-                            :, lat_slice, lon_slice]
-                    for var_name in self.runoff_vars[1:]:
-                        data_subset_runoff += \
-                            data_in_nc.variables[var_name][
-                                :, lat_slice, lon_slice]
-
-                    # get runoff dims
-                    len_time_subset = data_subset_runoff.shape[0]
-                    len_lat_subset = data_subset_runoff.shape[1]
-                    len_lon_subset = data_subset_runoff.shape[2]
-                    # reshape the runoff
-                    data_subset_runoff = \
-                        data_subset_runoff.reshape(
-                            len_time_subset,
-                            (len_lat_subset * len_lon_subset))
+    def execute(self, nc_file_list, index_list, in_weight_table,
+                out_nc, grid_type, mp_lock,
+                use_weight_table_cache=True, prefetch_depth=2,
+                memory_budget=None, use_float32=False,
+                time_step_factor=1, use_masked_arrays=False):
+        """The source code of the tool.
+
+        Parameters
+        ----------
+        nc_file_list: list
+            List of LSM runoff files (or lists of files to combine).
+        index_list: list
+            Time index in the inflow file of each entry in `nc_file_list`.
+        in_weight_table: str or list
+            Path to the weight table CSV file. If a list of weight tables
+            of watersheds on the same grid is given, each runoff file is
+            read once for all of them (see :meth:`read_in_weight_tables`).
+        out_nc: str or list
+            Path to the inflow file created with
+            :meth:`generateOutputInflowFile`. A list with the inflow file
+            of each weight table if `in_weight_table` is a list.
+        grid_type: str
+            The LSM grid type (Ex. 't255').
+        mp_lock: :obj:`multiprocessing.Lock`
+            Lock held while writing to the inflow file. If None, the
+            inflow file is kept open and written in whole chunks.
+        use_weight_table_cache: bool, optional
+            Use the compiled weight table cache.
+            See :meth:`read_in_weight_table`. Default is True.
+        prefetch_depth: int, optional
+            Number of runoff files read in the background ahead of the
+            file being converted. Each file read ahead is held in memory.
+            If 0, the files are read one at a time. Default is 2.
+        memory_budget: int, optional
+            Approximate memory in bytes for the runoff and inflow being
+            converted. If given, runoff with a time dimension is read and
+            written a few time steps at a time to stay within the budget
+            (see :meth:`get_time_chunk_size`). The cumulative t255 runoff
+            is always converted a whole file at a time. If None, each
+            file is converted at once. Default is None.
+        use_float32: bool, optional
+            If True, the runoff, weights and inflow are float32 instead of
+            float64, which halves the memory used. m3_riv is float32,
+            so the float64 result is rounded with a relative error of
+            at most 2**-24. The runoff and weights are not negative, so
+            the float32 sums of a stream with n grid cells add a relative
+            error of at most about (64 + n / 64 + 3) * 2**-24 (1e-5
+            for n = 10,000), as the cells are summed in blocks of 64.
+            Default is False.
+        time_step_factor: int, optional
+            Number of consecutive runoff time steps summed into each
+            inflow time step (Ex. 3 for 1 hourly runoff and 3 hourly
+            inflow or 8 for 3 hourly runoff and daily inflow). The entries
+            of `index_list` are then the time index of the runoff files
+            before resampling and an inflow time step can span several
+            runoff files. The runoff is summed in place as it is read, so
+            the runoff files are not grouped. Each inflow time step needs
+            all of its runoff time steps. Default is 1.
+        use_masked_arrays: bool, optional
+            If True, the runoff is read as masked arrays by netCDF4.
+            Otherwise, the automatic masking and scaling of netCDF4 is
+            turned off and the fill value, missing values, valid range,
+            scale factor and offset of the runoff variables are applied
+            to the raw runoff in place. The negative and NaN runoff is
+            then set to zero in one pass. Byte and unsigned runoff
+            variables are always read as masked arrays. Default is False.
+        """
+        out_nc_list = out_nc if isinstance(out_nc, list) else [out_nc]
+        for out_file in out_nc_list:
+            if not os.path.exists(out_file):
+                raise Exception("Outfile has not been created. "
+                                "You need to run: generateOutputInflowFile "
+                                "function ...")
+
+        inflow_iterator = \
+            self._generate_inflow(nc_file_list, index_list,
+                                  in_weight_table, grid_type,
+                                  use_weight_table_cache,
+                                  prefetch_depth,
+                                  memory_budget,
+                                  use_float32,
+                                  time_step_factor,
+                                  use_masked_arrays)
+
+        if mp_lock is None:
+            self._write_inflow_files(out_nc_list, inflow_iterator)
+            return
+
+        for time_index, inflow_data in inflow_iterator:
+            # only one process is allowed to write at a time to netcdf file
+            mp_lock.acquire()
+            try:
+                self._write_inflow_files(out_nc_list,
+                                         [(time_index, inflow_data)])
+            finally:
+                mp_lock.release()
+
+    def execute_to_slabs(self, nc_file_list, index_list, in_weight_table,
+                         slab_directory, grid_type,
+                         use_weight_table_cache=True, prefetch_depth=2,
+                         memory_budget=None, use_float32=False,
+                         time_step_factor=1, use_masked_arrays=False):
+        """
+        Generates the inflow like :meth:`execute`, but each time slab
+        is saved to a file in `slab_directory` instead of being written
+        to the inflow file. This way, workers never wait on each other
+        and a single process writes the slabs with
+        :meth:`write_inflow_slabs`.
+
+        Parameters
+        ----------
+        slab_directory: str
+            Path to the directory to store the time slabs in.
+
+        See :meth:`execute` for the other parameters.
+
+        Returns
+        -------
+        list:
+            A list of tuples with the index of the first time step of
+            the slab in the inflow file and the path to the slab file.
+        """
+        slab_list = []
+        for time_index, inflow_data in \
+                self._generate_inflow(nc_file_list, index_list,
+                                      in_weight_table, grid_type,
+                                      use_weight_table_cache,
+                                      prefetch_depth,
+                                      memory_budget,
+                                      use_float32,
+                                      time_step_factor,
+                                      use_masked_arrays):
+            slab_file = os.path.join(slab_directory,
+                                     "m3_riv_{0:010d}.npy".format(time_index))
+            np.save(slab_file, inflow_data)
+            slab_list.append((time_index, slab_file))
+        return slab_list
+
+    @classmethod
+    def write_inflow_slabs(cls, out_nc, slab_list):
+        """
+        Writes the time slabs from :meth:`execute_to_slabs` to the
+        inflow file in time order and removes the slab files.
+
+        Parameters
+        ----------
+        out_nc: str or list
+            Path to the inflow file created with
+            :meth:`generateOutputInflowFile` or a list of inflow files
+            (see :meth:`execute`).
+        slab_list: list
+            The list returned by :meth:`execute_to_slabs`.
+        """
+        out_nc_list = out_nc if isinstance(out_nc, list) else [out_nc]
+        slab_list = sorted(slab_list)
+        cls._write_inflow_files(
+            out_nc_list,
+            ((time_index, np.load(slab_file))
+             for time_index, slab_file in slab_list))
+        for _, slab_file in slab_list:
+            os.remove(slab_file)
 
-                data_in_nc.close()
 
-                if not index_new:
-                    # compute new indices based on the data_subset_surface
-                    for r in range(0, self.count):
-                        ind_lat_orig = lat_ind_all[r]
-                        ind_lon_orig = lon_ind_all[r]
-                        index_new.append(
-                            (ind_lat_orig - min_lat_ind_all) * len_lon_subset
-                            + (ind_lon_orig - min_lon_ind_all))
-
-                # obtain a new subset of data
-                if runoff_dimension_size == 2:
-                    data_subset_new = data_subset_runoff[index_new]
-                elif runoff_dimension_size == 3:
-                    data_subset_new = data_subset_runoff[:, index_new]
-
-                # FILTER DATA
-                try:
-                    # set masked values to zero
-                    data_subset_new = data_subset_new.filled(fill_value=0)
-                except AttributeError:
-                    pass
-                # set negative values to zero
-                data_subset_new[data_subset_new < 0] = 0
+class _InflowWriter(object):
+    """
+    Writes time slabs of inflow to m3_riv in an open inflow file.
+    Consecutive slabs are combined until they end on a chunk boundary
+    of m3_riv, so chunked files are written a whole chunk at a time.
+    """
+    def __init__(self, data_out_nc):
+        self.m3_riv_var = data_out_nc.variables['m3_riv']
+        self.num_rivids = self.m3_riv_var.shape[1]
+        chunking = self.m3_riv_var.chunking()
+        self.chunk_time_size = 1
+        if chunking and chunking != 'contiguous':
+            self.chunk_time_size = chunking[0]
+
+        self.buffer_time_index = 0
+        self.buffer_list = []
+        self.buffer_size = 0
+
+    def write(self, time_index, inflow_data):
+        """
+        Adds the inflow slab starting at `time_index`.
+        """
+        if self.buffer_list and \
+                time_index != self.buffer_time_index + self.buffer_size:
+            self.flush()
 
-                # combine data
-                if data_subset_all is None:
-                    data_subset_all = data_subset_new
-                else:
-                    data_subset_all = np.add(data_subset_all, data_subset_new)
+        if not self.buffer_list:
+            self.buffer_time_index = time_index
+            self.buffer_size = 0
+        self.buffer_list.append(inflow_data)
+        self.buffer_size += inflow_data.shape[0]
 
-            if runoff_dimension_size == 3 and len_time_subset > 1:
-                inflow_data = np.zeros((len_time_subset, self.size_stream_id))
-            else:
-                inflow_data = np.zeros(self.size_stream_id)
-
-            pointer = 0
-            for stream_index in xrange(self.size_stream_id):
-                npoints = int(self.dict_list[self.header_wt[4]][pointer])
-                # Check if all npoints points correspond to the same streamID
-                if len(set(self.dict_list[self.header_wt[0]][
-                           pointer: (pointer + npoints)])) != 1:
-                    print("ROW INDEX {0}".format(pointer))
-                    print("COMID {0}".format(
-                        self.dict_list[self.header_wt[0]][pointer]))
-                    raise Exception(self.error_messages[2])
-
-                area_sqm_npoints = \
-                    np.array([float(k) for k in
-                              self.dict_list[self.header_wt[1]][
-                              pointer: (pointer + npoints)]])
-
-                # assume data is incremental
-                if runoff_dimension_size == 3:
-                    data_goal = data_subset_all[:, pointer:(pointer + npoints)]
-                else:
-                    data_goal = data_subset_all[pointer:(pointer + npoints)]
-
-                if grid_type == 't255':
-                    # A) ERA Interim Low Res (T255) - data is cumulative
-                    # from time 3/6/9/12
-                    # (time zero not included, so assumed to be zero)
-                    ro_first_half = \
-                        np.concatenate([data_goal[0:1, ],
-                                        np.subtract(data_goal[1:4, ],
-                                                    data_goal[0:3, ])])
-                    # from time 15/18/21/24
-                    # (time restarts at time 12, assumed to be zero)
-                    ro_second_half = \
-                        np.concatenate([data_goal[4:5, ],
-                                        np.subtract(data_goal[5:, ],
-                                                    data_goal[4:7, ])])
-                    ro_stream = \
-                        np.multiply(
-                            np.concatenate([ro_first_half, ro_second_half]),
-                            area_sqm_npoints)
+        if (self.buffer_time_index + self.buffer_size) % \
+                self.chunk_time_size == 0:
+            self.flush()
 
-                else:
-                    ro_stream = data_goal * area_sqm_npoints * \
-                                conversion_factor
+    def flush(self):
+        """
+        Writes the inflow slabs added since the last write.
+        """
+        if not self.buffer_list:
+            return
+        with NETCDF_LOCK:
+            self.m3_riv_var[
+                self.buffer_time_index:
+                self.buffer_time_index + self.buffer_size, :] = \
+                self.buffer_list[0] if len(self.buffer_list) == 1 \
+                else np.concatenate(self.buffer_list)
+        self.buffer_list = []
+
+
+class _RawRunoffReader(object):
+    """
+    Reads the sum of the runoff variables like netCDF4 with automatic
+    masking and scaling, but without masked arrays. The raw runoff is
+    read and the fill value, missing values, valid range, scale factor
+    and offset of each variable are applied in place, so the runoff is
+    only copied to combine the rectangles of the read plan. Only the
+    reads hold the netCDF lock.
+    """
+    def __init__(self, runoff_var_list):
+        self.runoff_var_list = runoff_var_list
+        self.var_attributes = []
+        for runoff_var in runoff_var_list:
+            runoff_var.set_auto_maskandscale(False)
+            self.var_attributes.append(self._get_var_attributes(runoff_var))
+        self.buffers = {}
 
-                # filter nan
-                ro_stream[np.isnan(ro_stream)] = 0
+    @staticmethod
+    def can_read(runoff_var_list):
+        """
+        Checks that none of the runoff variables are byte or unsigned
+        variables, which netCDF4 masks and converts differently.
+        """
+        for runoff_var in runoff_var_list:
+            if runoff_var.dtype.kind not in 'if' or \
+                    runoff_var.dtype.itemsize < 2 or \
+                    '_Unsigned' in runoff_var.ncattrs():
+                return False
+        return True
 
-                if ro_stream.any():
-                    if runoff_dimension_size == 3 and len_time_subset > 1:
-                        inflow_data[:, stream_index] = ro_stream.sum(axis=1)
-                    else:
-                        inflow_data[stream_index] = ro_stream.sum()
+    @staticmethod
+    def _get_var_attributes(runoff_var):
+        """
+        Returns the invalid values, valid range, scale factor and
+        offset of the variable as netCDF4 uses them.
+        """
+        ncattrs = runoff_var.ncattrs()
+        dtype = runoff_var.dtype
+        # the fill value (or the default fill value) and missing values
+        if '_FillValue' in ncattrs:
+            invalid_values = [runoff_var.getncattr('_FillValue')]
+        else:
+            invalid_values = [default_fillvals[dtype.str[1:]]]
+        if 'missing_value' in ncattrs:
+            invalid_values.extend(
+                np.ravel(runoff_var.getncattr('missing_value')))
+
+        valid_min = None
+        valid_max = None
+        if 'valid_range' in ncattrs:
+            valid_min, valid_max = \
+                np.array(runoff_var.getncattr('valid_range'), dtype)[:2]
+        else:
+            if 'valid_min' in ncattrs:
+                valid_min = np.array(runoff_var.getncattr('valid_min'),
+                                     dtype)
+            if 'valid_max' in ncattrs:
+                valid_max = np.array(runoff_var.getncattr('valid_max'),
+                                     dtype)
+
+        scale_factor = None
+        add_offset = None
+        if 'scale_factor' in ncattrs:
+            scale_factor = runoff_var.getncattr('scale_factor')
+        if 'add_offset' in ncattrs:
+            add_offset = runoff_var.getncattr('add_offset')
+
+        return {
+            'invalid_values': np.array(invalid_values, dtype),
+            'valid_min': valid_min,
+            'valid_max': valid_max,
+            'scale_factor': scale_factor,
+            'add_offset': add_offset,
+        }
+
+    def _get_buffer(self, name, shape, dtype):
+        """
+        Returns a buffer that is reused for each read with the same shape
+        (Ex. for each rectangle of the read plan).
+        """
+        buffer_key = (name, shape, np.dtype(dtype).str)
+        buffer_array = self.buffers.get(buffer_key)
+        if buffer_array is None:
+            buffer_array = np.empty(shape, dtype=dtype)
+            self.buffers[buffer_key] = buffer_array
+        return buffer_array
+
+    def _find_invalid(self, raw_runoff, var_attributes, invalid):
+        """
+        Sets `invalid` to True where the raw runoff is not valid.
+        """
+        for invalid_index, invalid_value in \
+                enumerate(var_attributes['invalid_values']):
+            if invalid_index == 0:
+                invalid_out = invalid
+            else:
+                invalid_out = self._get_buffer('invalid_value',
+                                               invalid.shape, bool)
+            if np.isnan(invalid_value):
+                np.isnan(raw_runoff, out=invalid_out)
+            else:
+                np.equal(raw_runoff, invalid_value, out=invalid_out)
+            if invalid_index > 0:
+                invalid |= invalid_out
+        if var_attributes['valid_min'] is not None:
+            invalid |= raw_runoff < var_attributes['valid_min']
+        if var_attributes['valid_max'] is not None:
+            invalid |= raw_runoff > var_attributes['valid_max']
 
-                pointer += npoints
+    @staticmethod
+    def _scale(raw_runoff, var_attributes):
+        """
+        Applies the scale factor and offset like netCDF4.
+        """
+        scale_factor = var_attributes['scale_factor']
+        add_offset = var_attributes['add_offset']
+        if scale_factor is not None and add_offset is not None:
+            if add_offset != 0.0 or scale_factor != 1.0:
+                runoff = raw_runoff * scale_factor
+                if np.result_type(runoff, add_offset) == runoff.dtype:
+                    runoff += add_offset
+                    return runoff
+                return runoff + add_offset
+            return raw_runoff.astype(np.asarray(scale_factor).dtype)
+        if scale_factor is not None and scale_factor != 1.0:
+            return raw_runoff * scale_factor
+        if add_offset is not None and add_offset != 0.0:
+            return raw_runoff + add_offset
+        return raw_runoff
+
+    def _read_rectangle(self, runoff_slice, time_slice=None):
+        """
+        Reads the sum of the runoff variables in a rectangle of the
+        grid with the shape (time, grid cell). Invalid values are set
+        to zero.
+        """
+        runoff = None
+        invalid = None
+        for runoff_var, var_attributes in zip(self.runoff_var_list,
+                                              self.var_attributes):
+            with NETCDF_LOCK:
+                raw_runoff = runoff_var[runoff_slice]
+            # reshape the runoff to (time, grid cell)
+            len_time_subset = 1
+            if time_slice is not None:
+                len_time_subset = raw_runoff.shape[0]
+            raw_runoff = raw_runoff.reshape(len_time_subset, -1)
+
+            if invalid is None:
+                invalid = self._get_buffer('invalid', raw_runoff.shape, bool)
+                self._find_invalid(raw_runoff, var_attributes, invalid)
+            else:
+                var_invalid = self._get_buffer('var_invalid',
+                                               raw_runoff.shape, bool)
+                self._find_invalid(raw_runoff, var_attributes, var_invalid)
+                invalid |= var_invalid
 
-            # only one process is allowed to write at a time to netcdf file
-            mp_lock.acquire()
-            data_out_nc = Dataset(out_nc, "a", format="NETCDF3_CLASSIC")
-            if runoff_dimension_size == 3 and len_time_subset > 1:
-                data_out_nc.variables['m3_riv'][
-                    index*len_time_subset:(index+1)*len_time_subset, :] = \
-                    inflow_data
+            if runoff is None:
+                runoff = self._scale(raw_runoff, var_attributes)
             else:
-                data_out_nc.variables['m3_riv'][index] = inflow_data
-            data_out_nc.close()
-            mp_lock.release()
+                runoff += self._scale(raw_runoff, var_attributes)
+
+        np.copyto(runoff, 0, where=invalid)
+        return runoff
+
+    def read(self, read_plan, time_slice=None):
+        """
+        Reads the runoff in the rectangles of the read plan like
+        :meth:`CreateInflowFileFromGriddedRunoff._read_runoff_subset`.
+        """
+        runoff_list = []
+        for lat_start, lat_stop, lon_start, lon_stop in read_plan:
+            runoff_slice = (slice(lat_start, lat_stop),
+                            slice(lon_start, lon_stop))
+            if time_slice is not None:
+                runoff_slice = (time_slice,) + runoff_slice
+            runoff_list.append(self._read_rectangle(runoff_slice,
+                                                    time_slice))
+
+        if len(runoff_list) == 1:
+            return runoff_list[0]
+        # combine the rectangles in a buffer that is reused
+        runoff = self._get_buffer(
+            'runoff',
+            (runoff_list[0].shape[0],
+             sum(rectangle_runoff.shape[1]
+                 for rectangle_runoff in runoff_list)),
+            runoff_list[0].dtype)
+        return np.concatenate(runoff_list, axis=1, out=runoff)
+
+
+class _RunoffResampler(object):
+    """
+    Sums every `time_step_factor` consecutive runoff time steps into
+    one inflow time step as the runoff is read. The sums are made in
+    place in buffers that are reused, and an inflow time step that is
+    not complete at the end of the runoff is carried over to the next
+    runoff.
+    """
+    def __init__(self, time_step_factor):
+        self.time_step_factor = time_step_factor
+        self.runoff_buffer = None
+        # the inflow time step being summed
+        self.window_runoff = None
+        self.window_index = 0
+        self.window_size = 0
+
+    def _get_runoff_buffer(self, num_windows, runoff):
+        """
+        Returns a buffer for the sums of `num_windows` inflow time steps.
+        """
+        if self.runoff_buffer is None or \
+                self.runoff_buffer.shape[0] < num_windows or \
+                self.runoff_buffer.shape[1:] != runoff.shape[1:] or \
+                self.runoff_buffer.dtype != runoff.dtype:
+            self.runoff_buffer = np.empty((num_windows,) + runoff.shape[1:],
+                                          dtype=runoff.dtype)
+        return self.runoff_buffer[:num_windows]
+
+    def add(self, time_index, runoff):
+        """
+        Adds the runoff starting at the runoff time step `time_index`.
+
+        Returns
+        -------
+        tuple:
+            The index of the first inflow time step completed and the
+            summed runoff of the inflow time steps completed or None if
+            none were completed. The summed runoff is only valid until
+            the next call.
+        """
+        len_time = runoff.shape[0]
+        if self.window_size:
+            if time_index != self.window_index * self.time_step_factor + \
+                    self.window_size:
+                raise Exception("ERROR: Runoff time step {0} missing. The "
+                                "runoff time steps of each inflow time "
+                                "step need to be converted together ..."
+                                .format(self.window_index *
+                                        self.time_step_factor +
+                                        self.window_size))
+        elif time_index % self.time_step_factor:
+            raise Exception("ERROR: Runoff time step {0} is not the first "
+                            "of an inflow time step. The runoff time steps "
+                            "of each inflow time step need to be converted "
+                            "together ...".format(time_index))
+
+        # finish the inflow time step carried over
+        runoff_index = 0
+        num_windows = 0
+        if self.window_size:
+            runoff_index = min(self.time_step_factor - self.window_size,
+                               len_time)
+            for time_step_runoff in runoff[:runoff_index]:
+                self.window_runoff += time_step_runoff
+            self.window_size += runoff_index
+            if self.window_size < self.time_step_factor:
+                return None
+            num_windows = 1
+
+        num_full_windows = \
+            (len_time - runoff_index) // self.time_step_factor
+        runoff_sum = self._get_runoff_buffer(
+            num_windows + num_full_windows, runoff)
+        if num_windows:
+            runoff_sum[0] = self.window_runoff
+            self.window_size = 0
+
+        # sum the inflow time steps in the runoff
+        if num_full_windows:
+            runoff_stop = runoff_index + \
+                num_full_windows * self.time_step_factor
+            np.add.reduce(
+                runoff[runoff_index:runoff_stop].reshape(
+                    (num_full_windows, self.time_step_factor) +
+                    runoff.shape[1:]),
+                axis=1,
+                out=runoff_sum[num_windows:])
+            runoff_index = runoff_stop
+            num_windows += num_full_windows
+
+        first_window_index = \
+            (time_index + runoff_index) // self.time_step_factor - \
+            num_windows
+
+        # carry the rest over to the next runoff
+        if runoff_index < len_time:
+            if self.window_runoff is None or \
+                    self.window_runoff.shape != runoff.shape[1:] or \
+                    self.window_runoff.dtype != runoff.dtype:
+                self.window_runoff = np.empty(runoff.shape[1:],
+                                              dtype=runoff.dtype)
+            self.window_runoff[:] = runoff[runoff_index]
+            for time_step_runoff in runoff[runoff_index + 1:]:
+                self.window_runoff += time_step_runoff
+            self.window_index = \
+                (time_index + runoff_index) // self.time_step_factor
+            self.window_size = len_time - runoff_index
+
+        if not num_windows:
+            return None
+        return first_window_index, runoff_sum
+
+    def finish(self):
+        """
+        Checks that the last inflow time step is complete.
+        """
+        if self.window_size:
+            raise Exception("ERROR: Inflow time step {0} only has {1} of "
+                            "{2} runoff time steps ..."
+                            .format(self.window_index, self.window_size,
+                                    self.time_step_factor))
@@ -7,8 +7,6 @@
    Adapted from CreateInflowFileFromECMWFRunoff.py.
    License: BSD-3-Clause
 """
-from netCDF4 import Dataset
-
 from .CreateInflowFileFromGriddedRunoff import \
     CreateInflowFileFromGriddedRunoff
 
@@ -36,19 +34,13 @@ class CreateInflowFileFromLDASRunoff(CreateInflowFileFromGriddedRunoff):
 
         super(CreateInflowFileFromLDASRunoff, self).__init__()
 
-    def data_validation(self, in_nc):
+    def dataset_validation(self, data_nc):
         """Check the necessary dimensions and variables in the
-        input netcdf data"""
-        data_nc = Dataset(in_nc)
+        opened input netcdf data"""
         for dim in self.dims_oi:
             if dim not in data_nc.dimensions.keys():
-                data_nc.close()
                 raise Exception(self.error_messages[1])
 
         for var in self.vars_oi:
             if var not in data_nc.variables.keys():
-                data_nc.close()
                 raise Exception(self.error_messages[2])
-
-        data_nc.close()
-        return
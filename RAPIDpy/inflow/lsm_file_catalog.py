@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+   lsm_file_catalog.py
+   RAPIDpy
+
+   License: BSD 3-Clause
+"""
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import os
+import pickle
+
+try:
+    from os import scandir
+except ImportError:  # python 2
+    scandir = None
+
+LSM_FILE_CATALOG_VERSION = 3
+
+
+class LSMFileCatalog(object):
+    """
+    Catalog of the LSM files in a directory tree, the datetime
+    parsed from each file name, the time steps in each file
+    and the grids of the LSM files.
+
+    The listing of each directory is kept with the modification time
+    of the directory, so a refresh only lists the directories where
+    files were added or removed. If `catalog_file` is given, the
+    catalog is saved there and loaded on the next run.
+
+    Parameters
+    ----------
+    lsm_data_location: str
+        Path to the directory containing the LSM files.
+    catalog_file: str, optional
+        Path to the file the catalog is saved to.
+
+    Example:
+
+    .. code:: python
+
+        from datetime import datetime
+        import re
+        from RAPIDpy.inflow.lsm_file_catalog import LSMFileCatalog
+
+        lsm_file_catalog = LSMFileCatalog('/home/alan/era_data',
+                                          '/home/alan/era_catalog.pkl')
+        lsm_file_catalog.refresh()
+        lsm_file_list = lsm_file_catalog.get_file_list((".nc", ".nc4"))
+        lsm_file_list = lsm_file_catalog.filter_by_datetime(
+            lsm_file_list,
+            re.compile(r'\\d{8}'),
+            "%Y%m%d",
+            datetime(2010, 1, 1),
+            datetime(2010, 12, 31))
+        lsm_file_catalog.save()
+    """
+    def __init__(self, lsm_data_location, catalog_file=None):
+        self.lsm_data_location = lsm_data_location
+        self.catalog_file = catalog_file
+        # directory path: (mtime, file names, subdirectory paths)
+        self.directories = {}
+        # (datetime regex, datetime pattern): {file path: datetime}
+        self.file_datetimes = {}
+        # file path: (mtime, size, header)
+        self.file_headers = {}
+        # file path: (mtime, size, (number of time steps,
+        #                           first datetime, last datetime))
+        self.file_times = {}
+        # header: LSM grid information
+        self.grid_info = {}
+        self.file_list = []
+        if catalog_file and os.path.exists(catalog_file):
+            self._load()
+
+    def _load(self):
+        """
+        Loads the saved catalog if it was made for the same directory.
+        """
+        try:
+            with open(self.catalog_file, 'rb') as catalog_in:
+                catalog = pickle.load(catalog_in)
+            if catalog['version'] != LSM_FILE_CATALOG_VERSION or \
+                    catalog['lsm_data_location'] != \
+                    os.path.abspath(self.lsm_data_location):
+                print("LSM file catalog out of date. Rebuilding ...")
+                return
+            self.directories = catalog['directories']
+            self.file_datetimes = catalog['file_datetimes']
+            self.file_headers = catalog['file_headers']
+            self.file_times = catalog['file_times']
+            self.grid_info = catalog['grid_info']
+        except (IOError, OSError, EOFError, KeyError, TypeError,
+                ValueError, pickle.UnpicklingError):
+            print("Invalid LSM file catalog. Rebuilding ...")
+
+    def save(self):
+        """
+        Saves the catalog to `catalog_file`. The catalog is written to
+        a temporary name and moved into place so other processes never
+        read a partial catalog.
+        """
+        if not self.catalog_file:
+            return
+        tmp_catalog_file = "{0}.{1}.tmp".format(self.catalog_file,
+                                                os.getpid())
+        with open(tmp_catalog_file, 'wb') as catalog_out:
+            pickle.dump({'version': LSM_FILE_CATALOG_VERSION,
+                         'lsm_data_location':
+                             os.path.abspath(self.lsm_data_location),
+                         'directories': self.directories,
+                         'file_datetimes': self.file_datetimes,
+                         'file_headers': self.file_headers,
+                         'file_times': self.file_times,
+                         'grid_info': self.grid_info},
+                        catalog_out,
+                        protocol=2)
+        getattr(os, 'replace', os.rename)(tmp_catalog_file,
+                                          self.catalog_file)
+
+    @staticmethod
+    def _list_directory(directory):
+        """
+        Returns the file names and the subdirectory paths in a directory.
+        Links to directories are followed.
+        """
+        file_names = []
+        subdirectories = []
+        if scandir is not None:
+            for entry in scandir(directory):
+                if entry.is_dir():
+                    subdirectories.append(entry.path)
+                else:
+                    file_names.append(entry.name)
+        else:
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    subdirectories.append(path)
+                else:
+                    file_names.append(name)
+        return sorted(file_names), sorted(subdirectories)
+
+    def refresh(self):
+        """
+        Updates the catalog with the files in `lsm_data_location`.
+        Only the directories modified since the last refresh are listed.
+        """
+        directories = {}
+        directory_stack = [self.lsm_data_location]
+        while directory_stack:
+            directory = directory_stack.pop()
+            if directory in directories:
+                continue
+            try:
+                directory_mtime = os.stat(directory).st_mtime
+            except OSError:
+                continue
+            directory_info = self.directories.get(directory)
+            if directory_info is None or \
+                    directory_info[0] != directory_mtime:
+                try:
+                    directory_info = (directory_mtime,) + \
+                        self._list_directory(directory)
+                except OSError:
+                    continue
+            directories[directory] = directory_info
+            directory_stack.extend(directory_info[2])
+        self.directories = directories
+
+        self.file_list = sorted(
+            os.path.join(directory, file_name)
+            for directory, directory_info in self.directories.items()
+            for file_name in directory_info[1])
+
+        # forget the datetimes, headers and times of removed files
+        file_set = set(self.file_list)
+        for file_dict in list(self.file_datetimes.values()) + \
+                [self.file_headers, self.file_times]:
+            for file_path in set(file_dict).difference(file_set):
+                del file_dict[file_path]
+
+    @staticmethod
+    def _get_file_info(file_info_dict, file_path):
+        """
+        Returns the information about the LSM file in `file_info_dict`
+        if the file did not change since it was added, otherwise None.
+        """
+        file_info = file_info_dict.get(file_path)
+        if file_info is None:
+            return None
+        file_stat = os.stat(file_path)
+        if file_info[:2] != (file_stat.st_mtime, file_stat.st_size):
+            return None
+        return file_info[2]
+
+    @staticmethod
+    def _set_file_info(file_info_dict, file_path, file_info):
+        """
+        Adds the information about the LSM file to `file_info_dict`
+        with the modification time and size of the file.
+        """
+        file_stat = os.stat(file_path)
+        file_info_dict[file_path] = \
+            (file_stat.st_mtime, file_stat.st_size, file_info)
+
+    def get_file_header(self, file_path):
+        """
+        Returns the header of the LSM file (see
+        :func:`~RAPIDpy.inflow.lsm_rapid_process.read_lsm_file_header`)
+        if the file did not change since it was added, otherwise None.
+        """
+        return self._get_file_info(self.file_headers, file_path)
+
+    def set_file_header(self, file_path, file_header):
+        """
+        Adds the header of the LSM file to the catalog.
+        """
+        self._set_file_info(self.file_headers, file_path, file_header)
+
+    def get_file_times(self, file_path):
+        """
+        Returns the (number of time steps, first datetime, last datetime)
+        of the LSM file (see
+        :func:`~RAPIDpy.inflow.lsm_rapid_process.read_lsm_file_times`)
+        if the file did not change since it was added, otherwise None.
+        """
+        return self._get_file_info(self.file_times, file_path)
+
+    def set_file_times(self, file_path, file_times):
+        """
+        Adds the time steps of the LSM file to the catalog.
+        """
+        self._set_file_info(self.file_times, file_path, file_times)
+
+    def get_file_list(self, file_endings):
+        """
+        Returns the sorted list of files with one of the file endings.
+        """
+        file_endings = tuple(file_endings)
+        return [file_path for file_path in self.file_list
+                if file_path.endswith(file_endings)]
+
+    def get_file_datetimes(self, file_list, file_re_match,
+                           file_datetime_pattern):
+        """
+        Returns the datetime of each file from the file name.
+        The datetimes are parsed once and kept in the catalog.
+        """
+        datetime_dict = self.file_datetimes.setdefault(
+            (file_re_match.pattern, file_datetime_pattern), {})
+        file_datetime_list = []
+        for file_path in file_list:
+            file_datetime = datetime_dict.get(file_path)
+            if file_datetime is None:
+                match = file_re_match.search(file_path)
+                if match is None:
+                    raise ValueError("Datetime pattern {0} not found in "
+                                     "LSM file {1}."
+                                     .format(file_re_match.pattern,
+                                             file_path))
+                file_datetime = datetime.strptime(match.group(0),
+                                                  file_datetime_pattern)
+                datetime_dict[file_path] = file_datetime
+            file_datetime_list.append(file_datetime)
+        return file_datetime_list
+
+    def filter_by_datetime(self, file_list, file_re_match,
+                           file_datetime_pattern, start_datetime,
+                           end_datetime):
+        """
+        Returns the files from `file_list` with datetimes from
+        `start_datetime` to `end_datetime`. The window is found with a
+        binary search if the datetimes are in the order of `file_list`.
+        """
+        file_datetime_list = self.get_file_datetimes(file_list,
+                                                     file_re_match,
+                                                     file_datetime_pattern)
+        if all(earlier <= later for earlier, later
+               in zip(file_datetime_list, file_datetime_list[1:])):
+            return file_list[
+                bisect_left(file_datetime_list, start_datetime):
+                bisect_right(file_datetime_list, end_datetime)]
+
+        file_list_subset = []
+        for file_path, file_datetime in zip(file_list, file_datetime_list):
+            if file_datetime > end_datetime:
+                break
+            if file_datetime >= start_datetime:
+                file_list_subset.append(file_path)
+        return file_list_subset
@@ -7,16 +7,17 @@
    License: BSD 3-Clause
 """
 from datetime import datetime, timedelta
+import hashlib
+import json
 import multiprocessing
 import os
 import re
+from shutil import rmtree
+import tempfile
 import traceback
 
 # external packages
-import pandas as pd
-import pangaea
-from netCDF4 import Dataset
-import numpy as np
+from netCDF4 import Dataset, chartostring, num2date
 
 # local imports
 from ..rapid import RAPID
@@ -25,11 +26,19 @@ from .CreateInflowFileFromERAInterimRunoff import \
 from .CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
 from .CreateInflowFileFromWRFHydroRunoff import \
     CreateInflowFileFromWRFHydroRunoff
+from .lsm_file_catalog import LSMFileCatalog
 from ..postprocess.generate_return_periods import generate_return_periods
 from ..postprocess.generate_seasonal_averages import generate_seasonal_averages
 from ..utilities import (case_insensitive_file_search,
+                         get_available_memory,
+                         get_file_signature,
                          get_valid_directory_list,
-                         partition)
+                         is_stage_up_to_date,
+                         partition,
+                         read_run_manifest,
+                         record_pipeline_stage,
+                         run_pipeline,
+                         run_tasks)
 
 
 # -----------------------------------------------------------------------------
@@ -46,6 +55,15 @@ def generate_inflows_from_runoff(args):
     rapid_inflow_file = args[4]
     rapid_inflow_tool = args[5]
     mp_lock = args[6]
+    # if given, the inflow is staged in this directory instead of
+    # being written to the inflow file
+    slab_directory = None
+    if len(args) > 7:
+        slab_directory = args[7]
+    # extra keyword arguments for execute (Ex. memory_budget)
+    execute_options = {}
+    if len(args) > 8:
+        execute_options = args[8]
 
     time_start_all = datetime.utcnow()
 
@@ -58,6 +76,7 @@ def generate_inflows_from_runoff(args):
         file_index_list = [file_index_list]
     else:
         file_index_list = file_index_list
+    slab_list = []
     if runoff_file_list and file_index_list:
         # prepare ECMWF file for RAPID
         index_string = "Index: {0}".format(file_index_list[0])
@@ -70,12 +89,22 @@ def generate_inflows_from_runoff(args):
         print(runoff_string)
         print("Converting inflow ...")
         try:
-            rapid_inflow_tool.execute(nc_file_list=runoff_file_list,
-                                      index_list=file_index_list,
-                                      in_weight_table=weight_table_file,
-                                      out_nc=rapid_inflow_file,
-                                      grid_type=grid_type,
-                                      mp_lock=mp_lock)
+            if slab_directory is None:
+                rapid_inflow_tool.execute(nc_file_list=runoff_file_list,
+                                          index_list=file_index_list,
+                                          in_weight_table=weight_table_file,
+                                          out_nc=rapid_inflow_file,
+                                          grid_type=grid_type,
+                                          mp_lock=mp_lock,
+                                          **execute_options)
+            else:
+                slab_list = rapid_inflow_tool.execute_to_slabs(
+                    nc_file_list=runoff_file_list,
+                    index_list=file_index_list,
+                    in_weight_table=weight_table_file,
+                    slab_directory=slab_directory,
+                    grid_type=grid_type,
+                    **execute_options)
         except Exception:
             # This prints the type, value, and stack trace of the
             # current exception being handled.
@@ -85,11 +114,419 @@ def generate_inflows_from_runoff(args):
         time_finish_ecmwf = datetime.utcnow()
         print("Time to convert inflows: {0}"
               .format(time_finish_ecmwf-time_start_all))
+    return slab_list
+
+
+def get_num_inflow_workers(num_cpus, lsm_file_list, weight_table_file,
+                           rapid_inflow_tool, memory_budget=None):
+    """
+    Limits the number of inflow workers by the available memory.
+    The memory used by a worker is estimated from the size of the
+    runoff variables in the first LSM file (or `memory_budget`).
+    The weight table is shared by the workers, so its size is only
+    counted once.
+    """
+    available_memory = get_available_memory()
+    if available_memory is None:
+        return num_cpus
+
+    weight_table_list = weight_table_file
+    if not isinstance(weight_table_list, list):
+        weight_table_list = [weight_table_list]
+    # the compiled weight table is about twice the size of the CSV
+    weight_table_memory = 2 * sum(os.path.getsize(weight_table)
+                                  for weight_table in weight_table_list)
+    # the workers share the weight table (see share_weight_table)
+    available_memory = max(0, available_memory - weight_table_memory)
+    if memory_budget is not None:
+        worker_memory = memory_budget
+    else:
+        lsm_file_group = lsm_file_list[0]
+        if not isinstance(lsm_file_group, list):
+            lsm_file_group = [lsm_file_group]
+
+        lsm_example_file = Dataset(lsm_file_group[0])
+        runoff_bytes = sum(
+            lsm_example_file.variables[var_name].size *
+            lsm_example_file.variables[var_name].dtype.itemsize
+            for var_name in rapid_inflow_tool.runoff_vars
+            if var_name in lsm_example_file.variables)
+        lsm_example_file.close()
+        runoff_bytes = max(runoff_bytes,
+                           os.path.getsize(lsm_file_group[0]))
+
+        # the runoff is copied while reading, filtering and combining it
+        worker_memory = 4 * runoff_bytes * len(lsm_file_group)
+    max_workers = max(1, int(available_memory // worker_memory))
+    if max_workers < num_cpus:
+        print("WARNING: Number of inflow workers limited to {0} by the "
+              "available memory ...".format(max_workers))
+        return max_workers
+    return num_cpus
+
+
+def convert_lsm_to_inflow(lsm_file_list, weight_table_file, grid_type,
+                          rapid_inflow_file, rapid_inflow_tool, num_cpus,
+                          inflow_processing_mode, execute_options,
+                          slab_parent_directory, lsm_file_index_list=None,
+                          lsm_files_per_window=1):
+    """
+    Converts the LSM files to inflow in this process or in a pool of
+    worker processes (see `inflow_processing_mode` in
+    :func:`run_lsm_rapid_process`). The weight table and inflow file
+    can be lists to convert the inflow of several watersheds at once.
+    If given, `lsm_file_index_list` is the time index in the inflow
+    file of each LSM file (Ex. to only convert new LSM files).
+    The LSM files are given to the workers in whole windows of
+    `lsm_files_per_window` files summed into an inflow time step
+    (see `time_step_factor` in :func:`run_lsm_rapid_process`).
+    """
+    if lsm_file_index_list is None:
+        lsm_file_index_list = list(range(len(lsm_file_list)))
+
+    if inflow_processing_mode == 'serial':
+        generate_inflows_from_runoff((
+            lsm_file_list,
+            lsm_file_index_list,
+            weight_table_file,
+            grid_type,
+            rapid_inflow_file,
+            rapid_inflow_tool,
+            None,
+            None,
+            execute_options))
+        return
+
+    num_inflow_workers = get_num_inflow_workers(
+        num_cpus,
+        lsm_file_list,
+        weight_table_file,
+        rapid_inflow_tool,
+        execute_options.get('memory_budget'))
+    # use more jobs than workers so the slabs are
+    # written while the other jobs are running
+    window_list = [list(range(window_start,
+                              min(window_start + lsm_files_per_window,
+                                  len(lsm_file_list))))
+                   for window_start in range(0, len(lsm_file_list),
+                                             lsm_files_per_window)]
+    partition_list, _ = \
+        partition(window_list,
+                  min(len(window_list), 4 * num_inflow_workers))
+    slab_directory = tempfile.mkdtemp(prefix="m3_riv_slabs_",
+                                      dir=slab_parent_directory)
+    job_combinations = []
+    for cpu_grouped_window_list in partition_list:
+        file_index_list = [file_index for window in cpu_grouped_window_list
+                           for file_index in window]
+        if file_index_list:
+            job_combinations.append((
+                [lsm_file_list[file_index] for file_index
+                 in file_index_list],
+                [lsm_file_index_list[file_index] for file_index
+                 in file_index_list],
+                weight_table_file,
+                grid_type,
+                rapid_inflow_file,
+                rapid_inflow_tool,
+                None,
+                slab_directory,
+                execute_options))
+    try:
+        # the workers memory map the weight table compiled once here
+        # instead of each reading it
+        rapid_inflow_tool.share_weight_table(
+            weight_table_file,
+            slab_directory,
+            use_cache=execute_options.get('use_weight_table_cache', True),
+            use_float32=execute_options.get('use_float32', False))
+        pool = multiprocessing.Pool(num_inflow_workers)
+        # results are returned in time order
+        for slab_list in pool.imap(generate_inflows_from_runoff,
+                                   job_combinations):
+            rapid_inflow_tool.write_inflow_slabs(rapid_inflow_file,
+                                                 slab_list)
+        pool.close()
+        pool.join()
+    finally:
+        rapid_inflow_tool.release_shared_weight_table()
+        rmtree(slab_directory, ignore_errors=True)
+
+
+def run_inflow_job(lsm_file_list, lsm_file_index_list, weight_table_file,
+                   grid_type, rapid_inflow_file, rapid_inflow_tool,
+                   num_cpus, inflow_processing_mode, execute_options,
+                   slab_parent_directory, inflow_manifest_list,
+                   run_manifest_list, lsm_files_per_window=1):
+    """
+    Converts the LSM files at `lsm_file_index_list` in `lsm_file_list`
+    to inflow with :func:`convert_lsm_to_inflow` and then writes the
+    (inflow file, header, LSM file signatures) manifests in
+    `inflow_manifest_list` of incremental inflow files. Finally, the
+    inflow stage is recorded in each (run manifest, stage) of
+    `run_manifest_list` (see :func:`~RAPIDpy.utilities.run_pipeline`).
+    """
+    if lsm_file_index_list:
+        convert_lsm_to_inflow([lsm_file_list[file_index] for file_index
+                               in lsm_file_index_list],
+                              weight_table_file,
+                              grid_type,
+                              rapid_inflow_file,
+                              rapid_inflow_tool,
+                              num_cpus,
+                              inflow_processing_mode,
+                              execute_options,
+                              slab_parent_directory,
+                              lsm_file_index_list,
+                              lsm_files_per_window)
+
+        for manifest_inflow_file, manifest_header, \
+                lsm_file_signature_list in inflow_manifest_list:
+            write_inflow_manifest(manifest_inflow_file,
+                                  manifest_header,
+                                  lsm_file_signature_list)
+    else:
+        print("Inflow up to date: {0}".format(rapid_inflow_file))
+
+    for run_manifest_file, inflow_stage in run_manifest_list:
+        record_pipeline_stage(run_manifest_file, inflow_stage)
+
+
+def run_rapid_stage(rapid_manager, simulation_start_datetime,
+                    in_rivid_lat_lon_z_file, project_name,
+                    work_directory=None):
+    """
+    Runs RAPID and makes the output CF compliant. If `work_directory`
+    is given, RAPID runs in a temporary directory in it, so RAPID runs
+    at the same time do not share the RAPID namelist file.
+    """
+    rapid_work_directory = None
+    original_directory = os.getcwd()
+    if work_directory is not None:
+        rapid_work_directory = tempfile.mkdtemp(prefix="rapid_run_",
+                                                dir=work_directory)
+        os.chdir(rapid_work_directory)
+    try:
+        rapid_manager.run()
+    finally:
+        if rapid_work_directory is not None:
+            os.chdir(original_directory)
+            rmtree(rapid_work_directory, ignore_errors=True)
+
+    rapid_manager.make_output_cf_compliant(
+        simulation_start_datetime=simulation_start_datetime,
+        comid_lat_lon_z_file=in_rivid_lat_lon_z_file,
+        project_name=project_name
+    )
+
+
+def run_rapid_watershed(rapid_manager, watershed_input_directory,
+                        watershed_output_directory, lsm_rapid_output_file,
+                        in_rivid_lat_lon_z_file, out_file_ending,
+                        simulation_start_datetime, project_name, num_cpus,
+                        generate_return_periods_file, return_period_method,
+                        generate_seasonal_averages_file,
+                        generate_seasonal_initialization_file,
+                        generate_initialization_file,
+                        run_manifest_file, resume=False,
+                        work_directory=None):
+    """
+    Runs RAPID for a watershed and generates the files requested in
+    :func:`run_lsm_rapid_process` from the output. Each step is a stage
+    of a pipeline (see :func:`~RAPIDpy.utilities.run_pipeline`)
+    recorded in `run_manifest_file`, so the return periods and seasonal
+    averages are generated at the same time and, if `resume` is True,
+    the stages that are up to date are skipped.
+    """
+    rapid_input_files = [rapid_manager.Vlat_file,
+                         rapid_manager.rapid_connect_file,
+                         rapid_manager.riv_bas_id_file,
+                         rapid_manager.k_file,
+                         rapid_manager.x_file]
+    if rapid_manager.BS_opt_Qinit:
+        rapid_input_files.append(rapid_manager.Qinit_file)
+    if in_rivid_lat_lon_z_file:
+        rapid_input_files.append(in_rivid_lat_lon_z_file)
+
+    stage_list = [{
+        'name': 'rapid',
+        'function': run_rapid_stage,
+        'args': (rapid_manager, simulation_start_datetime,
+                 in_rivid_lat_lon_z_file, project_name, work_directory),
+        'cpus': num_cpus,
+        'inputs': rapid_input_files,
+        'outputs': [lsm_rapid_output_file],
+        'parameters': {
+            'namelist': {key: str(value) for key, value
+                         in vars(rapid_manager).items()
+                         if not key.startswith('_')},
+            'simulation_start_datetime': str(simulation_start_datetime),
+            'project_name': project_name,
+        },
+    }]
+
+    # the return periods and seasonal averages share the processors
+    postprocess_num_cpus = max(1, num_cpus // max(
+        1, generate_return_periods_file + generate_seasonal_averages_file))
+    if generate_return_periods_file:
+        return_periods_file = os.path.join(
+            watershed_output_directory,
+            'return_periods_{0}'.format(out_file_ending))
+        # assume storm has 3 day length
+        storm_length_days = 3
+        stage_list.append({
+            'name': 'return_periods',
+            'function': generate_return_periods,
+            'args': (lsm_rapid_output_file, return_periods_file,
+                     postprocess_num_cpus, storm_length_days,
+                     return_period_method),
+            'cpus': postprocess_num_cpus,
+            'inputs': [lsm_rapid_output_file],
+            'outputs': [return_periods_file],
+            'parameters': {'storm_duration_days': storm_length_days,
+                           'method': return_period_method},
+            'depends_on': ['rapid'],
+        })
+
+    if generate_seasonal_averages_file:
+        seasonal_averages_file = os.path.join(
+            watershed_output_directory,
+            'seasonal_averages_{0}'.format(out_file_ending))
+        stage_list.append({
+            'name': 'seasonal_averages',
+            'function': generate_seasonal_averages,
+            'args': (lsm_rapid_output_file, seasonal_averages_file,
+                     postprocess_num_cpus),
+            'cpus': postprocess_num_cpus,
+            'inputs': [lsm_rapid_output_file],
+            'outputs': [seasonal_averages_file],
+            'depends_on': ['rapid'],
+        })
+
+    if generate_seasonal_initialization_file:
+        seasonal_qinit_file = os.path.join(
+            watershed_input_directory,
+            'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
+        stage_list.append({
+            'name': 'seasonal_initialization',
+            'function': rapid_manager.generate_seasonal_intitialization,
+            'args': (seasonal_qinit_file,),
+            'cpus': 1,
+            'inputs': [lsm_rapid_output_file],
+            'outputs': [seasonal_qinit_file],
+            'depends_on': ['rapid'],
+        })
+
+    if generate_initialization_file:
+        qinit_file = os.path.join(
+            watershed_input_directory,
+            'qinit_{0}.csv'.format(out_file_ending[:-3]))
+        stage_list.append({
+            'name': 'initialization',
+            'function': rapid_manager.generate_qinit_from_past_qout,
+            'args': (qinit_file,),
+            'cpus': 1,
+            'inputs': [lsm_rapid_output_file],
+            'outputs': [qinit_file],
+            'depends_on': ['rapid'],
+        })
+
+    run_pipeline(stage_list, run_manifest_file, num_cpus, resume)
 
 
 # -----------------------------------------------------------------------------
 # UTILITY FUNCTIONS
 # -----------------------------------------------------------------------------
+INFLOW_MANIFEST_VERSION = 1
+
+
+def get_inflow_manifest_file(rapid_inflow_file):
+    """
+    Returns the path to the manifest of an incremental inflow file.
+    """
+    return "{0}_manifest.json".format(os.path.splitext(rapid_inflow_file)[0])
+
+
+def get_lsm_file_signature(lsm_file):
+    """
+    Returns the signatures of the LSM file (or list of LSM files
+    combined into one time step).
+    """
+    if not isinstance(lsm_file, list):
+        lsm_file = [lsm_file]
+    return [get_file_signature(lsm_sub_file) for lsm_sub_file in lsm_file]
+
+
+def get_stale_inflow_indices(rapid_inflow_file, manifest_header,
+                             lsm_file_signature_list):
+    """
+    Finds the LSM files that need to be converted to update an
+    incremental inflow file.
+
+    Parameters
+    ----------
+    rapid_inflow_file: str
+        Path to the inflow file.
+    manifest_header: dict
+        The settings the inflow file was generated with. If they do not
+        match the manifest, the inflow file is generated again.
+    lsm_file_signature_list: list
+        The signature of each LSM file from :func:`get_lsm_file_signature`
+        in time order.
+
+    Returns
+    -------
+    list:
+        The index of each new or changed LSM file or None if the inflow
+        file needs to be generated from scratch.
+    """
+    manifest_file = get_inflow_manifest_file(rapid_inflow_file)
+    if not (os.path.exists(rapid_inflow_file) and
+            os.path.exists(manifest_file)):
+        return None
+
+    try:
+        with open(manifest_file) as manifest_in:
+            manifest = json.load(manifest_in)
+        manifest_signature_list = manifest['files']
+        manifest_header_match = \
+            manifest['version'] == INFLOW_MANIFEST_VERSION and \
+            manifest['header'] == json.loads(json.dumps(manifest_header))
+    except (IOError, OSError, KeyError, TypeError, ValueError):
+        print("Invalid inflow manifest. Regenerating inflow file ...")
+        return None
+
+    if not manifest_header_match:
+        print("Inflow file settings changed. Regenerating inflow file ...")
+        return None
+    if len(manifest_signature_list) > len(lsm_file_signature_list):
+        print("Fewer LSM files than in the inflow file. "
+              "Regenerating inflow file ...")
+        return None
+
+    return [file_index for file_index, lsm_file_signature
+            in enumerate(lsm_file_signature_list)
+            if file_index >= len(manifest_signature_list) or
+            manifest_signature_list[file_index] != lsm_file_signature]
+
+
+def write_inflow_manifest(rapid_inflow_file, manifest_header,
+                          lsm_file_signature_list):
+    """
+    Records the LSM files in each time index of an incremental inflow
+    file. The manifest is written to a temporary name and moved into
+    place, so it is only updated once the inflow is written.
+    """
+    manifest_file = get_inflow_manifest_file(rapid_inflow_file)
+    tmp_manifest_file = "{0}.{1}.tmp".format(manifest_file, os.getpid())
+    with open(tmp_manifest_file, 'w') as manifest_out:
+        json.dump({'version': INFLOW_MANIFEST_VERSION,
+                   'header': manifest_header,
+                   'files': lsm_file_signature_list},
+                  manifest_out)
+    getattr(os, 'replace', os.rename)(tmp_manifest_file, manifest_file)
+
+
 DEFAULT_LSM_INPUTS = {
     'erai_new': {
         'file_datetime_re_pattern': r'\d{8}',
@@ -138,356 +575,448 @@ DEFAULT_LSM_INPUTS = {
 }
 
 
-def identify_lsm_grid(lsm_grid_path):
+# names of the LSM dimensions and variables in order of preference
+LSM_NAMES = {
+    'latitude_dim': ('lat', ['latitude',
+                             'g0_lat_0',  # GLDAS/NLDAS MOSAIC
+                             'lat_110',  # NLDAS NOAH/VIC
+                             'north_south',  # LIS/Joules
+                             'south_north',  # WRF Hydro
+                             'Y']),  # FLDAS
+    'longitude_dim': ('lon', ['longitude',
+                              'g0_lon_1',  # GLDAS/NLDAS MOSAIC
+                              'lon_110',  # NLDAS NOAH/VIC
+                              'east_west',  # LIS/Joules
+                              'west_east',  # WRF Hydro
+                              'X']),  # FLDAS
+    'time_dim': (None, ['time', 'Time', 'Times', 'times']),
+    'latitude_var': ('lat', ['latitude',
+                             'g0_lat_0',
+                             'lat_110',
+                             'north_south',
+                             'XLAT',  # WRF
+                             'Y']),  # FLDAS
+    'longitude_var': ('lon', ['longitude',
+                              'g0_lon_1',
+                              'lon_110',
+                              'east_west',
+                              'XLONG',  # WRF
+                              'X']),  # FLDAS
+    'time_var': (None, ['time', 'Time', 'Times', 'times']),
+}
+
+# (match type, name, runoff type) of the LSM runoff variables
+LSM_RUNOFF_VARIABLES = [
+    ('prefix', 'SSRUN', 'surface'),  # NLDAS/GLDAS
+    ('prefix', 'BGRUN', 'subsurface'),  # NLDAS/GLDAS
+    ('name', 'Qs_acc', 'surface'),  # GLDAS v2
+    ('name', 'Qsb_acc', 'subsurface'),  # GLDAS v2
+    ('name', 'Qs_tavg', 'surface'),  # FLDAS
+    ('name', 'Qsb_tavg', 'subsurface'),  # FLDAS
+    ('name', 'Qs_inst', 'surface'),  # LIS
+    ('name', 'Qsb_inst', 'subsurface'),  # LIS
+    ('name', 'SFROFF', 'surface'),  # WRF Hydro
+    ('name', 'UDROFF', 'subsurface'),  # WRF Hydro
+    ('lower_name', 'ro', 'total'),  # ERA Interim
+    ('name', 'total runoff', 'total'),  # CMIP5 data
+]
+
+# The LSM products in the order they are checked. A product matches if
+# any of its 'match' conditions match the file, then the first of its
+# grids with matching conditions is used. The conditions are:
+#   attributes: the global attributes have these values
+#   attribute_contains: the global attributes contain these strings
+#   runoff_vars: the runoff variable names start with these strings
+#   grid_shape: the (latitude, longitude) dimension sizes
+#   max_grid_shape: the maximum (latitude, longitude) dimension sizes
+LSM_GRID_REGISTRY = [
+    {
+        'match': [
+            {'attributes': {'institution': "European Centre for "
+                                           "Medium-Range Weather Forecasts"}},
+            {'runoff_vars': {'total': 'ro'}},
+        ],
+        'rapid_inflow_tool': 'erai',
+        'grids': [
+            {
+                # Downloaded as 0.5 degree grid
+                'grid_shape': (1280, 2576),
+                'identified_as': "new ERA Interim GRID",
+                'description': "new ERA Interim GRID",
+                'model_name': "erai",
+                'weight_file_name': r'weight_era_new\.csv',
+                'grid_type': 'erai_new',
+            },
+            {
+                # ERA Interim Low Res (T255)
+                # Downloaded as 0.5 degree grid
+                'grid_shape': (361, 720),
+                'identified_as': "ERA Interim Low Res (T255) GRID",
+                'description': "ERA Interim (T255 Grid)",
+                'model_name': "erai",
+                'weight_file_name': r'weight_era_t255\.csv',
+                'grid_type': 't255',
+            },
+            {
+                # ERA Interim High Res (T511)
+                'grid_shape': (512, 1024),
+                'identified_as': "ERA Interim High Res (T511) GRID",
+                'description': "ERA Interim (T511 Grid)",
+                'model_name': "erai",
+                'weight_file_name': r'weight_era_t511\.csv',
+                'grid_type': 't511',
+            },
+            {
+                # ERA 20CM (T159) - 3hr - 10 ensembles
+                # Downloaded as 1.125 degree grid
+                'grid_shape': (161, 320),
+                'identified_as': "ERA 20CM (T159) GRID",
+                'description': "ERA 20CM (T159 Grid)",
+                'model_name': "era_20cm",
+                'weight_file_name': r'weight_era_t159\.csv',
+                'grid_type': 't159',
+            },
+        ],
+        'error': "Unsupported ECMWF grid.",
+    },
+    {
+        'match': [{'attributes': {'institution': "NASA GSFC"}}],
+        'grids': [
+            {
+                'attributes': {
+                    'title': "GLDAS2.0 LIS land surface model output"},
+                'identified_as': "GLDAS v2 LIS GRID",
+                'description': "GLDAS2.0 LIS",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_gldas2\.csv',
+                'grid_type': 'gldas2',
+            },
+            {
+                # this is the LIS model (can be FLDAS)
+                # THIS CASE CAN ALSO BE FOR FLDAS, however you will need to
+                # add the file_datetime_pattern && file_datetime_re_pattern
+                # for it to work if it is not 3-hourly time step.
+                'identified_as': "LIS GRID",
+                'description': "NASA GSFC LIS",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_lis\.csv',
+                'grid_type': 'lis',
+            },
+        ],
+    },
+    {
+        'match': [{'attributes': {'institution': "Met Office, UK"}}],
+        'grids': [
+            {
+                'identified_as': "Joules GRID",
+                'description': "Met Office Joules",
+                'model_name': "met_office",
+                'weight_file_name': r'weight_joules\.csv',
+                'grid_type': 'joules',
+            },
+        ],
+    },
+    {
+        'match': [{'attributes': {'institution': "NCAR, USACE, USBR"}}],
+        'runoff_vars': ['total'],
+        'grids': [
+            {
+                'identified_as': "CMIP5",
+                'description': "CMIP5 Runoff",
+                'model_name': "cmip5",
+                'weight_file_name': r'weight_cmip5\.csv',
+                'grid_type': 'cmip5',
+            },
+        ],
+    },
+    {
+        'match': [{'runoff_vars': {'surface': 'SSRUN',
+                                   'subsurface': 'BGRUN'}}],
+        'grids': [
+            {
+                # SSRUN_GDS0_SFC_ave1h (surface)
+                # BGRUN_GDS0_SFC_ave1h (subsurface)
+                #  or
+                # SSRUNsfc_GDS0_SFC_ave1h (surface)
+                # BGRUNsfc_GDS0_SFC_ave1h (subsurface)
+                'grid_shape': (600, 1440),
+                'identified_as': "GLDAS GRID",
+                'description': "GLDAS",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_gldas\.csv',
+                'grid_type': 'gldas',
+            },
+            {
+                # NLDAS MOSAIC (g0_lat_0, g0_lon_1)
+                # or NLDAS NOAH/VIC (lat_110, lon_110)
+                'max_grid_shape': (224, 464),
+                'identified_as': "NLDAS GRID",
+                'description': "NLDAS",
+                'model_name': "nasa",
+                'weight_file_name': r'weight_nldas\.csv',
+                'grid_type': 'nldas',
+            },
+        ],
+        'error': "Unsupported runoff grid.",
+    },
+    {
+        'match': [{'attribute_contains': {'TITLE': "WRF"}}],
+        'rapid_inflow_tool': 'wrf',
+        'grids': [
+            {
+                'identified_as': "WRF/WRF-Hydro GRID",
+                'description': "WRF/WRF-Hydro Runoff",
+                'model_name': "wrf",
+                'weight_file_name': r'weight_wrf\.csv',
+                'grid_type': 'wrf',
+            },
+        ],
+    },
+]
+
+# global attributes used to identify the LSM grid
+LSM_GRID_ATTRIBUTES = ('institution', 'title', 'TITLE')
+
+
+def read_lsm_file_header(lsm_grid_path):
     """
-    This is used to idenfity the input LSM grid
+    Reads the parts of the LSM file header used to identify the grid.
+
+    Returns
+    -------
+    tuple:
+        The (name, size) of each dimension, the variable names and
+        the (name, value) of the global attributes in
+        `LSM_GRID_ATTRIBUTES`. This is the structural signature
+        of the LSM file.
     """
-    # check to see what kind of file we are dealing with
-    lsm_example_file = Dataset(lsm_grid_path)
-
-    # INDENTIFY LAT/LON DIMENSIONS
-    dim_list = lsm_example_file.dimensions.keys()
-    latitude_dim = "lat"
-    if 'latitude' in dim_list:
-        latitude_dim = 'latitude'
-    elif 'g0_lat_0' in dim_list:
-        # GLDAS/NLDAS MOSAIC
-        latitude_dim = 'g0_lat_0'
-    elif 'lat_110' in dim_list:
-        # NLDAS NOAH/VIC
-        latitude_dim = 'lat_110'
-    elif 'north_south' in dim_list:
-        # LIS/Joules
-        latitude_dim = 'north_south'
-    elif 'south_north' in dim_list:
-        # WRF Hydro
-        latitude_dim = 'south_north'
-    elif 'Y' in dim_list:
-        # FLDAS
-        latitude_dim = 'Y'
-
-    longitude_dim = "lon"
-    if 'longitude' in dim_list:
-        longitude_dim = 'longitude'
-    elif 'g0_lon_1' in dim_list:
-        # GLDAS/NLDAS MOSAIC
-        longitude_dim = 'g0_lon_1'
-    elif 'lon_110' in dim_list:
-        # NLDAS NOAH/VIC
-        longitude_dim = 'lon_110'
-    elif 'east_west' in dim_list:
-        # LIS/Joules
-        longitude_dim = 'east_west'
-    elif 'west_east' in dim_list:
-        # WRF Hydro
-        longitude_dim = 'west_east'
-    elif 'X' in dim_list:
-        # FLDAS
-        longitude_dim = 'X'
-
-    time_dim = None
-    if 'time' in dim_list:
-        time_dim = 'time'
-    elif 'Time' in dim_list:
-        time_dim = 'Time'
-    elif 'Times' in dim_list:
-        time_dim = 'Times'
-    elif 'times' in dim_list:
-        time_dim = 'times'
-
-    lat_dim_size = len(lsm_example_file.dimensions[latitude_dim])
-    lon_dim_size = len(lsm_example_file.dimensions[longitude_dim])
-
-    # IDENTIFY VARIABLES
-    var_list = lsm_example_file.variables.keys()
-    latitude_var = "lat"
-    if 'latitude' in var_list:
-        latitude_var = 'latitude'
-    elif 'g0_lat_0' in var_list:
-        latitude_var = 'g0_lat_0'
-    elif 'lat_110' in var_list:
-        latitude_var = 'lat_110'
-    elif 'north_south' in var_list:
-        latitude_var = 'north_south'
-    elif 'XLAT' in var_list:
-        # WRF
-        latitude_var = 'XLAT'
-    elif 'Y' in var_list:
-        # FLDAS
-        latitude_var = 'Y'
-
-    longitude_var = "lon"
-    if 'longitude' in var_list:
-        longitude_var = 'longitude'
-    elif 'g0_lon_1' in var_list:
-        longitude_var = 'g0_lon_1'
-    elif 'lon_110' in var_list:
-        longitude_var = 'lon_110'
-    elif 'east_west' in var_list:
-        longitude_var = 'east_west'
-    elif 'XLONG' in var_list:
-        # WRF
-        longitude_var = 'XLONG'
-    elif 'X' in var_list:
-        # FLDAS
-        longitude_var = 'X'
-
-    time_var = None
-    if 'time' in var_list:
-        time_var = 'time'
-    elif 'Time' in var_list:
-        time_var = 'Time'
-    elif 'Times' in var_list:
-        time_var = 'Times'
-    elif 'times' in var_list:
-        time_var = 'times'
-
-    surface_runoff_var = ""
-    subsurface_runoff_var = ""
-    total_runoff_var = ""
-    for var in var_list:
-        if var.startswith("SSRUN"):
-            # NLDAS/GLDAS
-            surface_runoff_var = var
-        elif var.startswith("BGRUN"):
-            # NLDAS/GLDAS
-            subsurface_runoff_var = var
-        elif var == "Qs_acc":
-            # GLDAS v2
-            surface_runoff_var = var
-        elif var == "Qsb_acc":
-            # GLDAS v2
-            subsurface_runoff_var = var
-        elif var == "Qs_tavg":
-            # FLDAS
-            surface_runoff_var = var
-        elif var == "Qsb_tavg":
-            # FLDAS
-            subsurface_runoff_var = var
-        elif var == "Qs_inst":
-            # LIS
-            surface_runoff_var = var
-        elif var == "Qsb_inst":
-            # LIS
-            subsurface_runoff_var = var
-        elif var == "SFROFF":
-            # WRF Hydro
-            surface_runoff_var = var
-        elif var == "UDROFF":
-            # WRF Hydro
-            subsurface_runoff_var = var
-        elif var.lower() == "ro":
-            # ERA Interim
-            total_runoff_var = var
-        elif var == "total runoff":
-            # CMIP5 data
-            total_runoff_var = var
-
-    # IDENTIFY GRID TYPE
-    lsm_file_data = {
-        "weight_file_name": "",
-        "grid_type": "",
-        "model_name": "",
-        "description": "",
-        "rapid_inflow_tool": None,
-        "latitude_var": latitude_var,
-        "longitude_var": longitude_var,
-        "time_var": time_var,
-        "latitude_dim": latitude_dim,
-        "longitude_dim": longitude_dim,
-        "time_dim": time_dim,
-    }
+    with Dataset(lsm_grid_path) as lsm_example_file:
+        attribute_names = lsm_example_file.ncattrs()
+        return (
+            tuple((dim_name, len(dim))
+                  for dim_name, dim in lsm_example_file.dimensions.items()),
+            tuple(lsm_example_file.variables),
+            tuple((attribute_name,
+                   lsm_example_file.getncattr(attribute_name))
+                  for attribute_name in LSM_GRID_ATTRIBUTES
+                  if attribute_name in attribute_names),
+        )
 
-    institution = ""
-    title = ""
-    try:
-        institution = lsm_example_file.getncattr("institution")
-    except AttributeError:
-        pass
-    try:
-        title = lsm_example_file.getncattr("title")
-    except AttributeError:
-        pass
-
-    runoff_vars = [surface_runoff_var, subsurface_runoff_var]
-
-    if institution == "European Centre for Medium-Range Weather Forecasts" \
-            or total_runoff_var.lower() == "ro":
-        # these are the ECMWF models
-        if lat_dim_size == 1280 and lon_dim_size == 2576:
-            print("Runoff file identified as new ERA Interim GRID")
-            # A) ERA Interim Low Res (T255)
-            # Downloaded as 0.5 degree grid
-            #  dimensions:
-            #    longitude = 720 ;
-            #    latitude = 361 ;
-            lsm_file_data["description"] = "new ERA Interim GRID"
-            lsm_file_data["model_name"] = "erai"
-            lsm_file_data["weight_file_name"] = r'weight_era_new\.csv'
-            lsm_file_data["grid_type"] = 'erai_new'
-        elif lat_dim_size == 361 and lon_dim_size == 720:
-            print("Runoff file identified as ERA Interim Low Res (T255) GRID")
-            # A) ERA Interim Low Res (T255)
-            # Downloaded as 0.5 degree grid
-            #  dimensions:
-            # 	 longitude = 720 ;
-            # 	 latitude = 361 ;
-            lsm_file_data["description"] = "ERA Interim (T255 Grid)"
-            lsm_file_data["model_name"] = "erai"
-            lsm_file_data["weight_file_name"] = r'weight_era_t255\.csv'
-            lsm_file_data["grid_type"] = 't255'
-
-        elif lat_dim_size == 512 and lon_dim_size == 1024:
-            print("Runoff file identified as ERA Interim High Res (T511) GRID")
-            # B) ERA Interim High Res (T511)
-            #  dimensions:
-            #   lon = 1024 ;
-            #   lat = 512 ;
-            lsm_file_data["description"] = "ERA Interim (T511 Grid)"
-            lsm_file_data["weight_file_name"] = r'weight_era_t511\.csv'
-            lsm_file_data["model_name"] = "erai"
-            lsm_file_data["grid_type"] = 't511'
-        elif lat_dim_size == 161 and lon_dim_size == 320:
-            print("Runoff file identified as ERA 20CM (T159) GRID")
-            # C) ERA 20CM (T159) - 3hr - 10 ensembles
-            # Downloaded as 1.125 degree grid
-            #  dimensions:
-            #   longitude = 320 ;
-            #   latitude = 161 ;
-            lsm_file_data["description"] = "ERA 20CM (T159 Grid)"
-            lsm_file_data["weight_file_name"] = r'weight_era_t159\.csv'
-            lsm_file_data["model_name"] = "era_20cm"
-            lsm_file_data["grid_type"] = 't159'
+
+def _match_lsm_grid_conditions(conditions, attributes, runoff_var_names,
+                               grid_shape):
+    """
+    Checks the conditions of an entry in `LSM_GRID_REGISTRY`.
+    """
+    for attribute_name, value in conditions.get('attributes', {}).items():
+        if attributes.get(attribute_name, "") != value:
+            return False
+    for attribute_name, value in \
+            conditions.get('attribute_contains', {}).items():
+        if value not in attributes.get(attribute_name, ""):
+            return False
+    for runoff_type, value in conditions.get('runoff_vars', {}).items():
+        if not runoff_var_names[runoff_type].lower().startswith(
+                value.lower()):
+            return False
+    if 'grid_shape' in conditions and \
+            grid_shape != tuple(conditions['grid_shape']):
+        return False
+    if 'max_grid_shape' in conditions and \
+            (grid_shape[0] > conditions['max_grid_shape'][0] or
+             grid_shape[1] > conditions['max_grid_shape'][1]):
+        return False
+    return True
+
+
+def classify_lsm_grid(lsm_file_header):
+    """
+    Identifies the LSM grid from the LSM file header
+    (see :func:`read_lsm_file_header`) with `LSM_GRID_REGISTRY`.
+
+    Returns
+    -------
+    dict:
+        The LSM grid information without the inflow tool.
+    """
+    dimensions = dict(lsm_file_header[0])
+    var_list = lsm_file_header[1]
+    attributes = dict(lsm_file_header[2])
+
+    lsm_grid_info = {}
+    for name_key, (default_name, name_list) in LSM_NAMES.items():
+        names = var_list if name_key.endswith('_var') else dimensions
+        lsm_grid_info[name_key] = next(
+            (name for name in name_list if name in names), default_name)
+
+    runoff_var_names = {
+        'surface': "",
+        'subsurface': "",
+        'total': "",
+    }
+    for var in var_list:
+        for match_type, runoff_name, runoff_type in LSM_RUNOFF_VARIABLES:
+            if (match_type == 'prefix' and var.startswith(runoff_name)) or \
+                    (match_type == 'name' and var == runoff_name) or \
+                    (match_type == 'lower_name' and
+                     var.lower() == runoff_name):
+                runoff_var_names[runoff_type] = var
+                break
+
+    grid_shape = (dimensions[lsm_grid_info['latitude_dim']],
+                  dimensions[lsm_grid_info['longitude_dim']])
+
+    for lsm_product in LSM_GRID_REGISTRY:
+        if not any(_match_lsm_grid_conditions(conditions, attributes,
+                                              runoff_var_names, grid_shape)
+                   for conditions in lsm_product['match']):
+            continue
+        for lsm_grid in lsm_product['grids']:
+            if _match_lsm_grid_conditions(lsm_grid, attributes,
+                                          runoff_var_names, grid_shape):
+                break
         else:
-            lsm_example_file.close()
-            raise Exception("Unsupported ECMWF grid.")
+            raise Exception(lsm_product['error'])
+
+        lsm_grid_info.update(
+            weight_file_name=lsm_grid['weight_file_name'],
+            grid_type=lsm_grid['grid_type'],
+            model_name=lsm_grid['model_name'],
+            description=lsm_grid['description'],
+            identified_as=lsm_grid['identified_as'],
+            rapid_inflow_tool_name=lsm_product.get('rapid_inflow_tool',
+                                                   'ldas'),
+            surface_runoff_var=runoff_var_names['surface'],
+            subsurface_runoff_var=runoff_var_names['subsurface'],
+            runoff_vars=[runoff_var_names[runoff_type]
+                         for runoff_type in
+                         lsm_product.get('runoff_vars',
+                                         ['surface', 'subsurface'])],
+        )
+        return lsm_grid_info
 
-        lsm_file_data["rapid_inflow_tool"] = \
-            CreateInflowFileFromERAInterimRunoff()
+    raise Exception("Unsupported LSM grid.")
 
-    elif institution == "NASA GSFC":
-        if title == "GLDAS2.0 LIS land surface model output":
-            print("Runoff file identified as GLDAS v2 LIS GRID")
-            # this is the LIS model
-            lsm_file_data["weight_file_name"] = r'weight_gldas2\.csv'
-            lsm_file_data["grid_type"] = 'gldas2'
-            lsm_file_data["description"] = "GLDAS2.0 LIS"
-            lsm_file_data["model_name"] = "nasa"
 
-        else:
-            print("Runoff file identified as LIS GRID")
-            # this is the LIS model (can be FLDAS)
-            # THIS CASE CAN ALSO BE FOR FLDAS, however you will need to add
-            # the file_datetime_pattern && file_datetime_re_pattern for it to
-            # work if it is not 3-hourly time step.
-            lsm_file_data["weight_file_name"] = r'weight_lis\.csv'
-            lsm_file_data["grid_type"] = 'lis'
-            lsm_file_data["description"] = "NASA GSFC LIS"
-            lsm_file_data["model_name"] = "nasa"
-
-    elif institution == "Met Office, UK":
-        print("Runoff file identified as Joules GRID")
-        lsm_file_data["weight_file_name"] = r'weight_joules\.csv'
-        lsm_file_data["grid_type"] = 'joules'
-        lsm_file_data["description"] = "Met Office Joules"
-        lsm_file_data["model_name"] = "met_office"
-
-    elif institution == "NCAR, USACE, USBR":
-        print("Runoff file identified as CMIP5")
-        lsm_file_data["weight_file_name"] = r'weight_cmip5\.csv'
-        lsm_file_data["grid_type"] = 'cmip5'
-        lsm_file_data["description"] = "CMIP5 Runoff"
-        lsm_file_data["model_name"] = "cmip5"
-
-        runoff_vars = [total_runoff_var]
-
-    elif surface_runoff_var.startswith("SSRUN") \
-            and subsurface_runoff_var.startswith("BGRUN"):
-
-        lsm_file_data["model_name"] = "nasa"
-        if lat_dim_size == 600 and lon_dim_size == 1440:
-            print("Runoff file identified as GLDAS GRID")
-            # GLDAS NC FILE
-            # dimensions:
-            #     g0_lat_0 = 600 ;
-            #     g0_lon_1 = 1440 ;
-            # variables
-            # SSRUN_GDS0_SFC_ave1h (surface)
-            # BGRUN_GDS0_SFC_ave1h (subsurface)
-            #  or
-            # SSRUNsfc_GDS0_SFC_ave1h (surface)
-            # BGRUNsfc_GDS0_SFC_ave1h (subsurface)
-            lsm_file_data["description"] = "GLDAS"
-            lsm_file_data["weight_file_name"] = r'weight_gldas\.csv'
-            lsm_file_data["grid_type"] = 'gldas'
-
-        elif lat_dim_size <= 224 and lon_dim_size <= 464:
-            print("Runoff file identified as NLDAS GRID")
-            # NLDAS MOSAIC FILE
-            # dimensions:
-            #     g0_lat_0 = 224 ;
-            #     g0_lon_1 = 464 ;
-            # NLDAS NOAH/VIC FILE
-            # dimensions:
-            #     lat_110 = 224 ;
-            #     lon_110 = 464 ;
-
-            lsm_file_data["description"] = "NLDAS"
-            lsm_file_data["weight_file_name"] = r'weight_nldas\.csv'
-            lsm_file_data["grid_type"] = 'nldas'
-        else:
-            lsm_example_file.close()
-            raise Exception("Unsupported runoff grid.")
+def identify_lsm_grid(lsm_grid_path, lsm_file_catalog=None):
+    """
+    This is used to idenfity the input LSM grid
 
-    else:
-        title = ""
-        try:
-            title = lsm_example_file.getncattr("TITLE")
-        except AttributeError:
-            pass
-
-        if "WRF" in title:
-            lsm_file_data["description"] = "WRF/WRF-Hydro Runoff"
-            lsm_file_data["weight_file_name"] = r'weight_wrf\.csv'
-            lsm_file_data["model_name"] = 'wrf'
-            lsm_file_data["grid_type"] = 'wrf'
-
-            lsm_file_data['rapid_inflow_tool'] = \
-                CreateInflowFileFromWRFHydroRunoff(
-                    latitude_dim,
-                    longitude_dim,
-                    latitude_var,
-                    longitude_var,
-                    surface_runoff_var,
-                    subsurface_runoff_var,
-                )
-        else:
-            lsm_example_file.close()
-            raise Exception("Unsupported LSM grid.")
+    Parameters
+    ----------
+    lsm_grid_path: str
+        Path to the LSM file.
+    lsm_file_catalog: :obj:`~RAPIDpy.inflow.lsm_file_catalog.LSMFileCatalog`, optional
+        If given, the LSM file header and the grid identified from it
+        are kept in the catalog, so unchanged files are not opened again
+        and files with the same header are not identified again.
+    """  # noqa
+    lsm_file_header = None
+    if lsm_file_catalog is not None:
+        lsm_file_header = lsm_file_catalog.get_file_header(lsm_grid_path)
+    if lsm_file_header is None:
+        lsm_file_header = read_lsm_file_header(lsm_grid_path)
+        if lsm_file_catalog is not None:
+            lsm_file_catalog.set_file_header(lsm_grid_path, lsm_file_header)
+
+    lsm_grid_info = None
+    if lsm_file_catalog is not None:
+        lsm_grid_info = lsm_file_catalog.grid_info.get(lsm_file_header)
+    if lsm_grid_info is None:
+        lsm_grid_info = classify_lsm_grid(lsm_file_header)
+        if lsm_file_catalog is not None:
+            lsm_file_catalog.grid_info[lsm_file_header] = lsm_grid_info
 
-    lsm_example_file.close()
+    print("Runoff file identified as {0}"
+          .format(lsm_grid_info['identified_as']))
 
-    # set the inflow tool to use the LDAS tool by default
-    if lsm_file_data["rapid_inflow_tool"] is None:
+    lsm_file_data = {
+        "weight_file_name": lsm_grid_info['weight_file_name'],
+        "grid_type": lsm_grid_info['grid_type'],
+        "model_name": lsm_grid_info['model_name'],
+        "description": lsm_grid_info['description'],
+        "rapid_inflow_tool": None,
+        "latitude_var": lsm_grid_info['latitude_var'],
+        "longitude_var": lsm_grid_info['longitude_var'],
+        "time_var": lsm_grid_info['time_var'],
+        "latitude_dim": lsm_grid_info['latitude_dim'],
+        "longitude_dim": lsm_grid_info['longitude_dim'],
+        "time_dim": lsm_grid_info['time_dim'],
+    }
+
+    # the inflow tools keep the weight table, so a new one is made each time
+    if lsm_grid_info['rapid_inflow_tool_name'] == 'erai':
+        lsm_file_data["rapid_inflow_tool"] = \
+            CreateInflowFileFromERAInterimRunoff()
+    elif lsm_grid_info['rapid_inflow_tool_name'] == 'wrf':
+        lsm_file_data['rapid_inflow_tool'] = \
+            CreateInflowFileFromWRFHydroRunoff(
+                lsm_grid_info['latitude_dim'],
+                lsm_grid_info['longitude_dim'],
+                lsm_grid_info['latitude_var'],
+                lsm_grid_info['longitude_var'],
+                lsm_grid_info['surface_runoff_var'],
+                lsm_grid_info['subsurface_runoff_var'],
+            )
+    else:
+        # set the inflow tool to use the LDAS tool by default
         lsm_file_data["rapid_inflow_tool"] = \
             CreateInflowFileFromLDASRunoff(
-                latitude_dim,
-                longitude_dim,
-                latitude_var,
-                longitude_var,
-                runoff_vars,
+                lsm_grid_info['latitude_dim'],
+                lsm_grid_info['longitude_dim'],
+                lsm_grid_info['latitude_var'],
+                lsm_grid_info['longitude_var'],
+                list(lsm_grid_info['runoff_vars']),
             )
 
     return lsm_file_data
 
 
+def read_lsm_file_times(lsm_file_path, time_var, time_dim):
+    """
+    Reads the number of time steps and the first and last datetime
+    of the LSM file. Character time variables (Ex. the WRF Times
+    variable) are parsed with the pattern %Y-%m-%d_%H:%M:%S.
+
+    Returns
+    -------
+    tuple:
+        The (number of time steps, first datetime, last datetime).
+    """
+    with Dataset(lsm_file_path) as lsm_file:
+        num_time_steps = len(lsm_file.dimensions[time_dim])
+        time_variable = lsm_file.variables[time_var]
+        time_variable.set_auto_mask(False)
+        time_values = time_variable[[0, num_time_steps - 1]]
+        if time_variable.dtype.kind == 'S':
+            file_datetimes = [datetime.strptime(str(time_string),
+                                                "%Y-%m-%d_%H:%M:%S")
+                              for time_string
+                              in chartostring(time_values)]
+        else:
+            # cftime datetimes are converted to python datetimes
+            file_datetimes = [
+                datetime(file_datetime.year, file_datetime.month,
+                         file_datetime.day, file_datetime.hour,
+                         file_datetime.minute, file_datetime.second,
+                         file_datetime.microsecond)
+                for file_datetime in num2date(
+                    time_values,
+                    time_variable.units,
+                    getattr(time_variable, 'calendar', 'standard'))]
+    return num_time_steps, file_datetimes[0], file_datetimes[1]
+
+
 def determine_start_end_timestep(lsm_file_list,
                                  file_re_match=None,
                                  file_datetime_pattern=None,
                                  expected_time_step=None,
-                                 lsm_grid_info=None):
+                                 lsm_grid_info=None,
+                                 lsm_file_catalog=None):
     """
-    Determine the start and end date from LSM input files
+    Determine the start and end date from LSM input files.
+    If `lsm_file_catalog` is given, the time steps of each LSM file
+    are kept in the catalog so unchanged files are not opened again.
     """
     if lsm_grid_info is None:
         lsm_grid_info = identify_lsm_grid(lsm_file_list[0])
@@ -540,30 +1069,42 @@ def determine_start_end_timestep(lsm_file_list,
                               file_datetime_pattern) \
             + timedelta(seconds=(file_size_time-1) * time_step)
     else:
-        with pangaea.open_mfdataset(lsm_file_list,
-                                    lat_var=lsm_grid_info['latitude_var'],
-                                    lon_var=lsm_grid_info['longitude_var'],
-                                    time_var=lsm_grid_info['time_var'],
-                                    lat_dim=lsm_grid_info['latitude_dim'],
-                                    lon_dim=lsm_grid_info['longitude_dim'],
-                                    time_dim=lsm_grid_info['time_dim']) as xds:
-
-            datetime_arr = [pd.to_datetime(dval) for dval in
-                            xds.lsm.datetime.values]
-            actual_simulation_start_datetime = datetime_arr[0]
-            actual_simulation_end_datetime = datetime_arr[-1]
-            total_num_time_steps = len(datetime_arr)
-
-            if total_num_time_steps <= 1:
-                if expected_time_step is not None:
-                    time_step = int(expected_time_step)
-                else:
-                    raise ValueError("Only one LSM file with one timestep "
-                                     "present. 'expected_time_step' parameter "
-                                     "required to continue.")
+        lsm_file_times_list = []
+        for lsm_file in lsm_file_list:
+            lsm_file_times = None
+            if lsm_file_catalog is not None:
+                lsm_file_times = lsm_file_catalog.get_file_times(lsm_file)
+            if lsm_file_times is None:
+                lsm_file_times = \
+                    read_lsm_file_times(lsm_file,
+                                        lsm_grid_info['time_var'],
+                                        lsm_grid_info['time_dim'])
+                if lsm_file_catalog is not None:
+                    lsm_file_catalog.set_file_times(lsm_file,
+                                                    lsm_file_times)
+            lsm_file_times_list.append(lsm_file_times)
+
+        actual_simulation_start_datetime = lsm_file_times_list[0][1]
+        actual_simulation_end_datetime = lsm_file_times_list[-1][2]
+        total_num_time_steps = sum(lsm_file_times[0] for lsm_file_times
+                                   in lsm_file_times_list)
+
+        first_file_num_time_steps, first_file_start_datetime, \
+            first_file_end_datetime = lsm_file_times_list[0]
+        if total_num_time_steps <= 1:
+            if expected_time_step is not None:
+                time_step = int(expected_time_step)
             else:
-                time_step = int(np.diff(xds.lsm.datetime.values)[0]
-                                / np.timedelta64(1, 's'))
+                raise ValueError("Only one LSM file with one timestep "
+                                 "present. 'expected_time_step' parameter "
+                                 "required to continue.")
+        elif first_file_num_time_steps > 1:
+            time_step = int((first_file_end_datetime -
+                             first_file_start_datetime).total_seconds()
+                            / (first_file_num_time_steps - 1))
+        else:
+            time_step = int((lsm_file_times_list[1][1] -
+                             first_file_start_datetime).total_seconds())
 
     if expected_time_step is not None:
         if time_step != int(expected_time_step):
@@ -602,7 +1143,18 @@ def run_lsm_rapid_process(rapid_executable_location,
                           modeling_institution="US Army Engineer Research "
                                                "and Development Center",
                           convert_one_hour_to_three=False,
-                          expected_time_step=None):
+                          expected_time_step=None,
+                          inflow_processing_mode="serial",
+                          inflow_file_options=None,
+                          inflow_memory_budget=None,
+                          inflow_use_float32=False,
+                          combine_watershed_inflow=False,
+                          incremental_inflow=False,
+                          lsm_file_catalog_file=None,
+                          ensemble_processing_mode="serial",
+                          rapid_num_processors=None,
+                          resume=False,
+                          time_step_factor=None):
     # pylint: disable=anomalous-backslash-in-string
     """
     This is the main process to generate inflow for RAPID and to run RAPID.
@@ -679,10 +1231,87 @@ def run_lsm_rapid_process(rapid_executable_location,
     convert_one_hour_to_three: bool, optional
         If the time step is expected to be 1-hr it will convert to 3.
         Set to False if the LIS, NLDAS, or Joules grid time step is
-        greater than 1-hr.
+        greater than 1-hr. Same as a `time_step_factor` of 3 for the
+        LIS, NLDAS and Joules grids.
     expected_time_step: int, optional
         The time step in seconds of your LSM input data if only one file
         is given. Required if only one file is present.
+    inflow_processing_mode: str, optional
+        How the LSM files are converted to inflow. If 'serial', the files
+        are converted in this process. If 'process', the files are
+        converted by a pool of worker processes limited by the number of
+        processors and the available memory. The workers stage their
+        time slabs in temporary files and this process writes them to
+        the inflow file in time order, so the workers never wait on
+        a lock. Default is 'serial'.
+    inflow_file_options: dict, optional
+        Extra keyword arguments for
+        :meth:`~RAPIDpy.inflow.CreateInflowFileFromGriddedRunoff.generateOutputInflowFile`
+        to set the format, chunking and compression of the inflow file
+        (Ex. {'file_format': 'NETCDF4', 'zlib': True}).
+    inflow_memory_budget: int, optional
+        Approximate memory in bytes for each inflow conversion. If given,
+        LSM files with many time steps (Ex. monthly CMIP5 or LIS files)
+        are converted a few time steps at a time. In 'process' mode,
+        this also sets the memory per worker. Default is None.
+    inflow_use_float32: bool, optional
+        If True, the inflow is computed in single precision, which halves
+        the memory used. See
+        :meth:`~RAPIDpy.inflow.CreateInflowFileFromGriddedRunoff.execute`
+        for the error compared to double precision. Default is False.
+    combine_watershed_inflow: bool, optional
+        If True, each LSM file is read once for all of the watersheds in
+        `rapid_io_files_location` and the inflow of every watershed is
+        written in the same pass. The grid cells shared by the watersheds
+        are read once. With `resume` or `incremental_inflow`, only the
+        watersheds converting the same LSM files are combined. Default
+        is False.
+    incremental_inflow: bool, optional
+        If True, the inflow file is kept between runs and only new or
+        changed LSM files are converted. The inflow file name has the
+        start date only (Ex. m3_riv_bas_erai_t511_3hr_20030121.nc), its
+        time dimension is unlimited and is extended when new LSM files
+        arrive. A manifest file next to it records the path, modification
+        time and size of the LSM files in each time index. If the
+        simulation start, time step, weight table or inflow settings
+        change, the inflow file is generated again. Default is False.
+    lsm_file_catalog_file: str, optional
+        Path to a file to save the catalog of LSM files and their
+        datetimes in (see :class:`~RAPIDpy.inflow.lsm_file_catalog.LSMFileCatalog`).
+        On the next run, only the directories with added or removed
+        files are listed again. Default is None.
+    ensemble_processing_mode: str, optional
+        How the ensembles and watersheds are run. If 'serial', each
+        ensemble is run after the other. If 'parallel', the inflow
+        conversion and the RAPID run of each (ensemble, watershed) are
+        tasks that share the processors. Each task runs in its own
+        process when the processors it uses are free and its inflow is
+        ready. An inflow task uses one processor ('serial'
+        `inflow_processing_mode`) or all of them ('process'). A RAPID
+        task, with its postprocessing, uses `rapid_num_processors`.
+        Default is 'serial'.
+    rapid_num_processors: int, optional
+        The number of processors used by each RAPID run. Default is
+        all of the processors in 'serial' `ensemble_processing_mode`
+        and 1 in 'parallel' `ensemble_processing_mode`.
+    resume: bool, optional
+        If True, the steps of each watershed (inflow, RAPID with the CF
+        compliant output, return periods, seasonal averages and the
+        initialization files) whose output files are newer than their
+        inputs and match the run manifest are skipped. The run manifest
+        is in the output directory of the watershed (Ex.
+        run_manifest_erai_t511_3hr_20030121to20030122.json) and records
+        the path, modification time and size of the input and output
+        files and the settings of each step that finished. Default is
+        False.
+    time_step_factor: int, optional
+        Number of consecutive LSM time steps summed into each inflow
+        time step (Ex. 3 for 1 hourly LSM files and 3 hourly inflow or
+        8 for 3 hourly LSM files and daily inflow). It needs to be a
+        multiple or a divisor of the number of time steps in each LSM
+        file. The last LSM files are not used if they do not fill an
+        inflow time step. If None, `convert_one_hour_to_three` is used.
+        Default is None.
 
 
     Returns
@@ -760,6 +1389,21 @@ def run_lsm_rapid_process(rapid_executable_location,
     """  # noqa
     time_begin_all = datetime.utcnow()
 
+    if inflow_processing_mode not in ('serial', 'process'):
+        raise ValueError("Invalid inflow_processing_mode: {0}. Must be "
+                         "'serial' or 'process'."
+                         .format(inflow_processing_mode))
+    if ensemble_processing_mode not in ('serial', 'parallel'):
+        raise ValueError("Invalid ensemble_processing_mode: {0}. Must be "
+                         "'serial' or 'parallel'."
+                         .format(ensemble_processing_mode))
+    parallel_ensembles = ensemble_processing_mode == 'parallel'
+    if time_step_factor is not None and \
+            (int(time_step_factor) != time_step_factor or
+             time_step_factor < 1):
+        raise ValueError("Invalid time_step_factor: {0}. Must be a "
+                         "positive integer.".format(time_step_factor))
+
     # use all processors makes precedent over num_processors arg
     if use_all_processors is True:
         num_cpus = multiprocessing.cpu_count()
@@ -791,6 +1435,14 @@ def run_lsm_rapid_process(rapid_executable_location,
                          "'rapid_input_location' and 'rapid_output_location'"
                          " set to continue.")
 
+    lsm_file_catalog = LSMFileCatalog(lsm_data_location,
+                                      lsm_file_catalog_file)
+    lsm_file_catalog.refresh()
+
+    # the processors shared by the tasks in 'parallel' mode
+    total_num_cpus = num_cpus
+    task_list = []
+
     all_output_file_information = []
     for ensemble in ensemble_list:
         output_file_information = {
@@ -803,18 +1455,12 @@ def run_lsm_rapid_process(rapid_executable_location,
             ensemble_file_ending4 = "_{0}.nc4".format(ensemble)
 
         # get list of files
-        lsm_file_list = []
-        for walkdir_info in os.walk(lsm_data_location,
-                                    followlinks=True):
-            for lsm_file in walkdir_info[2]:
-                if lsm_file.endswith(ensemble_file_ending) or \
-                        lsm_file.endswith(ensemble_file_ending4):
-                    lsm_file_list.append(
-                        os.path.join(walkdir_info[0], lsm_file))
-        lsm_file_list = sorted(lsm_file_list)
+        lsm_file_list = lsm_file_catalog.get_file_list(
+            (ensemble_file_ending, ensemble_file_ending4))
 
         # IDENTIFY THE GRID
-        lsm_file_data = identify_lsm_grid(lsm_file_list[0])
+        lsm_file_data = identify_lsm_grid(lsm_file_list[0],
+                                          lsm_file_catalog)
 
         # load in the datetime pattern
         if file_datetime_pattern is None or file_datetime_re_pattern is None:
@@ -828,18 +1474,12 @@ def run_lsm_rapid_process(rapid_executable_location,
         # get subset based on time bounds
         if simulation_start_datetime is not None:
             print("Filtering files by datetime ...")
-            lsm_file_list_subset = []
-            for lsm_file in lsm_file_list:
-                match = file_re_match.search(lsm_file)
-                print(match.group(0))
-                file_date = datetime.strptime(match.group(0),
-                                              file_datetime_pattern)
-                if file_date > simulation_end_datetime:
-                    break
-                if file_date >= simulation_start_datetime:
-                    lsm_file_list_subset.append(lsm_file)
-
-            lsm_file_list = sorted(lsm_file_list_subset)
+            lsm_file_list = lsm_file_catalog.filter_by_datetime(
+                lsm_file_list,
+                file_re_match,
+                file_datetime_pattern,
+                simulation_start_datetime,
+                simulation_end_datetime)
         print("Running from {0} to {1}".format(lsm_file_list[0],
                                                lsm_file_list[-1]))
 
@@ -851,18 +1491,47 @@ def run_lsm_rapid_process(rapid_executable_location,
                 file_re_match=file_re_match,
                 file_datetime_pattern=file_datetime_pattern,
                 expected_time_step=expected_time_step,
-                lsm_grid_info=lsm_file_data)
+                lsm_grid_info=lsm_file_data,
+                lsm_file_catalog=lsm_file_catalog)
 
-        # VALIDATING INPUT IF DIVIDING BY 3
-        if (lsm_file_data['grid_type'] in ('nldas', 'lis', 'joules')) \
-                and convert_one_hour_to_three:
-            num_extra_files = total_num_time_steps % 3
+        # sum the LSM time steps into the inflow time steps
+        inflow_time_step_factor = time_step_factor
+        if inflow_time_step_factor is None:
+            inflow_time_step_factor = 1
+            if (lsm_file_data['grid_type'] in ('nldas', 'lis', 'joules')) \
+                    and convert_one_hour_to_three:
+                inflow_time_step_factor = 3
+        inflow_time_step_factor = int(inflow_time_step_factor)
+        lsm_files_per_window = 1
+        if inflow_time_step_factor > 1:
+            file_num_time_steps = \
+                int(total_num_time_steps) // len(lsm_file_list)
+            if inflow_time_step_factor % file_num_time_steps == 0:
+                lsm_files_per_window = \
+                    inflow_time_step_factor // file_num_time_steps
+            elif file_num_time_steps % inflow_time_step_factor != 0:
+                raise ValueError("The time_step_factor ({0}) needs to be "
+                                 "a multiple or a divisor of the number of "
+                                 "time steps in each LSM file ({1}) ..."
+                                 .format(inflow_time_step_factor,
+                                         file_num_time_steps))
+            # the last inflow time step needs all of its LSM files
+            num_extra_files = len(lsm_file_list) % lsm_files_per_window
             if num_extra_files != 0:
-                print("WARNING: Number of files needs to be divisible by 3. "
-                      "Remainder is {0}".format(num_extra_files))
-                print("This means your simulation will be truncated")
-            total_num_time_steps /= 3
-            time_step *= 3
+                print("WARNING: The last {0} LSM file(s) do not fill an "
+                      "inflow time step of {1} LSM time steps and are not "
+                      "used ...".format(num_extra_files,
+                                        inflow_time_step_factor))
+                lsm_file_list = lsm_file_list[:-num_extra_files]
+                if not lsm_file_list:
+                    raise Exception("ERROR: Not enough LSM files for an "
+                                    "inflow time step ...")
+                actual_simulation_end_datetime -= timedelta(
+                    seconds=num_extra_files * file_num_time_steps *
+                    time_step)
+            total_num_time_steps = len(lsm_file_list) * \
+                file_num_time_steps // inflow_time_step_factor
+            time_step *= inflow_time_step_factor
 
         # compile the file ending
         out_file_ending = "{0}_{1}_{2}hr_{3:%Y%m%d}to{4:%Y%m%d}{5}"\
@@ -873,7 +1542,25 @@ def run_lsm_rapid_process(rapid_executable_location,
                     actual_simulation_end_datetime,
                     ensemble_file_ending)
 
-        # run LSM processes
+        if len(lsm_file_list) < num_cpus:
+            num_cpus = len(lsm_file_list)
+
+        inflow_file_ending = out_file_ending
+        if incremental_inflow:
+            inflow_file_ending = "{0}_{1}_{2}hr_{3:%Y%m%d}{4}"\
+                .format(lsm_file_data['model_name'],
+                        lsm_file_data['grid_type'],
+                        int(time_step/3600),
+                        actual_simulation_start_datetime,
+                        ensemble_file_ending)
+        lsm_file_signature_list = [get_lsm_file_signature(lsm_file)
+                                   for lsm_file in lsm_file_list]
+        # the LSM files are part of the inflow stage settings
+        lsm_file_digest = hashlib.sha1(
+            json.dumps(lsm_file_signature_list).encode('utf-8')).hexdigest()
+
+        # create the inflow files
+        watershed_list = []
         for master_watershed_input_directory, \
                 master_watershed_output_directory in rapid_directories:
             print("Running from: {0}".format(master_watershed_input_directory))
@@ -885,7 +1572,7 @@ def run_lsm_rapid_process(rapid_executable_location,
             # create inflow to dump data into
             master_rapid_runoff_file = \
                 os.path.join(master_watershed_output_directory,
-                             'm3_riv_bas_{0}'.format(out_file_ending))
+                             'm3_riv_bas_{0}'.format(inflow_file_ending))
 
             weight_table_file = \
                 case_insensitive_file_search(master_watershed_input_directory,
@@ -900,69 +1587,179 @@ def run_lsm_rapid_process(rapid_executable_location,
                 print("WARNING: comid_lat_lon_z file not found."
                       " The lat/lon will not be added ...")
 
-            print("Writing inflow file to: {0}"
-                  .format(master_rapid_runoff_file))
-            lsm_file_data['rapid_inflow_tool'].generateOutputInflowFile(
-                out_nc=master_rapid_runoff_file,
-                start_datetime_utc=actual_simulation_start_datetime,
-                number_of_timesteps=total_num_time_steps,
-                simulation_time_step_seconds=time_step,
-                in_rapid_connect_file=case_insensitive_file_search(
-                    master_watershed_input_directory,
-                    r'rapid_connect\.csv'),
-                in_rivid_lat_lon_z_file=in_rivid_lat_lon_z_file,
-                land_surface_model_description=lsm_file_data['description'],
-                modeling_institution=modeling_institution
-            )
-
-            job_combinations = []
-            if (lsm_file_data['grid_type'] in ('nldas', 'lis', 'joules')) \
-                    and convert_one_hour_to_three:
-                print("Grouping {0} in threes"
-                      .format(lsm_file_data['grid_type']))
-                lsm_file_list = [lsm_file_list[nldas_index:nldas_index+3]
-                                 for nldas_index in
-                                 range(0, len(lsm_file_list), 3)
-                                 if len(lsm_file_list[
-                                        nldas_index:nldas_index+3]) == 3]
-
-            if len(lsm_file_list) < num_cpus:
-                num_cpus = len(lsm_file_list)
-            # pylint: disable=no-member
-            mp_lock = multiprocessing.Manager().Lock()
-            partition_list, partition_index_list = \
-                partition(lsm_file_list, num_cpus)
-
-            for loop_index, cpu_grouped_file_list in enumerate(partition_list):
-                if cpu_grouped_file_list and partition_index_list[loop_index]:
-                    job_combinations.append((
-                        cpu_grouped_file_list,
-                        partition_index_list[loop_index],
-                        weight_table_file,
-                        lsm_file_data['grid_type'],
+            in_rapid_connect_file = case_insensitive_file_search(
+                master_watershed_input_directory,
+                r'rapid_connect\.csv')
+
+            run_manifest_file = os.path.join(
+                master_watershed_output_directory,
+                'run_manifest_{0}.json'.format(out_file_ending[:-3]))
+            inflow_input_files = [weight_table_file, in_rapid_connect_file]
+            if in_rivid_lat_lon_z_file:
+                inflow_input_files.append(in_rivid_lat_lon_z_file)
+            inflow_stage = {
+                'name': 'inflow',
+                'inputs': inflow_input_files,
+                'outputs': [master_rapid_runoff_file],
+                'parameters': {
+                    'lsm_files': lsm_file_digest,
+                    'start_datetime': "{0:%Y%m%d%H%M%S}".format(
+                        actual_simulation_start_datetime),
+                    'time_step': int(time_step),
+                    'number_of_timesteps': int(total_num_time_steps),
+                    'inflow_file_options': inflow_file_options or {},
+                    'inflow_use_float32': inflow_use_float32,
+                    'incremental_inflow': incremental_inflow,
+                    'time_step_factor': inflow_time_step_factor,
+                },
+            }
+
+            lsm_file_index_list = None
+            manifest_header = None
+            if resume and is_stage_up_to_date(
+                    inflow_stage, read_run_manifest(run_manifest_file)):
+                print("Skipping up to date stage: inflow")
+                lsm_file_index_list = []
+            else:
+                if incremental_inflow:
+                    manifest_header = {
+                        'start_datetime': "{0:%Y%m%d%H%M%S}".format(
+                            actual_simulation_start_datetime),
+                        'time_step': int(time_step),
+                        'grid_type': lsm_file_data['grid_type'],
+                        'weight_table':
+                            get_file_signature(weight_table_file),
+                        'rapid_connect':
+                            get_file_signature(in_rapid_connect_file),
+                        'inflow_file_options': inflow_file_options or {},
+                        'inflow_use_float32': inflow_use_float32,
+                        'time_step_factor': inflow_time_step_factor,
+                    }
+                    lsm_file_index_list = get_stale_inflow_indices(
                         master_rapid_runoff_file,
-                        lsm_file_data['rapid_inflow_tool'],
-                        mp_lock))
-#                   # COMMENTED CODE IS FOR DEBUGGING
-                    generate_inflows_from_runoff((
-                      cpu_grouped_file_list,
-                      partition_index_list[loop_index],
-                      weight_table_file,
-                      lsm_file_data['grid_type'],
-                      master_rapid_runoff_file,
-                      lsm_file_data['rapid_inflow_tool'],
-                      mp_lock))
-            # pool = multiprocessing.Pool(num_cpus)
-            # pool.map(generate_inflows_from_runoff,
-            #          job_combinations)
-            # pool.close()
-            # pool.join()
-
+                        manifest_header,
+                        lsm_file_signature_list)
+                    # convert every LSM file of the inflow time steps
+                    if lsm_file_index_list and lsm_files_per_window > 1:
+                        lsm_file_index_list = sorted(set(
+                            file_index - file_index % lsm_files_per_window +
+                            file_offset
+                            for file_index in lsm_file_index_list
+                            for file_offset in range(lsm_files_per_window)))
+
+                if lsm_file_index_list is None:
+                    print("Writing inflow file to: {0}"
+                          .format(master_rapid_runoff_file))
+                    rapid_inflow_tool = lsm_file_data['rapid_inflow_tool']
+                    rapid_inflow_tool.generateOutputInflowFile(
+                        out_nc=master_rapid_runoff_file,
+                        start_datetime_utc=actual_simulation_start_datetime,
+                        number_of_timesteps=total_num_time_steps,
+                        simulation_time_step_seconds=time_step,
+                        in_rapid_connect_file=in_rapid_connect_file,
+                        in_rivid_lat_lon_z_file=in_rivid_lat_lon_z_file,
+                        land_surface_model_description=lsm_file_data[
+                            'description'],
+                        modeling_institution=modeling_institution,
+                        unlimited_time=incremental_inflow,
+                        **(inflow_file_options or {})
+                    )
+                    lsm_file_index_list = list(range(len(lsm_file_list)))
+                else:
+                    print("Updating inflow file: {0}"
+                          .format(master_rapid_runoff_file))
+                    rapid_inflow_tool = lsm_file_data['rapid_inflow_tool']
+                    # the conversion factor of runoff rates
+                    # depends on the time step
+                    rapid_inflow_tool.simulation_time_step_seconds = \
+                        time_step
+                    rapid_inflow_tool.extend_inflow_time(
+                        master_rapid_runoff_file, int(total_num_time_steps))
+            watershed_list.append((master_watershed_input_directory,
+                                   master_watershed_output_directory,
+                                   master_rapid_runoff_file,
+                                   weight_table_file,
+                                   in_rivid_lat_lon_z_file,
+                                   lsm_file_index_list,
+                                   manifest_header,
+                                   (run_manifest_file, inflow_stage)))
+
+        # generate the inflow
+        inflow_execute_options = {
+            'memory_budget': inflow_memory_budget,
+            'use_float32': inflow_use_float32,
+            'time_step_factor': inflow_time_step_factor,
+        }
+        if combine_watershed_inflow:
+            # only the watersheds converting the same LSM files are
+            # combined so the up to date inflow of the other
+            # watersheds is not written again
+            watershed_groups = []
+            group_file_indices = []
+            for watershed in watershed_list:
+                if watershed[5] in group_file_indices:
+                    watershed_groups[group_file_indices.index(
+                        watershed[5])].append(watershed)
+                else:
+                    group_file_indices.append(watershed[5])
+                    watershed_groups.append([watershed])
+        else:
+            watershed_groups = [[watershed] for watershed in watershed_list]
+        inflow_task_names = {}
+        for watershed_group in watershed_groups:
+            weight_table_file = [watershed[3] for watershed
+                                 in watershed_group]
+            master_rapid_runoff_file = [watershed[2] for watershed
+                                        in watershed_group]
+            if not combine_watershed_inflow:
+                weight_table_file = weight_table_file[0]
+                master_rapid_runoff_file = master_rapid_runoff_file[0]
+            inflow_job = (
+                lsm_file_list,
+                watershed_group[0][5],
+                weight_table_file,
+                lsm_file_data['grid_type'],
+                master_rapid_runoff_file,
+                lsm_file_data['rapid_inflow_tool'],
+                num_cpus,
+                inflow_processing_mode,
+                inflow_execute_options,
+                watershed_group[0][1],
+                [(watershed[2], watershed[6], lsm_file_signature_list)
+                 for watershed in watershed_group
+                 if watershed[6] is not None],
+                [watershed[7] for watershed in watershed_group],
+                lsm_files_per_window)
+            if not parallel_ensembles or not inflow_job[1]:
+                run_inflow_job(*inflow_job)
+            else:
+                inflow_task_name = ('inflow', ensemble, watershed_group[0][0])
+                inflow_task_cpus = total_num_cpus
+                if inflow_processing_mode == 'serial':
+                    inflow_task_cpus = 1
+                task_list.append({
+                    'name': inflow_task_name,
+                    'function': run_inflow_job,
+                    'args': inflow_job,
+                    'cpus': inflow_task_cpus,
+                })
+                for watershed in watershed_group:
+                    inflow_task_names[watershed[0]] = inflow_task_name
+
+        # run RAPID for each watershed
+        rapid_num_cpus = rapid_num_processors
+        if rapid_num_cpus is None:
+            rapid_num_cpus = 1 if parallel_ensembles else num_cpus
+        for master_watershed_input_directory, \
+                master_watershed_output_directory, \
+                master_rapid_runoff_file, _, \
+                in_rivid_lat_lon_z_file, _, _, \
+                (run_manifest_file, _) in watershed_list:
             # set up RAPID manager
             rapid_manager = RAPID(
                 rapid_executable_location=rapid_executable_location,
                 cygwin_bin_location=cygwin_bin_location,
-                num_processors=num_cpus,
+                num_processors=rapid_num_cpus,
                 mpiexec_command=mpiexec_command,
                 ZS_TauR=time_step,
                 ZS_dtR=15 * 60,
@@ -1010,64 +1807,52 @@ def run_lsm_rapid_process(rapid_executable_location,
                                  "rapid_namelist_{}"
                                  .format(out_file_ending[:-3])))
             if run_rapid_simulation:
-                rapid_manager.run()
-
-                rapid_manager.make_output_cf_compliant(
-                    simulation_start_datetime=actual_simulation_start_datetime,
-                    comid_lat_lon_z_file=in_rivid_lat_lon_z_file,
-                    project_name="{0} Based Historical flows by {1}"
-                                 .format(lsm_file_data['description'],
-                                         modeling_institution)
-                )
-
-                # generate return periods
-                if generate_return_periods_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    return_periods_file = os.path.join(
-                        master_watershed_output_directory,
-                        'return_periods_{0}'.format(out_file_ending))
-                    # assume storm has 3 day length
-                    storm_length_days = 3
-                    generate_return_periods(
-                        qout_file=lsm_rapid_output_file,
-                        return_period_file=return_periods_file,
-                        num_cpus=num_cpus,
-                        storm_duration_days=storm_length_days,
-                        method=return_period_method)
-
-                # generate seasonal averages file
-                if generate_seasonal_averages_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    seasonal_averages_file = os.path.join(
-                        master_watershed_output_directory,
-                        'seasonal_averages_{0}'.format(out_file_ending))
-                    generate_seasonal_averages(lsm_rapid_output_file,
-                                               seasonal_averages_file,
-                                               num_cpus)
-
-                # generate seasonal initialization file
-                if generate_seasonal_initialization_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    seasonal_qinit_file = os.path.join(
-                        master_watershed_input_directory,
-                        'seasonal_qinit_{0}.csv'.format(out_file_ending[:-3]))
-                    rapid_manager.generate_seasonal_intitialization(
-                        seasonal_qinit_file)
-
-                # generate initialization file
-                if generate_initialization_file and \
-                        os.path.exists(lsm_rapid_output_file) and \
-                        lsm_rapid_output_file:
-                    qinit_file = os.path.join(
-                        master_watershed_input_directory,
-                        'qinit_{0}.csv'.format(out_file_ending[:-3]))
-                    rapid_manager.generate_qinit_from_past_qout(qinit_file)
+                rapid_job = (
+                    rapid_manager,
+                    master_watershed_input_directory,
+                    master_watershed_output_directory,
+                    lsm_rapid_output_file,
+                    in_rivid_lat_lon_z_file,
+                    out_file_ending,
+                    actual_simulation_start_datetime,
+                    "{0} Based Historical flows by {1}"
+                    .format(lsm_file_data['description'],
+                            modeling_institution),
+                    rapid_num_cpus,
+                    generate_return_periods_file,
+                    return_period_method,
+                    generate_seasonal_averages_file,
+                    generate_seasonal_initialization_file,
+                    generate_initialization_file,
+                    run_manifest_file,
+                    resume)
+                if parallel_ensembles:
+                    depends_on = []
+                    if master_watershed_input_directory in \
+                            inflow_task_names:
+                        depends_on.append(inflow_task_names[
+                            master_watershed_input_directory])
+                    task_list.append({
+                        'name': ('rapid', ensemble,
+                                 master_watershed_input_directory),
+                        'function': run_rapid_watershed,
+                        'args': rapid_job + (
+                            master_watershed_output_directory,),
+                        'cpus': rapid_num_cpus,
+                        'depends_on': depends_on,
+                    })
+                else:
+                    run_rapid_watershed(*rapid_job)
 
         all_output_file_information.append(output_file_information)
 
+    lsm_file_catalog.save()
+
+    if task_list:
+        print("Running {0} tasks on {1} processors ..."
+              .format(len(task_list), total_num_cpus))
+        run_tasks(task_list, total_num_cpus)
+
     # print info to user
     time_end = datetime.utcnow()
     print("Time Begin All: {0}".format(time_begin_all))
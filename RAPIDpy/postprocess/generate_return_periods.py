@@ -10,6 +10,7 @@ from datetime import datetime
 import multiprocessing
 from netCDF4 import Dataset
 import numpy as np
+import pandas as pd
 
 # local
 from ..dataset import RAPIDDataset
@@ -17,6 +18,22 @@ from ..helper_functions import add_latlon_metadata, log
 from ..utilities import partition
 
 
+def _iter_filtered_flow(qout_nc_file, rivid_index_list, step):
+    """
+    Reads the flow of the reaches a block at a time and yields the
+    maximum flow of each `step` days for each reach.
+    """
+    time_array = qout_nc_file.get_time_array(return_datetime=True)
+    for rivid_index_block, streamflow_block in \
+            qout_nc_file.iter_qout_blocks(river_index_array=rivid_index_list):
+        filtered_flow_block = \
+            pd.DataFrame(streamflow_block.T, index=time_array) \
+            .resample("{0}D".format(step)).max().values.T
+        for rivid_index, filtered_flow_data in \
+                zip(rivid_index_block, filtered_flow_block):
+            yield rivid_index, filtered_flow_data
+
+
 def generate_single_return_period(args):
     """
     This function calculates a single return period for a single reach
@@ -70,11 +87,8 @@ def generate_single_return_period(args):
         max_flow_array = np.zeros(len(rivid_index_list))
 
         # iterate through rivids to generate return periods
-        for iter_idx, rivid_index in enumerate(rivid_index_list):
-            filtered_flow_data = qout_nc_file.get_qout_index(
-                rivid_index,
-                pd_filter="{0}D".format(step),
-                filter_mode="max")
+        for iter_idx, (rivid_index, filtered_flow_data) in enumerate(
+                _iter_filtered_flow(qout_nc_file, rivid_index_list, step)):
             sorted_flow_data = np.sort(filtered_flow_data)[:num_years:-1]
             max_flow = sorted_flow_data[0]
             if max_flow < 0.01:
@@ -46,12 +46,20 @@ def generate_single_seasonal_average(args):
         if not time_indices:
             raise IndexError("No time steps found within range ...")
 
-        streamflow_array = qout_nc_file.get_qout(time_index_array=time_indices)
-
-    avg_streamflow_array = np.mean(streamflow_array, axis=1)
-    std_streamflow_array = np.std(streamflow_array, axis=1)
-    max_streamflow_array = np.amax(streamflow_array, axis=1)
-    min_streamflow_array = np.min(streamflow_array, axis=1)
+        avg_streamflow_array = np.zeros(qout_nc_file.size_river_id)
+        std_streamflow_array = np.zeros(qout_nc_file.size_river_id)
+        max_streamflow_array = np.zeros(qout_nc_file.size_river_id)
+        min_streamflow_array = np.zeros(qout_nc_file.size_river_id)
+        for river_indices, streamflow_array in \
+                qout_nc_file.iter_qout_blocks(time_index_array=time_indices):
+            avg_streamflow_array[river_indices] = \
+                np.mean(streamflow_array, axis=1)
+            std_streamflow_array[river_indices] = \
+                np.std(streamflow_array, axis=1)
+            max_streamflow_array[river_indices] = \
+                np.amax(streamflow_array, axis=1)
+            min_streamflow_array[river_indices] = \
+                np.min(streamflow_array, axis=1)
 
     mp_lock.acquire()
     seasonal_avg_nc = Dataset(seasonal_average_file, 'a')
@@ -959,8 +959,12 @@ class RAPID(object):
             log("Extracting data ...",
                 "INFO")
 
-            streamflow_array = \
-                qout_hist_nc.get_qout(time_index_array=time_indices)
+            mean_flow_array = np.zeros(qout_hist_nc.size_river_id)
+            for river_indices, streamflow_array in \
+                    qout_hist_nc.iter_qout_blocks(
+                        time_index_array=time_indices):
+                mean_flow_array[river_indices] = \
+                    np.mean(streamflow_array, axis=1)
 
             log("Reordering data...",
                 "INFO")
@@ -973,7 +977,7 @@ class RAPID(object):
                 try:
                     data_index = np.where(stream_id_array == riv_bas_id)[0][0]
                     init_flows_array[data_index] = \
-                        np.mean(streamflow_array[riv_bas_index])
+                        mean_flow_array[riv_bas_index]
                 except IndexError:
                     log('riv_bas_id {0} not found in connectivity list.'
                         .format(riv_bas_id),
@@ -6,8 +6,14 @@
    Created by Alan D. Snow, 2016.
    License BSD-3-Clause
 """
+import json
+from multiprocessing import Process, Queue as ProcessQueue
 import os
+from queue import Empty, Full, Queue
 import re
+from threading import Event, Thread
+import time
+import traceback
 
 from past.builtins import xrange  # pylint: disable=redefined-builtin
 
@@ -50,3 +56,344 @@ def get_valid_directory_list(input_directory):
         else:
             print("{0} not a directory. Skipping ...".format(directory))
     return valid_input_directories
+
+
+def get_available_memory():
+    """
+    Get the memory available to start new processes in bytes.
+    Returns None if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def prefetch(function, argument_list, depth):
+    """
+    Calls `function` with each entry of `argument_list` in a background
+    thread and yields the results in order. At most `depth` results
+    are read ahead of the consumer, which bounds the memory used.
+    If `depth` is less than 1, the calls are made in this thread.
+
+    Exceptions raised in the background thread are raised again
+    when the result would have been yielded.
+    """
+    return prefetch_iterator((function(*arguments)
+                              for arguments in argument_list), depth)
+
+
+def prefetch_iterator(iterator, depth):
+    """
+    Like :func:`prefetch`, but the results are read ahead from
+    `iterator`. If it is a generator, it is closed in the background
+    thread when the consumer stops early.
+    """
+    if depth < 1:
+        try:
+            for result in iterator:
+                yield result
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+        return
+
+    result_queue = Queue(maxsize=depth)
+    stop_event = Event()
+
+    def _put(result):
+        while not stop_event.is_set():
+            try:
+                result_queue.put(result, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _read_ahead():
+        try:
+            for result in iterator:
+                _put((True, result))
+                if stop_event.is_set():
+                    return
+            _put((None, None))
+        except Exception as ex:  # pylint: disable=broad-except
+            _put((False, ex))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    read_thread = Thread(target=_read_ahead)
+    read_thread.daemon = True
+    read_thread.start()
+    try:
+        while True:
+            success, result = result_queue.get()
+            if success is None:
+                return
+            if not success:
+                raise result
+            yield result
+    finally:
+        stop_event.set()
+        read_thread.join()
+
+
+def _run_task_process(task_name, function, args, error_queue):
+    """
+    Runs a task in a child process of :func:`run_tasks` and sends the
+    formatted traceback of a failure back to the parent.
+    """
+    try:
+        function(*args)
+    except Exception:
+        error_queue.put((task_name, traceback.format_exc()))
+        raise
+
+
+def run_tasks(task_list, num_cpus, poll_interval=0.1,
+              finished_callback=None):
+    """
+    Runs each task in its own process while the CPUs declared by the
+    running tasks stay within `num_cpus`. The tasks are started in the
+    order of `task_list` once the tasks they depend on are done. If a
+    task does not fit, later tasks that fit are started first, so all
+    of the CPUs are kept busy. A task that has no other task to run
+    alongside it runs in this process.
+
+    Parameters
+    ----------
+    task_list: list
+        A dict for each task with 'name', 'function', 'args', 'cpus'
+        (the number of CPUs used by the task) and optionally
+        'depends_on' (the names of the tasks to wait for).
+    num_cpus: int
+        The number of CPUs shared by the tasks. A task declaring more
+        CPUs than this runs alone.
+    poll_interval: float, optional
+        Seconds to wait between checks for finished tasks.
+    finished_callback: function, optional
+        Called in this process with the name of each task that succeeds.
+
+    Raises
+    ------
+    Exception:
+        If a task fails. The running tasks are finished and the
+        tasks that were not started are skipped. The message has the
+        tracebacks of the tasks that failed in a child process. A task
+        run in this process raises its own exception.
+    """
+    pending_task_list = list(task_list)
+    running_tasks = {}
+    finished_task_names = set()
+    failed_task_names = []
+    task_tracebacks = {}
+    error_queue = ProcessQueue()
+    free_cpus = num_cpus
+    while pending_task_list or running_tasks:
+        while True:
+            try:
+                task_name, task_traceback = error_queue.get_nowait()
+            except Empty:
+                break
+            task_tracebacks[task_name] = task_traceback
+        for task_name, (task_process, task_cpus) in \
+                list(running_tasks.items()):
+            if task_process.is_alive():
+                continue
+            task_process.join()
+            del running_tasks[task_name]
+            free_cpus += task_cpus
+            if task_process.exitcode == 0:
+                finished_task_names.add(task_name)
+                if finished_callback is not None:
+                    finished_callback(task_name)
+            else:
+                failed_task_names.append(task_name)
+        if failed_task_names:
+            pending_task_list = []
+
+        ready_task_list = [task for task in pending_task_list
+                           if finished_task_names.issuperset(
+                               task.get('depends_on', ()))]
+        if len(ready_task_list) == 1 and not running_tasks:
+            task = ready_task_list[0]
+            pending_task_list.remove(task)
+            task['function'](*task['args'])
+            finished_task_names.add(task['name'])
+            if finished_callback is not None:
+                finished_callback(task['name'])
+            continue
+
+        task_started = False
+        for task in ready_task_list:
+            task_cpus = max(1, min(task['cpus'], num_cpus))
+            if task_cpus > free_cpus:
+                continue
+            task_process = Process(target=_run_task_process,
+                                   args=(task['name'], task['function'],
+                                         task['args'], error_queue))
+            task_process.start()
+            running_tasks[task['name']] = (task_process, task_cpus)
+            free_cpus -= task_cpus
+            pending_task_list.remove(task)
+            task_started = True
+
+        if not task_started and running_tasks:
+            time.sleep(poll_interval)
+        elif pending_task_list and not running_tasks:
+            raise ValueError("Tasks depend on tasks that are not in the "
+                             "task list: {0}"
+                             .format([task['name'] for task
+                                      in pending_task_list]))
+
+    if failed_task_names:
+        while len(task_tracebacks) < len(failed_task_names):
+            try:
+                task_name, task_traceback = error_queue.get(timeout=1)
+            except Empty:
+                # the process exited without an exception
+                break
+            task_tracebacks[task_name] = task_traceback
+        failure_messages = [
+            "{0}:\n{1}".format(task_name,
+                               task_tracebacks.get(task_name,
+                                                   "No traceback.\n"))
+            for task_name in failed_task_names]
+        raise Exception("Tasks failed: {0}\n{1}"
+                        .format(failed_task_names,
+                                "\n".join(failure_messages)))
+
+
+# -----------------------------------------------------------------------------
+# PIPELINE FUNCTIONS
+# -----------------------------------------------------------------------------
+RUN_MANIFEST_VERSION = 1
+
+
+def get_file_signature(file_path):
+    """
+    Returns the path, modification time and size of a file. A file
+    with a different signature is assumed to have changed.
+    """
+    file_stat = os.stat(file_path)
+    return [os.path.abspath(file_path),
+            float(file_stat.st_mtime),
+            int(file_stat.st_size)]
+
+
+def _get_stage_record(stage):
+    """
+    Returns the signatures of the inputs and outputs of a pipeline
+    stage and its parameters as they are stored in the run manifest.
+    """
+    return json.loads(json.dumps({
+        'inputs': [get_file_signature(input_file)
+                   for input_file in stage.get('inputs', ())],
+        'outputs': [get_file_signature(output_file)
+                    for output_file in stage.get('outputs', ())],
+        'parameters': stage.get('parameters'),
+    }))
+
+
+def read_run_manifest(run_manifest_file):
+    """
+    Returns the records of the finished stages in the run manifest
+    by stage name. If the manifest is missing or invalid, no stages
+    are returned.
+    """
+    try:
+        with open(run_manifest_file) as manifest_in:
+            run_manifest = json.load(manifest_in)
+        if run_manifest['version'] != RUN_MANIFEST_VERSION:
+            return {}
+        return dict(run_manifest['stages'])
+    except (IOError, OSError, KeyError, TypeError, ValueError):
+        return {}
+
+
+def record_pipeline_stage(run_manifest_file, stage):
+    """
+    Records a finished stage in the run manifest. The manifest is written
+    to a temporary name and moved into place so other processes never
+    read a partial manifest.
+    """
+    stage_records = read_run_manifest(run_manifest_file)
+    stage_records[stage['name']] = _get_stage_record(stage)
+    tmp_manifest_file = "{0}.{1}.tmp".format(run_manifest_file, os.getpid())
+    with open(tmp_manifest_file, 'w') as manifest_out:
+        json.dump({'version': RUN_MANIFEST_VERSION,
+                   'stages': stage_records},
+                  manifest_out)
+    getattr(os, 'replace', os.rename)(tmp_manifest_file, run_manifest_file)
+
+
+def is_stage_up_to_date(stage, stage_records):
+    """
+    Checks that the outputs of the stage exist and are newer than its
+    inputs and that the inputs, outputs and parameters match the record
+    of the stage in the run manifest (see :func:`read_run_manifest`).
+    """
+    stage_record = stage_records.get(stage['name'])
+    output_files = stage.get('outputs', ())
+    if stage_record is None or not output_files:
+        return False
+    try:
+        current_record = _get_stage_record(stage)
+    except OSError:
+        # an input or output is missing
+        return False
+    if current_record != stage_record:
+        return False
+    newest_input_time = max([input_signature[1] for input_signature
+                             in current_record['inputs']] or [0])
+    return min(output_signature[1] for output_signature
+               in current_record['outputs']) >= newest_input_time
+
+
+def run_pipeline(stage_list, run_manifest_file, num_cpus, resume=True):
+    """
+    Runs the stages of a pipeline with :func:`run_tasks` and records each
+    finished stage in the run manifest. Stages that do not depend on
+    each other run at the same time.
+
+    Parameters
+    ----------
+    stage_list: list
+        The stages in the order they depend on each other. Each stage is
+        a task for :func:`run_tasks` with the input and output file paths
+        in 'inputs' and 'outputs' and JSON compatible 'parameters'.
+    run_manifest_file: str
+        Path to the run manifest.
+    num_cpus: int
+        The number of CPUs shared by the stages.
+    resume: bool, optional
+        If True, the stages that are up to date (see
+        :func:`is_stage_up_to_date`) and do not depend on a stage that
+        runs are skipped. Default is True.
+    """
+    stage_records = {}
+    if resume:
+        stage_records = read_run_manifest(run_manifest_file)
+
+    stage_dict = {}
+    task_list = []
+    for stage in stage_list:
+        depends_on = [stage_name for stage_name
+                      in stage.get('depends_on', ())
+                      if stage_name in stage_dict]
+        if not depends_on and is_stage_up_to_date(stage, stage_records):
+            print("Skipping up to date stage: {0}".format(stage['name']))
+            continue
+        stage_dict[stage['name']] = stage
+        task_list.append(dict(stage, depends_on=depends_on))
+
+    run_tasks(task_list, num_cpus,
+              finished_callback=lambda stage_name: record_pipeline_stage(
+                  run_manifest_file, stage_dict[stage_name]))
@@ -25,11 +25,11 @@ setup(
         'numpy',
         'netcdf4',
         'pandas',
-        'pangaea',
         'python-dateutil',
         'pytz',
         'requests',
         'rtree',
+        'scipy',
         'shapely',
     ],
     classifiers=[
@@ -15,18 +15,28 @@ from numpy.testing import assert_almost_equal
 import numpy as np
 import os
 from past.builtins import xrange
+import pickle
+import re
 import pytest
+from scipy.sparse import csr_matrix
 from shutil import copy, copytree, rmtree
 import unittest
 
 # local import
 from RAPIDpy.inflow import run_lsm_rapid_process
+from RAPIDpy.inflow.lsm_rapid_process import (determine_start_end_timestep,
+                                              get_num_inflow_workers,
+                                              identify_lsm_grid,
+                                              read_lsm_file_header)
 from RAPIDpy.inflow.CreateInflowFileFromERAInterimRunoff import CreateInflowFileFromERAInterimRunoff
+from RAPIDpy.inflow.CreateInflowFileFromGriddedRunoff import WeightTableError
+from RAPIDpy.inflow.lsm_file_catalog import LSMFileCatalog
 from RAPIDpy.inflow.CreateInflowFileFromLDASRunoff import CreateInflowFileFromLDASRunoff
 from RAPIDpy.inflow.CreateInflowFileFromWRFHydroRunoff import CreateInflowFileFromWRFHydroRunoff
 
 from RAPIDpy.helper_functions import (compare_csv_decimal_files,
                                       remove_files)
+from RAPIDpy.utilities import get_available_memory
 
 MAIN_TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 RAPID_EXE_PATH = os.path.join(MAIN_TESTS_FOLDER,
@@ -80,6 +90,17 @@ class TestRAPIDInflow(unittest.TestCase):
         d1.close()
         d2.close()
 
+    def _setup_directories(self):
+        """
+        setup the input and output directories removed in tearDown
+        """
+        for directory in (self.RAPID_DATA_PATH,
+                          os.path.join(self.OUTPUT_DATA_PATH, "output")):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+
     def _setup_automated(self, directory_name):
         """
         setup for automated method
@@ -414,6 +435,226 @@ class TestRAPIDInflow(unittest.TestCase):
             # check output file info
             assert output_file_info[i]['x-x']['m3_riv'] == generated_m3_file
 
+    def test_generate_era20cm_inflow_time_chunks(self):
+        """
+        Checks generating inflow file from ERA 20CM LSM in worker
+        processes a few time steps at a time
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+
+        output_file_info = run_lsm_rapid_process(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 1, 31),
+            ensemble_list=range(2),
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            inflow_processing_mode="process",
+            inflow_memory_budget=3000,
+        )
+
+        for i in range(2):
+            # CHECK OUTPUT
+            # m3_riv
+            m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_{0}.nc".format(i)
+            generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+            generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+
+            self._compare_m3(generated_m3_file,generated_m3_file_solution)
+            # check output file info
+            assert output_file_info[i]['x-x']['m3_riv'] == generated_m3_file
+
+    def test_generate_era20cm_inflow_parallel_ensembles(self):
+        """
+        Checks generating inflow files from ERA 20CM LSM
+        with the ensembles run in parallel tasks
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+
+        output_file_info = run_lsm_rapid_process(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 1, 31),
+            ensemble_list=range(3),
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            ensemble_processing_mode="parallel",
+        )
+
+        for i in range(3):
+            # CHECK OUTPUT
+            # m3_riv
+            m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_{0}.nc".format(i)
+            generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+            generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+
+            self._compare_m3(generated_m3_file,generated_m3_file_solution)
+            # check output file info
+            assert output_file_info[i]['x-x']['m3_riv'] == generated_m3_file
+
+    def test_generate_era20cm_inflow_combined_watersheds(self):
+        """
+        Checks generating inflow files of two watersheds from ERA 20CM LSM
+        reading each LSM file once
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+        copytree(rapid_input_path, os.path.join(self.RAPID_DATA_PATH, "x-x2"))
+
+        output_file_info = run_lsm_rapid_process(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 1, 31),
+            ensemble_list=[0],
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            combine_watershed_inflow=True,
+        )
+
+        m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_0.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        for watershed in ("x-x", "x-x2"):
+            # CHECK OUTPUT
+            # m3_riv
+            generated_m3_file = os.path.join(self.OUTPUT_DATA_PATH, "output", watershed, m3_file_name)
+            self._compare_m3(generated_m3_file, generated_m3_file_solution)
+            # check output file info
+            assert output_file_info[0][watershed]['m3_riv'] == generated_m3_file
+
+    def test_generate_era20cm_inflow_combined_watersheds_resume(self):
+        """
+        Checks only the watersheds with inflow to update are combined
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+        copytree(rapid_input_path, os.path.join(self.RAPID_DATA_PATH, "x-x2"))
+        run_options = dict(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 1, 31),
+            ensemble_list=[0],
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            expected_time_step=10800,
+            combine_watershed_inflow=True,
+            resume=True,
+        )
+        m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_0.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        generated_m3_file2 = os.path.join(self.OUTPUT_DATA_PATH, "output", "x-x2", m3_file_name)
+
+        run_lsm_rapid_process(**run_options)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+        self._compare_m3(generated_m3_file2, generated_m3_file_solution)
+
+        # the up to date inflow file is not written again
+        with Dataset(generated_m3_file, 'a') as d1:
+            d1.variables['m3_riv'][:] = -1
+        m3_mtime2 = os.path.getmtime(generated_m3_file2)
+        run_lsm_rapid_process(**run_options)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+        assert os.path.getmtime(generated_m3_file2) == m3_mtime2
+
+    def test_generate_era20cm_inflow_incremental(self):
+        """
+        Checks extending an inflow file from ERA 20CM LSM
+        with the new LSM files only
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+        run_options = dict(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            ensemble_list=[0],
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            expected_time_step=10800,
+            incremental_inflow=True,
+        )
+        m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_0.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        generated_m3_file = os.path.join(rapid_output_path, "m3_riv_bas_era_20cm_t159_3hr_20000129_0.nc")
+
+        run_lsm_rapid_process(simulation_end_datetime=datetime(2000, 1, 29),
+                              **run_options)
+        with Dataset(generated_m3_file) as d1:
+            assert d1.dimensions['time'].isunlimited()
+            assert len(d1.dimensions['time']) == 8
+
+        output_file_info = run_lsm_rapid_process(simulation_end_datetime=datetime(2014, 1, 31),
+                                                 **run_options)
+        assert output_file_info[0]['x-x']['m3_riv'] == generated_m3_file
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+        with Dataset(generated_m3_file) as d1, Dataset(generated_m3_file_solution) as d2:
+            assert (d1.variables['time'][:] == d2.variables['time'][:]).all()
+            assert (d1.variables['time_bnds'][:] == d2.variables['time_bnds'][:]).all()
+
+        # the converted LSM files are not converted again
+        with Dataset(generated_m3_file, 'a') as d1:
+            d1.variables['m3_riv'][:] = -1
+        run_lsm_rapid_process(simulation_end_datetime=datetime(2014, 1, 31),
+                              **run_options)
+        with Dataset(generated_m3_file) as d1:
+            assert (d1.variables['m3_riv'][:] == -1).all()
+
+    def test_generate_era20cm_inflow_resume(self):
+        """
+        Checks skipping the up to date inflow from ERA 20CM LSM
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("x-x")
+        run_options = dict(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 1, 31),
+            ensemble_list=[0],
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            expected_time_step=10800,
+            resume=True,
+        )
+        m3_file_name = "m3_riv_bas_era_20cm_t159_3hr_20000129to20000130_0.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        run_manifest_file = os.path.join(rapid_output_path,
+                                         "run_manifest_era_20cm_t159_3hr_20000129to20000130_0.json")
+
+        run_lsm_rapid_process(**run_options)
+        assert os.path.exists(run_manifest_file)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+
+        # the inflow is up to date
+        m3_mtime = os.path.getmtime(generated_m3_file)
+        run_lsm_rapid_process(**run_options)
+        assert os.path.getmtime(generated_m3_file) == m3_mtime
+
+        # a changed inflow file is generated again
+        with Dataset(generated_m3_file, 'a') as d1:
+            d1.variables['m3_riv'][:] = -1
+        run_lsm_rapid_process(**run_options)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+
     def test_generate_era20cm_inflow2(self):
         """
         Checks generating inflow file from ERA 20CM LSM manually
@@ -466,6 +707,58 @@ class TestRAPIDInflow(unittest.TestCase):
 
         self._compare_m3(generated_m3_file, generated_m3_file_solution)
 
+    def test_generate_erai_t255_inflow_netcdf4(self):
+        """
+        Checks generating a chunked and compressed NETCDF4 inflow file
+        from ERA Interim t255 LSM
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("x-x")
+
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'erai3t255', '*.nc')))
+
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+
+        m3_file_name = "m3_riv_bas_erai_t255_3hr_20140820to20140821.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+
+        inf_tool.generateOutputInflowFile(out_nc=generated_m3_file,
+                                          start_datetime_utc=datetime(2014,8,20),
+                                          number_of_timesteps=len(lsm_file_list)*8,
+                                          simulation_time_step_seconds=3*3600,
+                                          in_rapid_connect_file=os.path.join(rapid_input_path, 'rapid_connect.csv'),
+                                          in_rivid_lat_lon_z_file=os.path.join(rapid_input_path, 'comid_lat_lon_z.csv'),
+                                          land_surface_model_description="RAPID Inflow from ERA Interim (T255 Grid) 3 Hourly Runoff",
+                                          modeling_institution="US Army Engineer Research and Development Center",
+                                          file_format="NETCDF4",
+                                          chunksizes=(5, 9),
+                                          zlib=True)
+
+        inf_tool.execute(nc_file_list=lsm_file_list,
+                         index_list=list(xrange(len(lsm_file_list))),
+                         in_weight_table=os.path.join(rapid_input_path, 'weight_era_t255.csv'),
+                         out_nc=generated_m3_file,
+                         grid_type='t255',
+                         mp_lock=None)
+
+        # CHECK OUTPUT
+        with Dataset(generated_m3_file) as d1:
+            assert d1.file_format == "NETCDF4"
+            assert d1.variables['m3_riv'].chunking() == [5, 9]
+            assert d1.variables['m3_riv'].filters()['zlib']
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+
+        with pytest.raises(ValueError):
+            inf_tool.generateOutputInflowFile(out_nc=generated_m3_file,
+                                              start_datetime_utc=datetime(2014,8,20),
+                                              number_of_timesteps=len(lsm_file_list)*8,
+                                              simulation_time_step_seconds=3*3600,
+                                              in_rapid_connect_file=os.path.join(rapid_input_path, 'rapid_connect.csv'),
+                                              in_rivid_lat_lon_z_file=os.path.join(rapid_input_path, 'comid_lat_lon_z.csv'),
+                                              land_surface_model_description="RAPID Inflow from ERA Interim (T255 Grid) 3 Hourly Runoff",
+                                              modeling_institution="US Army Engineer Research and Development Center",
+                                              zlib=True)
+
     def test_generate_erai_t255_inflow2(self):
         """
         Checks generating inflow file from ERA Interim t255 LSM manually
@@ -575,6 +868,88 @@ class TestRAPIDInflow(unittest.TestCase):
         # check output file info
         assert output_file_info[0]['u-k']['m3_riv'] == generated_m3_file
 
+    def test_generate_lis_inflow_process(self):
+        """
+        Checks the inflow file from LIS LSM converted by a pool of
+        worker processes matches the inflow converted in this process
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("u-k")
+        run_options = dict(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'lis'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 12, 31),
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=False,
+            num_processors=4,
+            convert_one_hour_to_three=True,
+        )
+        m3_file_name = "m3_riv_bas_nasa_lis_3hr_20110121to20110121.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+
+        run_lsm_rapid_process(inflow_processing_mode='serial', **run_options)
+        with Dataset(generated_m3_file) as d1:
+            serial_m3_riv = d1.variables['m3_riv'][:]
+            serial_time = d1.variables['time'][:]
+        os.remove(generated_m3_file)
+
+        run_lsm_rapid_process(inflow_processing_mode='process', **run_options)
+        with Dataset(generated_m3_file) as d1:
+            process_m3_riv = d1.variables['m3_riv'][:]
+            assert (d1.variables['time'][:] == serial_time).all()
+        assert not np.ma.is_masked(process_m3_riv)
+        assert (process_m3_riv == serial_m3_riv).all()
+
+        # the number of workers is limited by the memory
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'lis', '*.nc')))
+        weight_table_file = os.path.join(rapid_input_path, 'weight_lis.csv')
+        inf_tool = identify_lsm_grid(lsm_file_list[0])['rapid_inflow_tool']
+        assert get_num_inflow_workers(4, lsm_file_list, weight_table_file,
+                                      inf_tool, memory_budget=1) == 4
+        if get_available_memory() is not None:
+            assert get_num_inflow_workers(4, lsm_file_list, weight_table_file,
+                                          inf_tool, memory_budget=2 ** 60) == 1
+
+    def test_generate_lis_inflow_incremental(self):
+        """
+        Checks extending an inflow file from LIS LSM with runoff
+        in kg m-2 s-1 with the new LSM files only
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("u-k")
+        run_options = dict(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'lis'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            convert_one_hour_to_three=True,
+            incremental_inflow=True,
+        )
+        m3_file_name = "m3_riv_bas_nasa_lis_3hr_20110121to20110121.nc"
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        generated_m3_file = os.path.join(rapid_output_path, "m3_riv_bas_nasa_lis_3hr_20110121.nc")
+
+        run_lsm_rapid_process(simulation_end_datetime=datetime(2011, 1, 21, 11),
+                              **run_options)
+        with Dataset(generated_m3_file) as d1:
+            assert len(d1.dimensions['time']) == 4
+
+        output_file_info = run_lsm_rapid_process(simulation_end_datetime=datetime(2014, 12, 31),
+                                                 **run_options)
+        assert output_file_info[0]['u-k']['m3_riv'] == generated_m3_file
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+        # the new time steps are written with the runoff rate conversion
+        with Dataset(generated_m3_file) as d1:
+            m3_riv = d1.variables['m3_riv'][:]
+            assert not np.ma.is_masked(m3_riv)
+            assert (m3_riv[4:] > 0).any(axis=1).all()
+
     def test_generate_lis_inflow2(self):
         """
         Checks generating inflow file from LIS LSM manually
@@ -639,6 +1014,40 @@ class TestRAPIDInflow(unittest.TestCase):
         # check output file info
         assert output_file_info[0]['u-k']['m3_riv'] == generated_m3_file
 
+    def test_generate_joules_inflow_time_step_factor(self):
+        """
+        Checks summing the Joules LSM time steps into 6 hourly inflow
+        """
+        rapid_input_path, rapid_output_path = self._setup_automated("u-k")
+        output_file_info = run_lsm_rapid_process(
+            rapid_executable_location=RAPID_EXE_PATH,
+            cygwin_bin_location=self.CYGWIN_BIN_PATH,
+            rapid_io_files_location=self.OUTPUT_DATA_PATH,
+            lsm_data_location=os.path.join(self.LSM_INPUT_DATA_PATH, 'joules'),
+            simulation_start_datetime=datetime(1980, 1, 1),
+            simulation_end_datetime=datetime(2014, 12, 31),
+            generate_rapid_namelist_file=False,
+            run_rapid_simulation=False,
+            use_all_processors=True,
+            file_datetime_pattern="%Y%m%d_%H",
+            file_datetime_re_pattern=r'\d{8}_\d{2}',
+            inflow_processing_mode='process',
+            time_step_factor=6,
+        )
+
+        generated_m3_file = os.path.join(rapid_output_path,
+                                         "m3_riv_bas_met_office_joules_6hr_20080803to20080803.nc")
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH,
+                                                  "m3_riv_bas_met_office_joules_3hr_20080803to20080803.nc")
+        assert output_file_info[0]['u-k']['m3_riv'] == generated_m3_file
+        with Dataset(generated_m3_file) as d1, Dataset(generated_m3_file_solution) as d2:
+            m3_riv_solution = d2.variables['m3_riv'][:]
+            assert d1.variables['m3_riv'].shape == (4, m3_riv_solution.shape[1])
+            np.testing.assert_allclose(d1.variables['m3_riv'][:],
+                                       m3_riv_solution[0::2] + m3_riv_solution[1::2],
+                                       rtol=1e-6)
+            assert (np.diff(d1.variables['time_bnds'][:], axis=1) == 6 * 3600).all()
+
     def test_generate_joules_inflow2(self):
         """
         Checks generating inflow file from Joules LSM manually
@@ -682,6 +1091,61 @@ class TestRAPIDInflow(unittest.TestCase):
 
         self._compare_m3(generated_m3_file, generated_m3_file_solution)
 
+    def test_share_weight_table(self):
+        """
+        Checks generating inflow file from Joules LSM with a weight table
+        shared with a pickled copy of the tool
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("u-k")
+
+        lsm_file_list = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH, 'joules', '*.nc')))
+
+        inf_tool = CreateInflowFileFromLDASRunoff(lat_dim="north_south",
+                                                  lon_dim="east_west",
+                                                  lat_var="north_south",
+                                                  lon_var="east_west",
+                                                  runoff_vars=["Qs_inst",
+                                                               "Qsb_inst"])
+
+        m3_file_name = "m3_riv_bas_met_office_joules_3hr_20080803to20080803.nc"
+        generated_m3_file = os.path.join(rapid_output_path, m3_file_name)
+        weight_table_file = os.path.join(rapid_input_path, 'weight_joules.csv')
+
+        inf_tool.generateOutputInflowFile(out_nc=generated_m3_file,
+                                          start_datetime_utc=datetime(2008,3,3),
+                                          number_of_timesteps=len(lsm_file_list) // 3,
+                                          simulation_time_step_seconds=3*3600,
+                                          in_rapid_connect_file=os.path.join(rapid_input_path, 'rapid_connect.csv'),
+                                          in_rivid_lat_lon_z_file=os.path.join(rapid_input_path, 'comid_lat_lon_z.csv'),
+                                          land_surface_model_description="RAPID Inflow from Met Office Joules Hourly Runoff",
+                                          modeling_institution="US Army Engineer Research and Development Center"
+                                          )
+
+        share_directory = os.path.join(rapid_output_path, 'shared_weight_table')
+        os.mkdir(share_directory)
+        inf_tool.share_weight_table(weight_table_file, share_directory,
+                                    use_float32=True)
+        # the pickled tool only has the location of the weight table
+        worker_tool = pickle.loads(pickle.dumps(inf_tool))
+        assert not worker_tool.weight_matrix.data.flags.writeable
+        assert worker_tool.float32_weight_matrices is not None
+
+        worker_tool.execute(nc_file_list=lsm_file_list,
+                            index_list=list(xrange(len(lsm_file_list))),
+                            in_weight_table=weight_table_file,
+                            out_nc=generated_m3_file,
+                            grid_type='joules',
+                            mp_lock=None,
+                            time_step_factor=3)
+
+        generated_m3_file_solution = os.path.join(self.INFLOW_COMPARE_DATA_PATH, m3_file_name)
+        self._compare_m3(generated_m3_file, generated_m3_file_solution)
+
+        inf_tool.release_shared_weight_table()
+        worker_tool.release_shared_weight_table()
+        assert inf_tool.weight_matrix is None
+        rmtree(share_directory)
+
     def test_generate_erai_t511_24_inflow(self):
         """
         Checks generating inflow file from ERA Interim t511 24hr LSM
@@ -810,3 +1274,357 @@ class TestRAPIDInflow(unittest.TestCase):
         # check output file info
         assert output_file_info[0]['ark-ms']['m3_riv'] == generated_m3_file
 
+
+    @staticmethod
+    def _sum_inflow_per_stream(inf_tool, data_subset_all, conversion_factor,
+                               grid_type):
+        """
+        Sums the inflow of one stream at a time from the weight table
+        rows like the tool did before the sparse weight matrix
+        """
+        inflow_data = np.zeros((data_subset_all.shape[0],
+                                inf_tool.size_stream_id))
+        pointer = 0
+        for stream_index in xrange(inf_tool.size_stream_id):
+            npoints = int(inf_tool.dict_list[inf_tool.header_wt[4]][pointer])
+            area_sqm_npoints = np.array(
+                [float(k) for k in inf_tool.dict_list[inf_tool.header_wt[1]][
+                    pointer:(pointer + npoints)]])
+            data_goal = data_subset_all[:, pointer:(pointer + npoints)]
+            if grid_type == 't255':
+                ro_first_half = \
+                    np.concatenate([data_goal[0:1, ],
+                                    np.subtract(data_goal[1:4, ],
+                                                data_goal[0:3, ])])
+                ro_second_half = \
+                    np.concatenate([data_goal[4:5, ],
+                                    np.subtract(data_goal[5:, ],
+                                                data_goal[4:7, ])])
+                ro_stream = np.multiply(
+                    np.concatenate([ro_first_half, ro_second_half]),
+                    area_sqm_npoints)
+            else:
+                ro_stream = data_goal * area_sqm_npoints * conversion_factor
+            ro_stream[np.isnan(ro_stream)] = 0
+            if ro_stream.any():
+                inflow_data[:, stream_index] = ro_stream.sum(axis=1)
+            pointer += npoints
+        return inflow_data
+
+    def test_aggregate_inflow_per_stream(self):
+        """
+        Checks the inflow is exactly the sum of the inflow of one
+        stream at a time
+        """
+        for watershed_folder, weight_table_name, lsm_folder, grid_type, \
+                inf_tool in (
+                    ('u-k', 'weight_joules.csv', 'joules', 'joules',
+                     CreateInflowFileFromLDASRunoff(lat_dim="north_south",
+                                                    lon_dim="east_west",
+                                                    lat_var="north_south",
+                                                    lon_var="east_west",
+                                                    runoff_vars=["Qs_inst",
+                                                                 "Qsb_inst"])),
+                    ('x-x', 'weight_era_t255.csv', 'erai3t255', 't255',
+                     CreateInflowFileFromERAInterimRunoff())):
+            rapid_input_path, _ = self._setup_manual(watershed_folder)
+            inf_tool.read_in_weight_table(
+                os.path.join(rapid_input_path, weight_table_name),
+                use_cache=False)
+            lsm_file = sorted(glob(os.path.join(self.LSM_INPUT_DATA_PATH,
+                                                lsm_folder, '*.nc')))[0]
+            data_subset_all, conversion_factor = \
+                inf_tool.read_runoff(lsm_file, num_nc_files=1)
+            # random runoff rounds differently if summed in another order
+            random_runoff = np.random.RandomState(0).lognormal(
+                size=(8, data_subset_all.shape[1])).astype(np.float32)
+
+            for runoff, runoff_conversion_factor in \
+                    ((data_subset_all, conversion_factor),
+                     (random_runoff, 0.001)):
+                inflow_list = list(inf_tool._aggregate_inflow(
+                    [0], [(0, 0, len(runoff), runoff.copy(),
+                           runoff_conversion_factor)],
+                    grid_type))
+                assert len(inflow_list) == 1
+                assert (inflow_list[0][1] ==
+                        self._sum_inflow_per_stream(
+                            inf_tool, runoff, runoff_conversion_factor,
+                            grid_type)).all()
+
+    def test_read_plan_dateline(self):
+        """
+        Checks the grid is read in separate rectangles for cells
+        on both sides of the dateline
+        """
+        self._setup_directories()
+        lon_ind_all = np.array([0, 1, 2, 0, 1437, 1438, 1439, 1439])
+        lat_ind_all = np.array([300, 300, 301, 302, 300, 301, 301, 302])
+        read_plan, index_new = \
+            CreateInflowFileFromERAInterimRunoff._compile_read_plan(lat_ind_all,
+                                                                    lon_ind_all)
+        assert read_plan.tolist() == [[300, 303, 0, 3], [300, 303, 1437, 1440]]
+
+        runoff = np.arange(2 * 721 * 1440, dtype=np.float32).reshape(2, 721, 1440)
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.read_plan = read_plan
+        data_subset_runoff = inf_tool._read_runoff_subset([runoff], slice(0, 2))
+        assert data_subset_runoff.shape == (2, 18)
+        assert (data_subset_runoff[:, index_new] ==
+                runoff[:, lat_ind_all, lon_ind_all]).all()
+
+    def test_read_runoff_without_masked_arrays(self):
+        """
+        Checks the runoff read without masked arrays matches the runoff
+        read with masked arrays
+        """
+        self._setup_directories()
+        runoff_file = os.path.join(self.RAPID_DATA_PATH, 'runoff.nc')
+        with Dataset(runoff_file, 'w') as runoff_nc:
+            runoff_nc.createDimension('time', 2)
+            runoff_nc.createDimension('lat', 3)
+            runoff_nc.createDimension('lon', 4)
+            runoff_nc.createVariable('lat', 'f8', ('lat',))[:] = np.arange(3)
+            runoff_nc.createVariable('lon', 'f8', ('lon',))[:] = np.arange(4)
+
+            # fill, missing and out of range values
+            runoff_a = np.arange(24, dtype=np.float32).reshape(2, 3, 4) - 3
+            runoff_a[0, 1, 1] = -9999
+            runoff_a[1, 2, 3] = -8888
+            runoff_a[0, 2, 2] = 150
+            var_a = runoff_nc.createVariable('a', 'f4', ('time', 'lat', 'lon'),
+                                             fill_value=-9999)
+            var_a.missing_value = np.float32(-8888)
+            var_a.valid_max = np.float32(100)
+            var_a.set_auto_maskandscale(False)
+            var_a[:] = runoff_a
+
+            # packed values
+            runoff_b = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+            runoff_b[1, 1, 2] = -32767
+            var_b = runoff_nc.createVariable('b', 'i2', ('time', 'lat', 'lon'),
+                                             fill_value=-32767)
+            var_b.scale_factor = 0.5
+            var_b.add_offset = 1.0
+            var_b.set_auto_maskandscale(False)
+            var_b[:] = runoff_b
+
+            # NaN fill value
+            runoff_c = np.ones((2, 3, 4))
+            runoff_c[0, 0, 3] = np.nan
+            var_c = runoff_nc.createVariable('c', 'f8', ('time', 'lat', 'lon'),
+                                             fill_value=np.nan)
+            var_c.set_auto_maskandscale(False)
+            var_c[:] = runoff_c
+
+        inf_tool = CreateInflowFileFromLDASRunoff(lat_dim="lat",
+                                                  lon_dim="lon",
+                                                  lat_var="lat",
+                                                  lon_var="lon",
+                                                  runoff_vars=["a", "b", "c"])
+        inf_tool.read_plan = np.array([[0, 2, 1, 4], [2, 3, 0, 4]])
+        inf_tool.index_new = np.array([0, 2, 3, 5, 6, 7, 9])
+        runoff, _ = inf_tool.read_runoff(runoff_file)
+        masked_runoff, _ = inf_tool.read_runoff(runoff_file,
+                                                use_masked_arrays=True)
+        assert runoff.dtype == masked_runoff.dtype
+        assert (runoff == masked_runoff).all()
+        assert runoff[0, 1] == 0
+        assert runoff[1, 6] == 0
+
+    def test_weight_table_bad_rows(self):
+        """
+        Checks all of the out of sequence weight table rows are reported
+        """
+        self._setup_directories()
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.count = 7
+        inf_tool.dict_list = {
+            inf_tool.header_wt[0]: np.array([10, 10, 20, 30, 30, 10, 40]),
+            inf_tool.header_wt[4]: np.array([2, 2, 1, 2, 3, 1, 1]),
+        }
+        with pytest.raises(WeightTableError) as excinfo:
+            inf_tool._validate_weight_table()
+        assert excinfo.value.bad_rows.tolist() == [4, 5]
+        assert excinfo.value.rivids.tolist() == [30, 10]
+
+        inf_tool.dict_list[inf_tool.header_wt[4]] = np.array([2, 2, 1, 2, 2, 1, 1])
+        inf_tool.dict_list[inf_tool.header_wt[0]][5] = 50
+        assert inf_tool._validate_weight_table().tolist() == [0, 2, 3, 5, 6, 7]
+
+    def test_write_lat_lon(self):
+        """
+        Checks the lat/lon join and that all missing rivids are reported
+        """
+        self._setup_directories()
+        lat_lon_file = os.path.join(self.RAPID_DATA_PATH, 'comid_lat_lon_z.csv')
+        with open(lat_lon_file, 'w') as lat_lon_csv:
+            lat_lon_csv.write("rivid,lat,lon,z\n30,3.5,-30.5,0\n10,1.5,-10.5,0\n"
+                              "20,2.5,-20.5,0\n10,9.5,-90.5,0\n")
+
+        with Dataset(os.path.join(self.RAPID_DATA_PATH, 'm3_riv.nc'), 'w') as data_out_nc:
+            data_out_nc.createDimension('rivid', 3)
+            data_out_nc.createVariable('rivid', 'i4', ('rivid',))[:] = [20, 10, 30]
+            data_out_nc.createVariable('lat', 'f8', ('rivid',))
+            data_out_nc.createVariable('lon', 'f8', ('rivid',))
+            CreateInflowFileFromERAInterimRunoff._write_lat_lon(data_out_nc, lat_lon_file)
+            assert data_out_nc.variables['lat'][:].tolist() == [2.5, 1.5, 3.5]
+            assert data_out_nc.variables['lon'][:].tolist() == [-20.5, -10.5, -30.5]
+            assert data_out_nc.geospatial_lat_min == 1.5
+            assert data_out_nc.geospatial_lat_max == 3.5
+            assert data_out_nc.geospatial_lon_min == -30.5
+            assert data_out_nc.geospatial_lon_max == -10.5
+
+            data_out_nc.variables['rivid'][:] = [40, 10, 5]
+            with pytest.raises(Exception) as excinfo:
+                CreateInflowFileFromERAInterimRunoff._write_lat_lon(data_out_nc, lat_lon_file)
+            assert "[40, 5]" in str(excinfo.value)
+
+    def test_lsm_file_catalog(self):
+        """
+        Checks the LSM file catalog is updated with new files
+        and filters the files by datetime
+        """
+        self._setup_directories()
+        lsm_data_location = os.path.join(self.RAPID_DATA_PATH, 'lsm')
+        os.makedirs(os.path.join(lsm_data_location, '2000'))
+        os.makedirs(os.path.join(lsm_data_location, '2001'))
+        for file_date in ('20001230', '20001231', '20010101'):
+            open(os.path.join(lsm_data_location, file_date[:4],
+                              'runoff_{0}.nc'.format(file_date)), 'w').close()
+        catalog_file = os.path.join(self.RAPID_DATA_PATH, 'lsm_catalog.pkl')
+        file_re_match = re.compile(r'\d{8}')
+
+        lsm_file_catalog = LSMFileCatalog(lsm_data_location, catalog_file)
+        lsm_file_catalog.refresh()
+        lsm_file_list = lsm_file_catalog.get_file_list(('.nc', '.nc4'))
+        assert [os.path.basename(lsm_file) for lsm_file in lsm_file_list] == \
+            ['runoff_20001230.nc', 'runoff_20001231.nc', 'runoff_20010101.nc']
+        assert lsm_file_catalog.filter_by_datetime(lsm_file_list, file_re_match, "%Y%m%d",
+                                                   datetime(2000, 12, 31),
+                                                   datetime(2001, 1, 1)) == lsm_file_list[1:]
+        lsm_file_catalog.save()
+
+        open(os.path.join(lsm_data_location, '2001', 'runoff_20010102.nc'), 'w').close()
+        # make sure the directory looks modified
+        os.utime(os.path.join(lsm_data_location, '2001'), (0, 0))
+        lsm_file_catalog = LSMFileCatalog(lsm_data_location, catalog_file)
+        assert (datetime(2000, 12, 30) in
+                lsm_file_catalog.file_datetimes[(r'\d{8}', "%Y%m%d")].values())
+        lsm_file_catalog.refresh()
+        lsm_file_list = lsm_file_catalog.get_file_list(('.nc',))
+        assert len(lsm_file_list) == 4
+        assert lsm_file_catalog.filter_by_datetime(lsm_file_list, file_re_match, "%Y%m%d",
+                                                   datetime(2001, 1, 2),
+                                                   datetime(2014, 1, 1)) == lsm_file_list[3:]
+
+    def test_identify_lsm_grid_catalog(self):
+        """
+        Checks the LSM grid of the files in the catalog is identified once
+        for files with the same header
+        """
+        self._setup_directories()
+        lsm_data_location = os.path.join(self.LSM_INPUT_DATA_PATH, 'era20cm')
+        lsm_file_catalog = LSMFileCatalog(lsm_data_location)
+        lsm_file_catalog.refresh()
+        lsm_file_list = lsm_file_catalog.get_file_list(('_0.nc', '_1.nc'))
+
+        for lsm_file in lsm_file_list:
+            lsm_file_data = identify_lsm_grid(lsm_file, lsm_file_catalog)
+            assert lsm_file_data['grid_type'] == 't159'
+            assert lsm_file_data['weight_file_name'] == r'weight_era_t159\.csv'
+            assert isinstance(lsm_file_data['rapid_inflow_tool'],
+                              CreateInflowFileFromERAInterimRunoff)
+        assert len(lsm_file_catalog.file_headers) == len(lsm_file_list)
+        assert len(lsm_file_catalog.grid_info) == 1
+        assert lsm_file_catalog.get_file_header(lsm_file_list[0]) == \
+            read_lsm_file_header(lsm_file_list[0])
+
+    def test_determine_start_end_timestep_catalog(self):
+        """
+        Checks the simulation window is computed from the time steps
+        of each LSM file kept in the catalog
+        """
+        self._setup_directories()
+        lsm_data_location = os.path.join(self.LSM_INPUT_DATA_PATH, 'wrf')
+        lsm_file_catalog = LSMFileCatalog(lsm_data_location)
+        lsm_file_catalog.refresh()
+        lsm_file_list = lsm_file_catalog.get_file_list(('.nc',))
+        lsm_file_data = identify_lsm_grid(lsm_file_list[0], lsm_file_catalog)
+
+        start_end_timestep = \
+            determine_start_end_timestep(lsm_file_list,
+                                         lsm_grid_info=lsm_file_data,
+                                         lsm_file_catalog=lsm_file_catalog)
+        assert start_end_timestep == (datetime(2008, 6, 1, 1), datetime(2008, 6, 1, 23),
+                                      3600, 23)
+        assert len(lsm_file_catalog.file_times) == len(lsm_file_list)
+        assert lsm_file_catalog.get_file_times(lsm_file_list[-1]) == \
+            (1, datetime(2008, 6, 1, 23), datetime(2008, 6, 1, 23))
+
+        # the time steps of unchanged files are read from the catalog
+        lsm_file_catalog.set_file_times(lsm_file_list[-1],
+                                        (2, datetime(2008, 6, 1, 23),
+                                         datetime(2008, 6, 2)))
+        assert determine_start_end_timestep(lsm_file_list,
+                                            lsm_grid_info=lsm_file_data,
+                                            lsm_file_catalog=lsm_file_catalog) == \
+            (datetime(2008, 6, 1, 1), datetime(2008, 6, 2), 3600, 24)
+
+    def test_float32_weight_matrices(self):
+        """
+        Checks the float32 inflow of streams with many grid cells
+        is within the documented error of the float64 inflow
+        """
+        self._setup_directories()
+        num_cells = np.array([10000, 0, 5])
+        stream_pointers = np.concatenate([[0], np.cumsum(num_cells)])
+        random_state = np.random.RandomState(0)
+
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.size_stream_id = num_cells.size
+        inf_tool.count = stream_pointers[-1]
+        inf_tool.weight_matrix = csr_matrix(
+            (random_state.uniform(1e6, 1e9, inf_tool.count),
+             np.arange(inf_tool.count),
+             stream_pointers),
+            shape=(inf_tool.size_stream_id, inf_tool.count))
+        runoff = random_state.uniform(0, 0.01, (4, inf_tool.count)).astype(np.float32)
+
+        inflow_float64 = inf_tool.weight_matrix.dot(runoff.T.astype(np.float64))
+        inflow_float32 = runoff.T
+        for weight_matrix in inf_tool._get_float32_weight_matrices():
+            inflow_float32 = weight_matrix.dot(inflow_float32)
+
+        assert inflow_float32.dtype == np.float32
+        assert (inflow_float32[1] == 0).all()
+        relative_error = np.abs(inflow_float32[[0, 2]] - inflow_float64[[0, 2]]) / \
+            inflow_float64[[0, 2]]
+        assert relative_error.max() < (64 + 10000 / 64. + 3) * 2 ** -24
+
+    def test_weight_table_cache(self):
+        """
+        Checks the compiled weight table cache is used and invalidated
+        """
+        rapid_input_path, rapid_output_path = self._setup_manual("x-x")
+        weight_table_file = os.path.join(rapid_input_path, 'weight_era_t159.csv')
+
+        inf_tool = CreateInflowFileFromERAInterimRunoff()
+        inf_tool.read_in_weight_table(weight_table_file)
+        assert os.path.exists(os.path.join(rapid_input_path, 'weight_era_t159_compiled.npy'))
+        assert os.path.exists(os.path.join(rapid_input_path, 'weight_era_t159_compiled.npz'))
+
+        cached_tool = CreateInflowFileFromERAInterimRunoff()
+        assert cached_tool._load_weight_table_cache(weight_table_file)
+        assert cached_tool.count == inf_tool.count
+        assert cached_tool.size_stream_id == inf_tool.size_stream_id
+        assert cached_tool.lat_slice == inf_tool.lat_slice
+        assert cached_tool.lon_slice == inf_tool.lon_slice
+        assert (cached_tool.index_new == inf_tool.index_new).all()
+        assert (cached_tool.weight_matrix != inf_tool.weight_matrix).nnz == 0
+
+        # modifying the weight table invalidates the cache
+        weight_table_stat = os.stat(weight_table_file)
+        os.utime(weight_table_file, (weight_table_stat.st_atime,
+                                     weight_table_stat.st_mtime + 10))
+        assert not cached_tool._load_weight_table_cache(weight_table_file)
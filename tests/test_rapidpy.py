@@ -18,13 +18,14 @@ import pytest
 #local import
 from RAPIDpy import RAPID
 from RAPIDpy import RAPIDDataset
-from RAPIDpy.dataset import compare_qout_files
+from RAPIDpy.dataset import compare_qout_files, QoutBlockCache
 from RAPIDpy.helper_functions import (compare_csv_decimal_files,
                                       compare_csv_timeseries_files,
                                       remove_files)
 
 from RAPIDpy.postprocess import find_goodness_of_fit, find_goodness_of_fit_csv
 from RAPIDpy.postprocess import ConvertRAPIDOutputToCF
+from RAPIDpy.utilities import prefetch, run_pipeline, run_tasks
 
 #GLOBAL VARIABLES
 MAIN_TESTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
@@ -965,3 +966,314 @@ def test_dataset_exceptions():
             qout_nc.write_flows_to_gssha_time_series_ihg(
                 dummy_file,
                 dummy_file)
+
+
+def test_prefetch():
+    """This tests reading ahead with prefetch"""
+    print("TEST 18: TEST PREFETCH")
+    argument_list = [(value,) for value in range(10)]
+    for depth in (0, 1, 3):
+        assert list(prefetch(lambda value: value * 2,
+                             argument_list, depth)) == \
+            [value * 2 for value in range(10)]
+
+    def _fail_on_five(value):
+        if value == 5:
+            raise ValueError("five")
+        return value
+
+    results = []
+    with pytest.raises(ValueError):
+        for result in prefetch(_fail_on_five, argument_list, 2):
+            results.append(result)
+    assert results == list(range(5))
+
+
+def _append_task_name(task_file, task_name, fail=False):
+    """Records the task that ran for test_run_tasks"""
+    with open(task_file, 'a') as task_out:
+        task_out.write("{0}\n".format(task_name))
+    if fail:
+        raise ValueError(task_name)
+
+
+def test_run_tasks():
+    """This tests running tasks with dependencies on a CPU budget"""
+    print("TEST 19: TEST RUN TASKS")
+    task_file = os.path.join(OUTPUT_DATA_PATH, 'run_tasks.txt')
+    remove_files(task_file)
+    task_list = [
+        {'name': 'rapid_a', 'function': _append_task_name,
+         'args': (task_file, 'rapid_a'), 'cpus': 2,
+         'depends_on': ['inflow_a']},
+        {'name': 'inflow_a', 'function': _append_task_name,
+         'args': (task_file, 'inflow_a'), 'cpus': 1},
+        {'name': 'rapid_b', 'function': _append_task_name,
+         'args': (task_file, 'rapid_b'), 'cpus': 4,
+         'depends_on': ['rapid_a']},
+    ]
+    run_tasks(task_list, 2, poll_interval=0.01)
+    with open(task_file) as task_in:
+        assert task_in.read().split() == ['inflow_a', 'rapid_a', 'rapid_b']
+
+    remove_files(task_file)
+    # a task running alone raises its own exception
+    task_list[1]['args'] = (task_file, 'inflow_a', True)
+    with pytest.raises(ValueError):
+        run_tasks(task_list, 2, poll_interval=0.01)
+    with open(task_file) as task_in:
+        assert task_in.read().split() == ['inflow_a']
+    remove_files(task_file)
+
+    # the traceback of a task failing in a child process is raised
+    task_list = [
+        {'name': 'inflow_a', 'function': _append_task_name,
+         'args': (task_file, 'inflow_a'), 'cpus': 1},
+        {'name': 'inflow_b', 'function': _append_task_name,
+         'args': (task_file, 'inflow_b', True), 'cpus': 1},
+    ]
+    with pytest.raises(Exception) as excinfo:
+        run_tasks(task_list, 2, poll_interval=0.01)
+    assert "['inflow_b']" in str(excinfo.value)
+    assert "ValueError: inflow_b" in str(excinfo.value)
+    remove_files(task_file)
+
+
+def _write_stage_output(task_file, task_name, output_file):
+    """Writes the output of a stage for test_run_pipeline"""
+    _append_task_name(task_file, task_name)
+    with open(output_file, 'w') as stage_out:
+        stage_out.write(task_name)
+
+
+def test_run_pipeline():
+    """This tests skipping the up to date stages of a pipeline"""
+    print("TEST 20: TEST RUN PIPELINE")
+    task_file = os.path.join(OUTPUT_DATA_PATH, 'run_pipeline.txt')
+    input_file = os.path.join(OUTPUT_DATA_PATH, 'pipeline_input.txt')
+    rapid_file = os.path.join(OUTPUT_DATA_PATH, 'pipeline_rapid.txt')
+    return_periods_file = \
+        os.path.join(OUTPUT_DATA_PATH, 'pipeline_return_periods.txt')
+    seasonal_file = os.path.join(OUTPUT_DATA_PATH, 'pipeline_seasonal.txt')
+    run_manifest_file = \
+        os.path.join(OUTPUT_DATA_PATH, 'run_manifest_pipeline.json')
+    remove_files(task_file, input_file, rapid_file, return_periods_file,
+                 seasonal_file, run_manifest_file)
+    with open(input_file, 'w') as input_out:
+        input_out.write('input')
+
+    stage_list = [
+        {'name': 'rapid', 'function': _write_stage_output,
+         'args': (task_file, 'rapid', rapid_file), 'cpus': 1,
+         'inputs': [input_file], 'outputs': [rapid_file],
+         'parameters': {'ZS_TauR': 10800}},
+        {'name': 'return_periods', 'function': _write_stage_output,
+         'args': (task_file, 'return_periods', return_periods_file),
+         'cpus': 1, 'inputs': [rapid_file],
+         'outputs': [return_periods_file], 'depends_on': ['rapid']},
+        {'name': 'seasonal_averages', 'function': _write_stage_output,
+         'args': (task_file, 'seasonal_averages', seasonal_file),
+         'cpus': 1, 'inputs': [rapid_file],
+         'outputs': [seasonal_file], 'depends_on': ['rapid']},
+    ]
+
+    def get_task_names():
+        with open(task_file) as task_in:
+            task_names = task_in.read().split()
+        remove_files(task_file)
+        return task_names
+
+    run_pipeline(stage_list, run_manifest_file, 2)
+    task_names = get_task_names()
+    assert task_names[0] == 'rapid'
+    assert sorted(task_names[1:]) == ['return_periods', 'seasonal_averages']
+
+    # everything is up to date
+    run_pipeline(stage_list, run_manifest_file, 2)
+    assert not os.path.exists(task_file)
+
+    # rerun if resume is off
+    run_pipeline(stage_list, run_manifest_file, 2, resume=False)
+    assert len(get_task_names()) == 3
+
+    # only the stages after the changed output
+    os.remove(seasonal_file)
+    run_pipeline(stage_list, run_manifest_file, 2)
+    assert get_task_names() == ['seasonal_averages']
+
+    # a changed parameter reruns the stage and the stages after it
+    stage_list[0]['parameters'] = {'ZS_TauR': 3600}
+    run_pipeline(stage_list, run_manifest_file, 2)
+    assert len(get_task_names()) == 3
+
+    # an input newer than the output
+    rapid_mtime = os.path.getmtime(rapid_file)
+    os.utime(input_file, (rapid_mtime + 10, rapid_mtime + 10))
+    run_pipeline(stage_list, run_manifest_file, 2)
+    assert len(get_task_names()) == 3
+
+    remove_files(input_file, rapid_file, return_periods_file,
+                 seasonal_file, run_manifest_file)
+
+
+def test_river_id_lookup():
+    """This tests finding the index of the river IDs in a Qout file"""
+    print("TEST 21: TEST RIVER ID LOOKUP")
+    cf_qout_file = os.path.join(COMPARE_DATA_PATH,
+                                'Qout_nasa_lis_3hr_20020830_CF.nc')
+    with RAPIDDataset(cf_qout_file) as qout_nc:
+        river_id_list = qout_nc.get_river_id_array().tolist()
+        for river_index, river_id in enumerate(river_id_list):
+            assert qout_nc.get_river_index(river_id) == river_index
+
+        with pytest.raises(IndexError):
+            qout_nc.get_river_index(49876539)
+
+        subset_river_id_list = \
+            [river_id_list[-1], 49876539, river_id_list[0], river_id_list[2]]
+        river_indices, river_ids, missing_river_ids = \
+            qout_nc.get_subset_riverid_index_list(subset_river_id_list)
+        assert river_indices.tolist() == [0, 2, len(river_id_list) - 1]
+        assert river_ids.tolist() == [river_id_list[0], river_id_list[2],
+                                      river_id_list[-1]]
+        assert missing_river_ids.tolist() == [49876539]
+
+
+def test_qout_read_runs():
+    """This tests reading Qout at unordered and repeated indices"""
+    print("TEST 22: TEST QOUT READ RUNS")
+    river_index_list = [4000, 3, 2, 2, 100, 4001, 2, 4167]
+    time_index_list = [5, 0, 1, 15, 5]
+    for qout_file_name in ('Qout_nasa_lis_3hr_20020830.nc',
+                           'Qout_nasa_lis_3hr_20020830_CF.nc'):
+        qout_file = os.path.join(COMPARE_DATA_PATH, qout_file_name)
+        with RAPIDDataset(qout_file) as qout_nc:
+            qout_array = qout_nc.get_qout_index(
+                river_index_list, time_index_array=time_index_list)
+            assert qout_array.shape == (len(river_index_list),
+                                        len(time_index_list))
+            for river_position, river_index in enumerate(river_index_list):
+                river_qout = qout_nc.get_qout_index(river_index)
+                assert qout_array[river_position].tolist() == \
+                    river_qout[time_index_list].tolist()
+
+            assert qout_nc.get_qout_index(river_index_list).tolist() == \
+                qout_nc.get_qout_index()[river_index_list].tolist()
+            assert qout_nc.get_qout_index(-1, time_index=5).tolist() == \
+                qout_nc.get_qout_index(4167)[5:6].tolist()
+
+
+def test_dataset_memmap():
+    """This tests reading Qout mapped into memory"""
+    print("TEST 23: TEST DATASET MEMMAP")
+    river_index_list = [4000, 3, 2, 100]
+    time_index_list = [5, 0, 1, 15]
+    for qout_file_name in ('Qout_nasa_lis_3hr_20020830.nc',
+                           'Qout_nasa_lis_3hr_20020830_CF.nc'):
+        qout_file = os.path.join(COMPARE_DATA_PATH, qout_file_name)
+        with RAPIDDataset(qout_file) as qout_nc, \
+                RAPIDDataset(qout_file, use_memmap=True) as qout_memmap_nc:
+            assert qout_nc.qout_memmap is None
+            assert qout_memmap_nc.qout_memmap is not None
+            assert qout_memmap_nc.get_qout_index().tolist() == \
+                qout_nc.get_qout_index().tolist()
+            assert qout_memmap_nc.get_qout_index(
+                river_index_list,
+                time_index_array=time_index_list).tolist() == \
+                qout_nc.get_qout_index(
+                    river_index_list,
+                    time_index_array=time_index_list).tolist()
+            assert qout_memmap_nc.get_qout(
+                qout_nc.get_river_id_array()[7]).tolist() == \
+                qout_nc.get_qout_index(7).tolist()
+
+    # only classic format files are mapped
+    qout_nc4_file = os.path.join(OUTPUT_DATA_PATH, 'Qout_memmap_nc4.nc')
+    with Dataset(qout_nc4_file, 'w', format='NETCDF4') as qout_nc4:
+        qout_nc4.createDimension('time', 2)
+        qout_nc4.createDimension('rivid', 3)
+        qout_nc4.createVariable('rivid', 'i4', ('rivid',))[:] = [1, 2, 3]
+        qout_nc4.createVariable('Qout', 'f4', ('rivid', 'time'))[:] = \
+            [[1, 2], [3, 4], [5, 6]]
+    with RAPIDDataset(qout_nc4_file, use_memmap=True) as qout_nc:
+        assert qout_nc.qout_memmap is None
+        assert qout_nc.get_qout(2).tolist() == [3, 4]
+    remove_files(qout_nc4_file)
+
+
+def test_dataset_block_cache():
+    """This tests reading Qout through the block cache"""
+    print("TEST 24: TEST DATASET BLOCK CACHE")
+    river_index_list = [4000, 3, 2, 2, 150]
+    time_index_list = [5, 0, 1, 15]
+    for qout_file_name in ('Qout_nasa_lis_3hr_20020830.nc',
+                           'Qout_nasa_lis_3hr_20020830_CF.nc'):
+        qout_file = os.path.join(COMPARE_DATA_PATH, qout_file_name)
+        # too small for the 3 river blocks with 3 time blocks
+        block_cache = QoutBlockCache(max_bytes=4 * 5 * 100 * 3,
+                                     time_block_size=5,
+                                     river_block_size=100)
+        with RAPIDDataset(qout_file) as qout_nc, \
+                RAPIDDataset(qout_file,
+                             block_cache=block_cache) as qout_cache_nc:
+            for _ in range(2):
+                assert qout_cache_nc.get_qout_index(
+                    river_index_list,
+                    time_index_array=time_index_list).tolist() == \
+                    qout_nc.get_qout_index(
+                        river_index_list,
+                        time_index_array=time_index_list).tolist()
+            assert block_cache.misses > 9
+            assert block_cache.num_bytes <= block_cache.max_bytes
+
+        block_cache = QoutBlockCache(time_block_size=5,
+                                     river_block_size=100)
+        with RAPIDDataset(qout_file) as qout_nc, \
+                RAPIDDataset(qout_file,
+                             block_cache=block_cache) as qout_cache_nc:
+            river_id = qout_nc.get_river_id_array()[7]
+            for _ in range(3):
+                assert qout_cache_nc.get_qout(river_id).tolist() == \
+                    qout_nc.get_qout_index(7).tolist()
+            assert qout_cache_nc.get_qout_index(
+                7, time_index=15).tolist() == \
+                qout_nc.get_qout_index(7, time_index=15).tolist()
+            assert block_cache.misses == 4
+            assert block_cache.hits == 9
+            block_cache.clear()
+            assert block_cache.num_bytes == 0
+
+
+def test_iter_qout_blocks():
+    """This tests reading Qout in blocks"""
+    print("TEST 25: TEST ITERATE QOUT BLOCKS")
+    for qout_file_name in ('Qout_nasa_lis_3hr_20020830.nc',
+                           'Qout_nasa_lis_3hr_20020830_CF.nc'):
+        qout_file = os.path.join(COMPARE_DATA_PATH, qout_file_name)
+        with RAPIDDataset(qout_file) as qout_nc:
+            qout_array = qout_nc.get_qout_index()
+
+            block_list = list(qout_nc.iter_qout_blocks(block_size=1000))
+            assert len(block_list) == 5
+            for river_indices, qout_block in block_list:
+                assert qout_block.shape == (len(river_indices),
+                                            qout_nc.size_time)
+                assert qout_block.tolist() == \
+                    qout_array[river_indices].tolist()
+
+            # the block size is limited by the memory budget
+            time_index_list = [0, 3, 4, 5]
+            block_list = list(qout_nc.iter_qout_blocks(
+                axis='time',
+                river_index_array=[7, 2, 4000],
+                time_index_array=time_index_list,
+                max_block_bytes=4 * 3 * 3))
+            assert [time_indices.tolist() for time_indices, _
+                    in block_list] == [[0, 3, 4], [5]]
+            for time_indices, qout_block in block_list:
+                assert qout_block.tolist() == \
+                    qout_array[[7, 2, 4000]][:, time_indices].tolist()
+
+    with pytest.raises(ValueError):
+        with RAPIDDataset(qout_file) as qout_nc:
+            next(qout_nc.iter_qout_blocks(axis='river'))